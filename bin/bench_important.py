@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""%prog [options]
+
+Compares isImportantForProduct against checking each product exclude regex
+in turn, for a push (5000 files by default) where every file is excluded.
+"""
+import time
+
+import buildbotcustom.misc
+from buildbotcustom.misc import isImportantForProduct
+from buildbotcustom.test.test_misc_important import Change, makeBigPush, \
+    naiveIsExcluded
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(__doc__)
+    parser.set_defaults(files=5000, repeat=5, product='mobile')
+    parser.add_option("-f", "--files", dest="files", type="int",
+                      help="number of excluded files in the push")
+    parser.add_option("-n", "--repeat", dest="repeat", type="int",
+                      help="number of times to repeat each check")
+    parser.add_option("-p", "--product", dest="product",
+                      help="product whose excludes to check")
+    options, args = parser.parse_args()
+
+    product = options.product
+    files = [f for f in makeBigPush(options.files * 3)
+             if naiveIsExcluded(product, f)][:options.files]
+    c = Change(files=files)
+
+    start = time.time()
+    for i in range(options.repeat):
+        for f in files:
+            naiveIsExcluded(product, f)
+    naive = (time.time() - start) / options.repeat
+
+    start = time.time()
+    buildbotcustom.misc._product_matchers.clear()
+    isImportantForProduct(c, product, verbose=False)
+    cold = time.time() - start
+
+    start = time.time()
+    for i in range(options.repeat):
+        isImportantForProduct(c, product, verbose=False)
+    warm = (time.time() - start) / options.repeat
+
+    print "%i excluded files: naive %.4fs, compiled %.4fs, memoized %.4fs" % \
+        (len(files), naive, cold, warm)
+
+if __name__ == '__main__':
+    main()
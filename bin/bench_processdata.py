@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""%prog [options]
+
+Times BaseHgPoller.processData on a generated pushlog (500 pushes by
+default), adding the changes to a sqlite database the way the master does,
+with and without batching them into a single transaction.
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from buildbotcustom.changes import hgpoller
+
+
+def makePushlog(pushes, changesets=3, files=10):
+    """Returns a json-pushes response with the given number of pushes, each
+    with changesets changesets touching files files, some shared"""
+    data = {}
+    for i in range(1, pushes + 1):
+        data[str(i)] = {
+            'date': 1300000000 + i,
+            'user': 'user%i@example.com' % i,
+            'changesets': [{
+                'node': '%040x' % (i * changesets + j),
+                'files': ['dir%i/file%i' % (j, k) for k in range(files)] +
+                ['shared/file%i' % k for k in range(files)],
+                'tags': [],
+                'author': 'Author <author@example.com>',
+                'branch': 'default',
+                'desc': 'Bug %i - change %i. r=someone\n\n%s' %
+                (i, j, 'More details. ' * 20),
+            } for j in range(changesets)],
+        }
+    return json.dumps(data)
+
+
+class ChangeCache(dict):
+    def add(self, number, change):
+        self[number] = change
+
+
+class SqliteDB(object):
+    """Just enough of buildbot 0.8.2's DBConnector for addChanges, storing
+    changes in a sqlite file like a small master would"""
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript("""
+            CREATE TABLE changes (changeid INTEGER PRIMARY KEY, author TEXT,
+                comments TEXT, branch TEXT, revision TEXT, revlink TEXT,
+                when_timestamp INTEGER);
+            CREATE TABLE change_files (changeid INTEGER, filename TEXT);
+            CREATE TABLE change_properties (changeid INTEGER,
+                property_name TEXT, property_value TEXT);
+        """)
+        self._change_cache = ChangeCache()
+
+    def runInteractionNow(self, fn, *args):
+        t = self.conn.cursor()
+        try:
+            result = fn(t, *args)
+        except:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        return result
+
+    def _txn_addChangeToDatabase(self, t, change):
+        t.execute("INSERT INTO changes (author, comments, branch, revision,"
+                  " revlink, when_timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                  (change.who, change.comments, change.branch,
+                   change.revision, change.revlink, change.when))
+        change.number = t.lastrowid
+        t.executemany("INSERT INTO change_files VALUES (?, ?)",
+                      [(change.number, f) for f in change.files])
+        t.executemany("INSERT INTO change_properties VALUES (?, ?, ?)",
+                      [(change.number, k, json.dumps(v)) for k, v, s in
+                       change.properties.asList()])
+
+    def addChangeToDatabase(self, change):
+        self.runInteractionNow(self._txn_addChangeToDatabase, change)
+        self.notify("add-change", change.number)
+        self._change_cache.add(change.number, change)
+
+    def notify(self, category, *args):
+        pass
+
+
+class Master(object):
+    def __init__(self, db):
+        self.db = db
+        self.status = self
+
+    def changeAdded(self, change):
+        pass
+
+    def addChange(self, change):
+        self.db.addChangeToDatabase(change)
+        self.changeAdded(change)
+
+
+class ChangeManager(object):
+    def __init__(self, master):
+        self.parent = master
+
+    def addChange(self, change):
+        self.parent.addChange(change)
+
+
+def run(data, batch, tmpdir):
+    db = SqliteDB(os.path.join(tmpdir, 'state-%s.sqlite' % time.time()))
+    poller = hgpoller.BaseHgPoller('http://hg.example.com', 'bench',
+                                   maxChanges=None)
+    poller.verbose = False
+    poller.batchChanges = batch
+    # Parse in this thread; there's no reactor running
+    poller.threadedParseSize = len(data)
+    poller.lastChangeset = 'x' * 40
+    poller.parent = ChangeManager(Master(db))
+    start = time.time()
+    poller.processData(data)
+    elapsed = time.time() - start
+    count = db.conn.execute("SELECT COUNT(*) FROM changes").fetchone()[0]
+    db.conn.close()
+    return elapsed, count
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(__doc__)
+    parser.set_defaults(pushes=500, repeat=5)
+    parser.add_option("-p", "--pushes", dest="pushes", type="int",
+                      help="number of pushes in the pushlog")
+    parser.add_option("-n", "--repeat", dest="repeat", type="int",
+                      help="run each variant this many times")
+    options, args = parser.parse_args()
+
+    data = makePushlog(options.pushes)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for batch in (False, True):
+            times = []
+            for i in range(options.repeat):
+                elapsed, count = run(data, batch, tmpdir)
+                times.append(elapsed)
+            print "%s: %i changes, best %.3fs of %s" % (
+                batch and "batched" or "one at a time", count, min(times),
+                ", ".join("%.3fs" % t for t in times))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""%prog [options]
+
+Reports how many try messages per second the try parser gets through for a
+generated try config (3000 builders by default), and how its time grows
+with the size of some awkward messages.
+"""
+import random
+import time
+
+from buildbotcustom.try_parser import TryParser, CompiledTryParser, \
+    processMessage
+from buildbotcustom.test.test_try_parser_perf import makeTryConfig, \
+    makeMessage, SCALING_CASES
+
+
+def bestTime(fn, *args):
+    '''Returns the shortest of three runs of fn(*args), in seconds'''
+    times = []
+    for i in range(3):
+        start = time.time()
+        fn(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def messagesPerSecond(parse, messages):
+    start = time.time()
+    for message in messages:
+        try:
+            parse(message)
+        except ValueError:
+            pass
+    return len(messages) / max(time.time() - start, 1e-6)
+
+
+def scaling(parse, makeMessage, n, factor):
+    '''Returns how many times longer parsing a message factor times the size
+    takes'''
+    small = bestTime(parse, makeMessage(n))
+    large = bestTime(parse, makeMessage(n * factor))
+    return large / max(small, 1e-4)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(__doc__)
+    parser.set_defaults(builders=3000, messages=2000, size=4000, factor=8)
+    parser.add_option("-b", "--builders", dest="builders", type="int",
+                      help="number of builders in the try config")
+    parser.add_option("-m", "--messages", dest="messages", type="int",
+                      help="number of messages to parse")
+    parser.add_option("-s", "--size", dest="size", type="int",
+                      help="size of the smaller message in scaling tests")
+    parser.add_option("-f", "--factor", dest="factor", type="int",
+                      help="how many times bigger the larger message is")
+    options, args = parser.parse_args()
+
+    builderNames, prettyNames, unittestSuites, talosSuites = \
+        makeTryConfig(options.builders)
+    rnd = random.Random(1)
+    messages = [makeMessage(rnd, prettyNames, unittestSuites, talosSuites)
+                for i in range(options.messages)]
+    print "%i builders, %i platforms, %i unittest suites" % (
+        len(builderNames), len(prettyNames), len(unittestSuites))
+
+    start = time.time()
+    compiled = CompiledTryParser(builderNames, prettyNames, None,
+                                 unittestSuites, talosSuites)
+    print "CompiledTryParser: made in %.3fs" % (time.time() - start)
+    print "CompiledTryParser: %.1f messages/second" % messagesPerSecond(
+        compiled.parse, messages)
+    print "CompiledTryParser, seen before: %.1f messages/second" % \
+        messagesPerSecond(compiled.parse, messages)
+
+    def tryParser(message):
+        return TryParser(message, builderNames, prettyNames, None,
+                         unittestSuites, talosSuites)
+    print "TryParser: %.1f messages/second" % messagesPerSecond(
+        tryParser, messages[:max(1, options.messages // 20)])
+
+    def parse(message):
+        compiled.results.clear()
+        return compiled.parse(message)
+    print
+    print "Time taken for %i times the size (~%i would be linear):" % (
+        options.factor, options.factor)
+    for name, makeBigMessage in sorted(SCALING_CASES.items()):
+        print "  %-22s processMessage %6.1f, parse %6.1f" % (
+            name, scaling(processMessage, makeBigMessage, options.size,
+                          options.factor),
+            scaling(parse, makeBigMessage, options.size, options.factor))
+
+if __name__ == '__main__':
+    main()
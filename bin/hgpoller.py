@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import os
+import sys
 import urlparse
 import urllib
 import time
@@ -63,6 +65,22 @@ def validating_https_open(url, ca_certs, username=None, password=None):
     return url_opener.open(req)
 
 
+def pushesToChanges(pushes):
+    """Returns a dict for each changeset in pushes, oldest first"""
+    changes = []
+    for push in pushes:
+        for c in push['changesets']:
+            changes.append({
+                'changeset': c['node'],
+                'author': c['author'],
+                'comments': c['desc'],
+                'files': c['files'],
+                'branch': c['branch'],
+                'updated': push['date'],
+            })
+    return changes
+
+
 def getChanges(base_url, last_changeset=None, tips_only=False, ca_certs=None,
                username=None, password=None):
     bits = urlparse.urlparse(base_url)
@@ -84,7 +102,7 @@ def getChanges(base_url, last_changeset=None, tips_only=False, ca_certs=None,
         handle = urllib2.urlopen(url)
 
     data = handle.read()
-    return _parse_changes(data)
+    return pushesToChanges(_parse_changes(data))
 
 
 def sendchange(master, branch, change):
@@ -105,19 +123,86 @@ def sendchange(master, branch, change):
     subprocess.check_call(cmd)
 
 
-def processBranch(branch, state, config):
-    log.debug("Processing %s", branch)
-    master = config.get('main', 'master')
-    if branch not in state:
-        state[branch] = {'last_run': 0, 'last_changeset': None}
-    branch_state = state[branch]
-    interval = config.getint(branch, 'interval')
-    if time.time() < (branch_state['last_run'] + interval):
-        log.debug("Skipping %s, too soon since last run", branch)
-        return
-
-    branch_state['last_run'] = time.time()
-
+class PBSender(object):
+    """Sends changes to the master's PBChangeSource, like buildbot
+    sendchange does, but over a single connection for all of them"""
+    def __init__(self, master, user='change', passwd='changepw'):
+        host, port = master.split(':')
+        self.host = host
+        self.port = int(port)
+        self.user = user
+        self.passwd = passwd
+        self.remote = None
+        self.waiting = []
+
+    def getRemote(self):
+        from twisted.internet import defer, reactor
+        from twisted.spread import pb
+        from twisted.cred import credentials
+
+        if self.remote is not None:
+            return defer.succeed(self.remote)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        if len(self.waiting) == 1:
+            log.debug("Connecting to %s:%i", self.host, self.port)
+            factory = pb.PBClientFactory()
+            reactor.connectTCP(self.host, self.port, factory)
+            login = factory.login(
+                credentials.UsernamePassword(self.user, self.passwd))
+            login.addCallbacks(self._connected, self._failed)
+        return d
+
+    def _connected(self, remote):
+        self.remote = remote
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(remote)
+
+    def _failed(self, f):
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.errback(f)
+
+    def send(self, branch, changes):
+        """Sends changes, in order. Returns a Deferred that fires once the
+        master has all of them."""
+        from twisted.internet import defer
+
+        def sendAll(remote):
+            ds = []
+            for c in changes:
+                log.info("Sending %s to %s:%i on branch %s", c['changeset'],
+                         self.host, self.port, branch)
+                ds.append(remote.callRemote('addChange', {
+                    'who': c['author'],
+                    'files': c['files'],
+                    'comments': c['comments'],
+                    'branch': branch,
+                    'revision': c['changeset'],
+                    'when': c['updated'],
+                    'category': None,
+                    'revlink': '',
+                    'properties': {},
+                    'repository': '',
+                    'project': '',
+                }))
+            return defer.DeferredList(ds, fireOnOneErrback=True,
+                                      consumeErrors=True)
+        d = self.getRemote()
+        d.addCallback(sendAll)
+        return d
+
+    def close(self):
+        if self.remote is not None:
+            self.remote.broker.transport.loseConnection()
+            self.remote = None
+
+
+def pollBranch(branch, branch_state, config):
+    """Returns (changes, last_changeset) for branch: the changes to send to
+    the master, and what branch_state['last_changeset'] should be once
+    they've been sent"""
     url = config.get(branch, 'url')
     ca_certs = config.get(branch, 'ca_certs')
     tips_only = config.getboolean(branch, 'tips_only')
@@ -129,32 +214,119 @@ def processBranch(branch, state, config):
         changes = getChanges(url, tips_only=tips_only,
                              last_changeset=last_changeset, ca_certs=ca_certs,
                              username=username, password=password)
-        # Do sendchanges!
-        for c in changes:
-            # Ignore off-default branches
-            if c['branch'] != 'default' and config.getboolean(branch, 'default_branch_only'):
-                log.info(
-                    "Skipping %s on branch %s", c['changeset'], c['branch'])
-                continue
-            # Change the comments to include the url to the revision
-            c['comments'] += ' %s/rev/%s' % (url, c['changeset'])
-            sendchange(master, branch, c)
-
     except urllib2.HTTPError, e:
         msg = e.fp.read()
         if e.code == 500 and 'unknown revision' in msg:
             log.info("%s Repo was reset, resetting last_changeset", branch)
-            branch_state['last_changeset'] = None
-            return
+            return [], None
         else:
             raise
 
     if not changes:
         # Empty repo, or no new changes; nothing to do
+        return [], last_changeset
+
+    to_send = []
+    for c in changes:
+        # Ignore off-default branches
+        if c['branch'] != 'default' and config.getboolean(branch, 'default_branch_only'):
+            log.info(
+                "Skipping %s on branch %s", c['changeset'], c['branch'])
+            continue
+        # Change the comments to include the url to the revision
+        c['comments'] += ' %s/rev/%s' % (url, c['changeset'])
+        to_send.append(c)
+    return to_send, changes[-1]['changeset']
+
+
+def getBranchState(branch, state, config):
+    """Returns the state for branch if it's due to be polled, or None"""
+    if branch not in state:
+        state[branch] = {'last_run': 0, 'last_changeset': None}
+    branch_state = state[branch]
+    interval = config.getint(branch, 'interval')
+    if time.time() < (branch_state['last_run'] + interval):
+        log.debug("Skipping %s, too soon since last run", branch)
+        return None
+    branch_state['last_run'] = time.time()
+    return branch_state
+
+
+def processBranch(branch, state, config):
+    log.debug("Processing %s", branch)
+    master = config.get('main', 'master')
+    branch_state = getBranchState(branch, state, config)
+    if branch_state is None:
         return
 
-    last_change = changes[-1]
-    branch_state['last_changeset'] = last_change['changeset']
+    changes, last_changeset = pollBranch(branch, branch_state, config)
+    # Do sendchanges!
+    for c in changes:
+        sendchange(master, branch, c)
+    branch_state['last_changeset'] = last_changeset
+
+
+def processBranchesConcurrently(branches, state, config, jobs, save):
+    """Polls branches in a pool of jobs threads, and sends their changes to
+    the master over one PB connection. Each branch's state is only updated,
+    and saved, once all of its changes have been sent."""
+    from twisted.internet import defer, reactor, threads
+
+    reactor.suggestThreadPoolSize(jobs)
+    sender = PBSender(config.get('main', 'master'),
+                      config.get('main', 'pb_user'),
+                      config.get('main', 'pb_passwd'))
+    failed = []
+
+    def doBranch(branch):
+        log.debug("Processing %s", branch)
+        branch_state = getBranchState(branch, state, config)
+        if branch_state is None:
+            return
+
+        def send(result):
+            changes, last_changeset = result
+            d = sender.send(branch, changes)
+            d.addCallback(lambda _: last_changeset)
+            return d
+
+        def sent(last_changeset):
+            branch_state['last_changeset'] = last_changeset
+            save()
+
+        def error(f):
+            log.error("%s failed: %s", branch, f.getTraceback())
+            failed.append(branch)
+
+        d = threads.deferToThread(pollBranch, branch, dict(branch_state),
+                                  config)
+        d.addCallback(send)
+        d.addCallbacks(sent, error)
+        return d
+
+    def done(_):
+        sender.close()
+        reactor.stop()
+
+    def start():
+        ds = [doBranch(b) for b in branches]
+        d = defer.DeferredList([d for d in ds if d is not None])
+        d.addBoth(done)
+    reactor.callWhenRunning(start)
+    reactor.run()
+    return failed
+
+
+def saveState(state, filename):
+    """Writes state to filename, replacing it in one step so that an
+    interrupted write doesn't lose what was there"""
+    tmp = filename + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        json.dump(state, f)
+    finally:
+        f.close()
+    os.rename(tmp, filename)
 
 if __name__ == '__main__':
     from ConfigParser import RawConfigParser
@@ -164,10 +336,18 @@ if __name__ == '__main__':
     parser.set_defaults(
         config_file="hgpoller.ini",
         verbosity=log.INFO,
+        pb=False,
+        jobs=4,
     )
     parser.add_option("-f", "--config-file", dest="config_file")
     parser.add_option("-v", "--verbose", dest="verbosity",
                       action="store_const", const=log.DEBUG)
+    parser.add_option("--pb", dest="pb", action="store_true",
+                      help="poll branches concurrently, and send changes "
+                      "over one PB connection rather than running buildbot "
+                      "sendchange for each one")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="with --pb, poll this many branches at once")
 
     options, args = parser.parse_args()
 
@@ -181,17 +361,27 @@ if __name__ == '__main__':
         'interval': 300,
         'state_file': 'state.json',
         'default_branch_only': "yes",
+        'pb_user': 'change',
+        'pb_passwd': 'changepw',
     })
     config.read(options.config_file)
 
+    state_file = config.get('main', 'state_file')
     try:
-        state = json.load(open(config.get('main', 'state_file')))
+        state = json.load(open(state_file))
     except (IOError, ValueError):
         state = {}
 
     branches = [s for s in config.sections() if s != 'main']
-    for branch in branches:
-        processBranch(branch, state, config)
-
-    # Save state
-    json.dump(state, open(config.get('main', 'state_file'), 'w'))
+    if options.pb:
+        failed = processBranchesConcurrently(
+            branches, state, config, options.jobs,
+            lambda: saveState(state, state_file))
+        saveState(state, state_file)
+        if failed:
+            sys.exit(1)
+    else:
+        for branch in branches:
+            processBranch(branch, state, config)
+            # Save state
+            saveState(state, state_file)
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""%prog [options] [fixture.json ...]
+
+Runs the master.cfg object generators (generateBranchObjects and friends)
+against sample configs, and reports how long each one takes, how much memory
+the process peaked at, which kinds of objects were created, and where the
+time went.
+
+Each fixture is a JSON file with these keys:
+    generator:   dotted name of the function to call, e.g.
+                 buildbotcustom.misc.generateBranchObjects
+    args:        list of positional arguments
+    kwargs:      dict of keyword arguments (optional)
+    description: what the fixture is exercising (optional)
+
+With no fixtures given, everything in test/fixtures/reconfig is run.
+
+buildbot is replaced with stub modules by default, so this runs without a
+master or a buildbot checkout. Other packages that aren't importable (e.g.
+the build/tools libraries, or Twisted and zope.interface outside the tox
+environment) are stubbed as well, and --stub stubs a package even if it is
+importable.
+"""
+import cProfile
+import gc
+import imp
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+import types
+from StringIO import StringIO
+
+import logging as log
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'test', 'fixtures', 'reconfig')
+
+# Packages we'll stub out if they can't be imported. buildbot is always
+# stubbed unless --real-buildbot is given. BuildSlaves holds a master's
+# passwords, so it's never importable from a checkout.
+STUBBED_PACKAGES = ['buildbot', 'twisted', 'zope', 'sqlalchemy', 'jinja2',
+                    'build', 'release', 'mozilla_buildtools', 'util',
+                    'OpenSSL', 'BuildSlaves']
+
+# Class attributes that subclasses build on, so they need real values
+STUB_CLASS_ATTRIBUTES = {
+    'compare_attrs': (),
+}
+
+
+class StubType(type):
+    def __getattr__(cls, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name in STUB_CLASS_ATTRIBUTES:
+            return STUB_CLASS_ATTRIBUTES[name]
+        return StubObject()
+
+    def __iter__(cls):
+        # zope.interface's implements() iterates over the interfaces it's
+        # given, which come from stubbed modules
+        return iter(())
+
+
+class StubObject(object):
+    """Stands in for anything defined in a stubbed module. Records how it was
+    constructed, and returns more stubs for anything else asked of it."""
+    __metaclass__ = StubType
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return StubObject()
+
+    def __call__(self, *args, **kwargs):
+        return StubObject(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(())
+
+
+class StubBuildFactory(StubObject):
+    """Keeps hold of its steps like buildbot's BuildFactory does, so they're
+    counted"""
+    def __init__(self, steps=None):
+        StubObject.__init__(self)
+        self.steps = []
+        for s in steps or []:
+            self.addStep(s)
+
+    def addStep(self, step_or_factory, **kwargs):
+        self.steps.append((step_or_factory, kwargs))
+
+    def addSteps(self, steps):
+        for s in steps:
+            self.addStep(s)
+
+
+class StubWithProperties(StubObject):
+    """Keeps its format string, which factories read back"""
+    def __init__(self, fmtstring, *args, **kwargs):
+        StubObject.__init__(self, fmtstring, *args, **kwargs)
+        self.fmtstring = fmtstring
+
+
+def _now():
+    return time.time()
+
+# Things that need to behave like the real thing
+STUB_OVERRIDES = {
+    'buildbot.util': {'json': json, 'now': _now},
+    'buildbot.process.factory': {'BuildFactory': StubBuildFactory},
+    'buildbot.process.properties': {'WithProperties': StubWithProperties},
+    'buildbot.steps.shell': {'WithProperties': StubWithProperties},
+}
+
+
+class StubModule(types.ModuleType):
+    """A module where every name exists. Names that look like classes or
+    constants are StubObject subclasses; lowercase names are submodules,
+    which can also be called like functions."""
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name[0].islower():
+            fullname = '%s.%s' % (self.__name__, name)
+            __import__(fullname)
+            value = sys.modules[fullname]
+        else:
+            value = StubType(name, (StubObject,), {'__module__': self.__name__})
+        setattr(self, name, value)
+        return value
+
+    def __call__(self, *args, **kwargs):
+        return StubObject(*args, **kwargs)
+
+
+class StubImporter(object):
+    """sys.meta_path hook that creates a StubModule for anything in one of
+    packages"""
+    def __init__(self, packages):
+        self.packages = set(packages)
+
+    def find_module(self, fullname, path=None):
+        if fullname.split('.')[0] in self.packages:
+            return self
+        return None
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        module = StubModule(fullname)
+        module.__file__ = '<stub>'
+        module.__path__ = []
+        module.__loader__ = self
+        sys.modules[fullname] = module
+        for name, value in STUB_OVERRIDES.get(fullname, {}).items():
+            setattr(module, name, value)
+        return module
+
+
+def installStubs(real_buildbot=False, stub=()):
+    """Stubs out buildbot, the packages in stub, and any other packages in
+    STUBBED_PACKAGES that can't be found. Returns the list of stubbed
+    packages."""
+    packages = list(stub)
+    for package in STUBBED_PACKAGES:
+        if package in packages:
+            continue
+        if package == 'buildbot' and not real_buildbot:
+            packages.append(package)
+            continue
+        try:
+            imp.find_module(package)
+        except ImportError:
+            packages.append(package)
+    sys.meta_path.insert(0, StubImporter(packages))
+    return packages
+
+
+def loadFixture(filename):
+    fixture = json.load(open(filename))
+    fixture.setdefault('kwargs', {})
+    fixture.setdefault('description', '')
+    fixture['name'] = os.path.splitext(os.path.basename(filename))[0]
+    return fixture
+
+
+def copyConfig(obj):
+    """Returns a copy of obj, a fixture's JSON args, with str in place of
+    unicode, as if it had come from a python config file"""
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, dict):
+        return dict((copyConfig(k), copyConfig(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [copyConfig(v) for v in obj]
+    return obj
+
+
+def getGenerator(dotted_name):
+    module_name, func_name = dotted_name.rsplit('.', 1)
+    __import__(module_name)
+    return getattr(sys.modules[module_name], func_name)
+
+
+def peakRSS():
+    """Returns the process's peak resident set size in MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes, not kilobytes
+        rss /= 1024
+    return rss / 1024.0
+
+
+def countObjects():
+    """Returns a dict of type name -> number of gc-tracked objects"""
+    counts = {}
+    for o in gc.get_objects():
+        name = type(o).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def profileFixture(fixture, repeat=1, top=20):
+    """Runs fixture's generator repeat times, and returns a dict of
+    results"""
+    generator = getGenerator(fixture['generator'])
+
+    gc.collect()
+    before = countObjects()
+    profiler = cProfile.Profile()
+    times = []
+    results = []
+    for i in range(repeat):
+        # Each run gets its own copy of the config, since generators are
+        # allowed to modify them
+        args = copyConfig(fixture['args'])
+        kwargs = copyConfig(fixture['kwargs'])
+        start = time.time()
+        results.append(profiler.runcall(generator, *args, **kwargs))
+        times.append(time.time() - start)
+    gc.collect()
+    after = countObjects()
+
+    created = {}
+    for name, count in after.items():
+        delta = count - before.get(name, 0)
+        if delta > 0:
+            created[name] = delta
+
+    stats_output = StringIO()
+    stats = pstats.Stats(profiler, stream=stats_output)
+    stats.sort_stats('cumulative').print_stats(top)
+
+    objects = results[-1]
+    return {
+        'name': fixture['name'],
+        'generator': fixture['generator'],
+        'times': times,
+        'best': min(times),
+        'peak_rss': peakRSS(),
+        'builders': len(objects.get('builders', [])),
+        'schedulers': len(objects.get('schedulers', [])),
+        'objects': created,
+        'profile': stats_output.getvalue(),
+    }
+
+
+def report(result, top=20):
+    print "%(name)s (%(generator)s)" % result
+    print "  %(builders)i builders, %(schedulers)i schedulers" % result
+    print "  wall time: best %.3fs of %s" % (
+        result['best'], ", ".join("%.3fs" % t for t in result['times']))
+    print "  peak RSS: %.1fMB" % result['peak_rss']
+    print "  gc-tracked objects created: %i" % sum(result['objects'].values())
+    created = sorted(result['objects'].items(), key=lambda x: -x[1])
+    for name, count in created[:top]:
+        print "    %8i %s" % (count, name)
+    print
+    print result['profile']
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(__doc__)
+    parser.set_defaults(
+        repeat=1,
+        top=20,
+        real_buildbot=False,
+        use_cache=False,
+        output=None,
+        loglevel=log.WARNING,
+    )
+    parser.add_option("-n", "--repeat", dest="repeat", type="int",
+                      help="run each generator this many times")
+    parser.add_option("-t", "--top", dest="top", type="int",
+                      help="show this many object types and profile entries")
+    parser.add_option("--real-buildbot", dest="real_buildbot",
+                      action="store_true",
+                      help="use the installed buildbot instead of stubs")
+    parser.add_option("-s", "--stub", dest="stub", action="append",
+                      default=[],
+                      help="stub this package even if it can be imported; "
+                      "may be given more than once")
+    parser.add_option("--use-cache", dest="use_cache", action="store_true",
+                      help="leave misc.cachedBuildObjects enabled, to "
+                      "measure repeated runs with unchanged configs")
+    parser.add_option("-o", "--output", dest="output",
+                      help="also write results as JSON to this file, for "
+                      "comparing between revisions")
+    parser.add_option("-v", "--verbose", dest="loglevel",
+                      action="store_const", const=log.DEBUG)
+
+    options, args = parser.parse_args()
+
+    log.basicConfig(format="%(message)s", level=options.loglevel)
+
+    if not args:
+        args = sorted(os.path.join(FIXTURE_DIR, f)
+                      for f in os.listdir(FIXTURE_DIR) if f.endswith('.json'))
+
+    stubbed = installStubs(options.real_buildbot, options.stub)
+    log.info("Stubbed packages: %s", ", ".join(stubbed))
+
+    start = time.time()
+    import buildbotcustom.misc
+    log.info("Imported buildbotcustom.misc in %.3fs", time.time() - start)
+    buildbotcustom.misc.cacheBuildObjects = options.use_cache
+
+    results = []
+    failed = False
+    for filename in args:
+        fixture = loadFixture(filename)
+        log.debug("Running %s: %s", fixture['name'], fixture['description'])
+        try:
+            result = profileFixture(fixture, options.repeat, options.top)
+        except Exception:
+            log.exception("%s failed", fixture['name'])
+            failed = True
+            continue
+        report(result, options.top)
+        results.append(result)
+
+    if options.output:
+        for r in results:
+            del r['profile']
+        json.dump(results, open(options.output, 'w'), indent=2)
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
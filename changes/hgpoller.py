@@ -85,22 +85,171 @@ which of the form
 }
 """
 
+import heapq
+import os
+import re
 import time
+import urlparse
+from collections import deque
 
-from twisted.python import log
-from twisted.internet import defer, reactor
-from twisted.internet.task import LoopingCall
-from twisted.web.client import getPage
+from twisted.python import failure, log
+from twisted.internet import defer, reactor, threads
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.web.error import Error as WebError
 
 from buildbot.changes import base, changes
 from buildbot.util import json
 
+from buildbotcustom import httpclient
 
-def _parse_changes(data):
-    pushes = json.loads(data).values()
-    # Sort by push date
-    pushes.sort(key=lambda p: p['date'])
-    return pushes
+
+# Returned by BaseHgPoller.getData when the pushlog hasn't changed since the
+# last request
+NOT_MODIFIED = object()
+
+# Totals across all pollers; see BaseHgPoller.countRequest
+requestStats = {
+    'requests': 0,
+    'not_modified': 0,
+    'bytes_received': 0,
+    'bytes_saved': 0,
+}
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+
+def _json_error(msg, data, pos):
+    if hasattr(json, 'JSONDecodeError'):
+        return json.JSONDecodeError(msg, data, pos)
+    return ValueError("%s: char %i" % (msg, pos))
+
+
+def _iter_pushes(data):
+    """Yields (push id, push) for each push in a json-pushes response, one at
+    a time, instead of decoding the whole response at once"""
+    skip = _WHITESPACE.match
+    pos = skip(data, 0).end()
+    if data[pos:pos + 1] != '{':
+        raise _json_error("Expecting object", data, pos)
+    pos = skip(data, pos + 1).end()
+    if data[pos:pos + 1] == '}':
+        return
+    while True:
+        pushid, pos = _decoder.raw_decode(data, pos)
+        pos = skip(data, pos).end()
+        if data[pos:pos + 1] != ':':
+            raise _json_error("Expecting : delimiter", data, pos)
+        pos = skip(data, pos + 1).end()
+        push, pos = _decoder.raw_decode(data, pos)
+        yield pushid, push
+        pos = skip(data, pos).end()
+        c = data[pos:pos + 1]
+        if c == '}':
+            return
+        if c != ',':
+            raise _json_error("Expecting , delimiter", data, pos)
+        pos = skip(data, pos + 1).end()
+
+
+def _push_weight(push, maxChanges, repo_branch, mergePushChanges):
+    """Returns how much push counts towards maxChanges in processData"""
+    changesets = push['changesets']
+    if repo_branch is not None:
+        changesets = [c for c in changesets if c['branch'] == repo_branch]
+    if mergePushChanges:
+        return min(len(changesets), 1)
+    return min(len(changesets), maxChanges)
+
+
+def _parse_changes(data, maxChanges=None, repo_branch=None,
+                   mergePushChanges=True):
+    """Returns the pushes in a json-pushes response, oldest first.
+
+    If maxChanges is set, older pushes that BaseHgPoller.processData would
+    ignore anyway, because newer ones already give it more than maxChanges
+    changes, are dropped as soon as that's clear, so the parsed pushes don't
+    all have to be held in memory."""
+    # (date, push id, weight, push) for the pushes we're keeping, oldest
+    # first
+    heap = []
+    total = 0
+    for pushid, push in _iter_pushes(data):
+        try:
+            order = int(pushid)
+        except ValueError:
+            order = pushid
+        if maxChanges is None:
+            heap.append((push['date'], order, 0, push))
+            continue
+
+        weight = _push_weight(push, maxChanges, repo_branch,
+                              mergePushChanges)
+        heapq.heappush(heap, (push['date'], order, weight, push))
+        total += weight
+        # The oldest push can go if the newer ones, apart from the second
+        # oldest, reach maxChanges; the second oldest will then be the one
+        # that makes processData notice there are too many changes.
+        while len(heap) > 2:
+            oldest = heap[0]
+            second = min(heap[1:3])
+            if total - oldest[2] - second[2] < maxChanges or \
+                    not second[3]['changesets']:
+                break
+            heapq.heappop(heap)
+            total -= oldest[2]
+    heap.sort()
+    return [push for date, order, weight, push in heap]
+
+
+def _commit_title(desc):
+    """Returns the first line of desc, trimmed to a word boundary if it's
+    longer than 100 characters"""
+    end = desc.find('\n')
+    if end != -1:
+        desc = desc[:end]
+    if len(desc) > 100:
+        trim_pos = desc.rfind(' ', 0, 100)
+        if trim_pos == -1:
+            trim_pos = 100
+        desc = desc[:trim_pos]
+    return desc
+
+
+def addChanges(changemaster, changelist):
+    """Adds changelist to the master. Where the master's database allows it
+    (buildbot 0.8.2's does), they're inserted in a single transaction,
+    rather than one transaction each as ChangeManager.addChange does.
+    Otherwise this does what ChangeManager.addChange does: each change is
+    logged, schedulers are notified of it, and old changes are pruned."""
+    master = getattr(changemaster, 'parent', None)
+    db = getattr(master, 'db', None)
+    if len(changelist) < 2 or \
+            not hasattr(db, '_txn_addChangeToDatabase') or \
+            not hasattr(db, 'runInteractionNow'):
+        for c in changelist:
+            changemaster.addChange(c)
+        return
+
+    def txn(t):
+        # _txn_addChangeToDatabase notifies the schedulers of each change
+        for c in changelist:
+            db._txn_addChangeToDatabase(t, c)
+    log.msg("adding %i changes in one transaction" % len(changelist))
+    for c in changelist:
+        msg = ("adding change, who %s, %d files, rev=%s, branch=%s, "
+               "repository=%s, comments %s, category %s, project %s" %
+               (c.who, len(c.files), c.revision, c.branch, c.repository,
+                c.comments, c.category, c.project))
+        log.msg(msg.encode('utf-8', 'replace'))
+    db.runInteractionNow(txn)
+    # What DBConnector.addChangeToDatabase and BuildMaster.addChange do
+    # after the insert
+    for c in changelist:
+        db._change_cache.add(c.number, c)
+        master.status.changeAdded(c)
+    changemaster.pruneChanges(changelist[-1].number)
 
 
 class Pluggable(object):
@@ -179,12 +328,79 @@ class BasePoller(object):
         pass
 
 
+class ChangesetStore(object):
+    """Remembers the last changeset each poller has seen in a JSON file, so
+    that after a restart they can ask the pushlog for just the pushes since
+    then, rather than starting from scratch and missing anything pushed
+    while the master was down."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.changesets = None
+
+    def load(self):
+        self.changesets = {}
+        if not os.path.exists(self.filename):
+            return
+        try:
+            self.changesets = json.load(open(self.filename))
+        except (IOError, ValueError):
+            log.msg("Couldn't load changesets from %s; starting afresh" %
+                    self.filename)
+            log.err()
+
+    def get(self, key):
+        if self.changesets is None:
+            self.load()
+        return self.changesets.get(key)
+
+    def set(self, key, changeset):
+        if self.get(key) == changeset:
+            return
+        if changeset is None:
+            del self.changesets[key]
+        else:
+            self.changesets[key] = changeset
+        # Write the new state alongside the old, and then move it into place,
+        # so the file is never left half written
+        tmp = self.filename + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(self.changesets, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
+
+
+# filename -> ChangesetStore
+try:
+    _changesetStores
+except NameError:
+    _changesetStores = {}
+
+
+def getChangesetStore(filename):
+    filename = os.path.abspath(filename)
+    if filename not in _changesetStores:
+        _changesetStores[filename] = ChangesetStore(filename)
+    return _changesetStores[filename]
+
+
 class BaseHgPoller(BasePoller):
     """Common base of HgPoller, HgLocalePoller, and HgAllLocalesPoller.
 
     Subclasses should implement getData, processData, and __str__"""
     verbose = True
     timeout = 30
+    # Responses larger than this are parsed in a thread, so they don't block
+    # the reactor
+    threadedParseSize = 512 * 1024
+    # The HgPollerHub our requests go through, if any
+    hub = None
+    # The ChangesetStore that lastChangeset is saved in, if any
+    changesetStore = None
+    # Add all the changes from a poll to the database in one transaction,
+    # where the master supports it
+    batchChanges = True
 
     def __init__(self, hgURL, branch, pushlogUrlOverride=None,
                  tipsOnly=False, tree=None, repo_branch=None, maxChanges=100,
@@ -203,6 +419,9 @@ class BaseHgPoller(BasePoller):
         self.pushlogUrlOverride = pushlogUrlOverride
         self.tipsOnly = tipsOnly
         self.lastChangeset = None
+        # The lastChangeset we got from changesetStore, until we know it's
+        # still in the repository
+        self.restoredChangeset = None
         self.startLoad = 0
         self.loadTime = None
         self.repo_branch = repo_branch
@@ -214,11 +433,57 @@ class BaseHgPoller(BasePoller):
 
         self.emptyRepo = False
 
+        # url -> (ETag, Last-Modified, length of the response) for the last
+        # response we got
+        self.validators = {}
+        self.requestStats = dict((k, 0) for k in requestStats)
+
     def getData(self):
         url = self._make_url()
         if self.verbose:
             log.msg("Polling Hg server at %s" % url)
-        return getPage(url, timeout=self.timeout)
+        headers = {}
+        etag, last_modified, length = self.validators.get(
+            url, (None, None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        if self.hub is not None:
+            d = self.hub.fetch(self, url, headers, self.timeout)
+        else:
+            d = httpclient.request(url, headers=headers, timeout=self.timeout)
+        d.addCallback(self._gotPage, url)
+        return d
+
+    def _gotPage(self, result, url):
+        status, headers, data = result
+        if status == '304':
+            return self._notModified(url)
+        etag = headers.get('etag', [None])[0]
+        last_modified = headers.get('last-modified', [None])[0]
+        # Only the current URL's validators are useful; fromchange changes
+        # whenever there are new pushes
+        self.validators.clear()
+        if etag or last_modified:
+            self.validators[url] = (etag, last_modified, len(data))
+        self.countRequest(bytes_received=len(data))
+        return data
+
+    def _notModified(self, url):
+        length = self.validators.get(url, (None, None, 0))[2]
+        self.countRequest(not_modified=1, bytes_saved=length)
+        if self.verbose:
+            log.msg("%s hasn't changed" % url)
+        return NOT_MODIFIED
+
+    def countRequest(self, **counts):
+        """Adds one request, and counts, to this poller's and the global
+        requestStats"""
+        counts['requests'] = 1
+        for stats in self.requestStats, requestStats:
+            for k, v in counts.items():
+                stats[k] += v
 
     def _make_url(self):
         url = None
@@ -252,10 +517,73 @@ class BaseHgPoller(BasePoller):
                 # log.msg("%s has been reset" % self.baseURL)
             # self.lastChangeset = None
             # self.emptyRepo = True
+        if self.restoredChangeset is not None and \
+                self.lastChangeset == self.restoredChangeset and \
+                res.check(WebError) and res.value.status in ('404', '500'):
+            # The changeset we saved before restarting has gone away, e.g.
+            # because the repository was reset while we were down.
+            log.msg("%s: saved changeset %s is unknown; starting afresh" %
+                    (self, self.lastChangeset))
+            self.restoredChangeset = None
+            self.setLastChangeset(None)
         return self.super_class.dataFailed(self, res)
 
+    def stateKey(self):
+        """Returns the key our lastChangeset is saved under in
+        changesetStore. Pollers watching different in-repo branches of one
+        repository each get their own."""
+        return "%s#%s" % (self.oldStateKey(), self.repo_branch or '*')
+
+    def oldStateKey(self):
+        """Returns the key lastChangeset used to be saved under, which didn't
+        include the in-repo branch"""
+        if self.pushlogUrlOverride:
+            return self.pushlogUrlOverride
+        return self.baseURL
+
+    def restoreLastChangeset(self):
+        """Picks up from the lastChangeset we saved before restarting"""
+        if self.changesetStore is None or self.lastChangeset is not None:
+            return
+        changeset = self.changesetStore.get(self.stateKey())
+        if changeset is None:
+            changeset = self.changesetStore.get(self.oldStateKey())
+            if changeset is not None:
+                self.saveLastChangeset(changeset)
+        if changeset is not None:
+            if self.verbose:
+                log.msg("%s: resuming from changeset %s" % (self, changeset))
+            self.lastChangeset = self.restoredChangeset = changeset
+
+    def saveLastChangeset(self, changeset):
+        try:
+            self.changesetStore.set(self.stateKey(), changeset)
+            if changeset is None:
+                # Don't fall back to it after the next restart
+                self.changesetStore.set(self.oldStateKey(), None)
+        except (IOError, OSError):
+            log.msg("%s: couldn't save last changeset" % self)
+            log.err()
+
+    def setLastChangeset(self, changeset):
+        self.lastChangeset = changeset
+        if self.changesetStore is not None:
+            self.saveLastChangeset(changeset)
+
     def processData(self, query):
-        pushes = _parse_changes(query)
+        # The server knew about our lastChangeset
+        self.restoredChangeset = None
+        if query is NOT_MODIFIED:
+            return
+        args = (query, self.maxChanges, self.repo_branch,
+                self.mergePushChanges)
+        if len(query) > self.threadedParseSize:
+            d = threads.deferToThread(_parse_changes, *args)
+            d.addCallback(self.processPushes)
+            return d
+        return self.processPushes(_parse_changes(*args))
+
+    def processPushes(self, pushes):
         if len(pushes) == 0:
             if self.lastChangeset is None:
                 # We don't have a lastChangeset, and there are no changes.  Assume
@@ -266,140 +594,284 @@ class BaseHgPoller(BasePoller):
             # Nothing else to do
             return
 
+        # If we have a lastChangeset we're comparing against, we've been
+        # running for a while and so any changes returned here are new.
+
+        # If the repository was previously empty (indicated by emptyRepo=True),
+        # we also want to pay attention to all these pushes.
+
+        # If we don't have a lastChangeset and the repository isn't empty, then
+        # don't trigger any new builds, and start monitoring for changes since
+        # the latest changeset in the repository
+        if self.lastChangeset is not None or self.emptyRepo:
+            self.submitChanges(self.makeChanges(pushes))
+
+        if self.hub is not None and self.lastChangeset is not None:
+            self.hub.recordPushes(self, pushes[-1]['date'])
+
+        # The repository isn't empty any more!
+        self.emptyRepo = False
+        # Use the last change found by the poller, regardless of if it's on our
+        # branch or not. This is so we don't have to constantly ignore it in
+        # future polls.
+        self.setLastChangeset(pushes[-1]["changesets"][-1]["node"])
+        if self.verbose:
+            log.msg("last changeset %s on %s" %
+                    (self.lastChangeset, self.baseURL))
+
+    def makeChanges(self, pushes):
+        """Returns a changes.Change for each of the changes in pushes we're
+        interested in, oldest first"""
+        maxChanges = self.maxChanges
+        repo_branch = self.repo_branch
+        mergePushChanges = self.mergePushChanges
         # We want to add at most self.maxChanges changes per push. If
         # mergePushChanges is True, then we'll get up to maxChanges pushes,
         # each with up to maxChanges changes.
         # Go through the list of pushes backwards, since we want to keep the
         # latest ones and possibly discard earlier ones.
+        # Each change is (user, date, files, desc, node, commit titles)
         change_list = []
         too_many = False
         for push in reversed(pushes):
             # Used for merging push changes
-            c = dict(
-                user=push['user'],
-                date=push['date'],
-                files=[],
-                desc="",
-                node=None,
-                commit_titles=[],
-                commit_titles_total_length=0,
-            )
+            files = []
+            seen = set()
+            desc = node = None
+            titles = []
+            titles_length = 0
 
             i = 0
             for change in reversed(push['changesets']):
-                if self.maxChanges is not None and (len(change_list) >= self.maxChanges or
-                                                    i >= self.maxChanges):
+                if maxChanges is not None and (len(change_list) >= maxChanges or
+                                               i >= maxChanges):
                     too_many = True
                     log.msg("%s: got too many changes" % self.baseURL)
                     break
 
                 # Ignore changes not on the specified in-repo branch.
-                if self.repo_branch is not None and self.repo_branch != change['branch']:
+                if repo_branch is not None and repo_branch != change['branch']:
                     continue
 
                 i += 1
 
-                if self.mergePushChanges:
-                    # Collect all the files for this push
-                    c['files'].extend(change['files'])
-                    # Keep the comments and revision of the last change of this push.
-                    # We're going through the changes in reverse order, so we
-                    # should use the comments and revision of the first change
-                    # in this loop
-                    if c['node'] is None:
-                        c['desc'] = change['desc']
-                        c['node'] = change['node']
-
-                    title = change['desc'].split('\n', 1)[0]
-                    if len(title) > 100:
-                        trim_pos = title.rfind(' ', 0, 100)
-                        if trim_pos == -1:
-                            trim_pos = 100
-                        title = title[:trim_pos]
-                    # The commit titles are stored in a Change property, which
-                    # are limited to 1024 chars in the database (see
-                    # change_properties in buildbot/db/scheme/tables.sql). In
-                    # order to avoid insert/update failures, we enforce a cap
-                    # on the total length with enough room for JSON overhead.
-                    if c['commit_titles_total_length'] + len(title) + 5 <= 800:
-                        c['commit_titles_total_length'] += len(title) + 5  # for json encoding like , " etc.
-                        c['commit_titles'].append(title)
-                else:
-                    c = dict(
-                        user=push['user'],
-                        date=push['date'],
-                        files=change['files'],
-                        desc=change['desc'],
-                        node=change['node'],
-                        branch=change['branch'],
-                    )
-                    change_list.append(c)
-
-            if too_many and self.mergePushChanges:
+                if not mergePushChanges:
+                    change_list.append((push['user'], push['date'],
+                                        change['files'], change['desc'],
+                                        change['node'], None))
+                    continue
+
+                # Collect all the files for this push
+                for f in change['files']:
+                    if f not in seen:
+                        seen.add(f)
+                        files.append(f)
+                # Keep the comments and revision of the last change of this push.
+                # We're going through the changes in reverse order, so we
+                # should use the comments and revision of the first change
+                # in this loop
+                if node is None:
+                    desc = change['desc']
+                    node = change['node']
+
+                # The commit titles are stored in a Change property, which
+                # are limited to 1024 chars in the database (see
+                # change_properties in buildbot/db/scheme/tables.sql). In
+                # order to avoid insert/update failures, we enforce a cap
+                # on the total length with enough room for JSON overhead.
+                if titles_length + 5 <= 800:
+                    title = _commit_title(change['desc'])
+                    if titles_length + len(title) + 5 <= 800:
+                        titles_length += len(title) + 5  # for json encoding like , " etc.
+                        titles.append(title)
+
+            if too_many and mergePushChanges:
                 # Add a dummy change to indicate we had too many changes
-                c['files'].extend(['overflow'])
+                files.append('overflow')
 
-            if self.mergePushChanges and c['node'] is not None:
-                change_list.append(c)
+            if mergePushChanges and node is not None:
+                change_list.append((push['user'], push['date'], files, desc,
+                                    node, titles))
 
-        if too_many and not self.mergePushChanges:
+        if too_many and not mergePushChanges:
             # We add this at the end, and the list gets reversed below. That
             # means this dummy change ends up being the 'first' change of the
             # set, and buildbot chooses the last change as the one to
             # build, so this dummy change doesn't impact which revision
             # gets built.
-            c = dict(
-                user='buildbot',
-                files=['overflow'],
-                node=None,
-                desc='more than maxChanges(%i) received; ignoring the rest' % self.maxChanges,
-                date=time.time(),
-            )
-            change_list.append(c)
+            change_list.append((
+                'buildbot', time.time(), ['overflow'],
+                'more than maxChanges(%i) received; ignoring the rest' %
+                maxChanges, None, None))
 
         # Un-reverse the list of changes so they get added in the right order
         change_list.reverse()
 
-        # If we have a lastChangeset we're comparing against, we've been
-        # running for a while and so any changes returned here are new.
-
-        # If the repository was previously empty (indicated by emptyRepo=True),
-        # we also want to pay attention to all these pushes.
-
-        # If we don't have a lastChangeset and the repository isn't empty, then
-        # don't trigger any new builds, and start monitoring for changes since
-        # the latest changeset in the repository
-        if self.lastChangeset is not None or self.emptyRepo:
-            for change in change_list:
-                link = "%s/rev/%s" % (self.baseURL, change["node"])
-                c = changes.Change(who=change["user"],
-                                   files=change["files"],
-                                   revision=change["node"],
-                                   comments=change["desc"],
-                                   revlink=link,
-                                   when=change["date"],
-                                   branch=self.branch)
-                if 'commit_titles' in change:
-                    c.properties.setProperty('commit_titles',
-                                             change['commit_titles'],
-                                             'BaseHgPoller')
-                self.changeHook(c)
+        result = []
+        for user, date, files, desc, node, titles in change_list:
+            c = changes.Change(who=user,
+                               files=files,
+                               revision=node,
+                               comments=desc,
+                               revlink="%s/rev/%s" % (self.baseURL, node),
+                               when=date,
+                               branch=self.branch)
+            if titles is not None:
+                c.properties.setProperty('commit_titles', titles,
+                                         'BaseHgPoller')
+            self.changeHook(c)
+            result.append(c)
+        return result
+
+    def submitChanges(self, changelist):
+        if self.batchChanges:
+            addChanges(self.parent, changelist)
+        else:
+            for c in changelist:
                 self.parent.addChange(c)
 
-        # The repository isn't empty any more!
-        self.emptyRepo = False
-        # Use the last change found by the poller, regardless of if it's on our
-        # branch or not. This is so we don't have to constantly ignore it in
-        # future polls.
-        self.lastChangeset = pushes[-1]["changesets"][-1]["node"]
-        if self.verbose:
-            log.msg("last changeset %s on %s" %
-                    (self.lastChangeset, self.baseURL))
-
     def changeHook(self, change):
         pass
 
 
+class HgPollerHub(object):
+    """Coordinates the HgPollers polling one hg server.
+
+    Each poller's LoopingCall is started at a different offset into its poll
+    interval, rather than all of them firing together after a reconfig. No
+    more than maxConcurrent pushlog requests are made to the server at once.
+    That's one fewer than httpclient allows per host, which leaves a
+    connection to it for everything else, e.g. fetching json-pushes for try.
+
+    metrics holds, for each poller by name, the time taken by its requests
+    and how long after being pushed its last change was noticed."""
+    maxConcurrent = httpclient.HTTPClientPool.maxPerHost - 1
+    # Weight given to the latest request in avgLatency
+    latencyWeight = 0.2
+
+    def __init__(self, host, maxConcurrent=None, clock=None):
+        self.host = host
+        if maxConcurrent is not None:
+            self.maxConcurrent = maxConcurrent
+        self.clock = clock or reactor
+        self.semaphore = defer.DeferredSemaphore(self.maxConcurrent)
+        self.pollers = []
+        # id(poller) -> DelayedCall that will start its LoopingCall
+        self.starts = {}
+        self.metrics = {}
+        self._rescheduleCall = None
+
+    def register(self, poller):
+        """Starts polling with poller. Pollers registered during the same
+        reactor turn are scheduled together."""
+        self.pollers.append(poller)
+        poller.hub = self
+        self.getMetrics(poller)
+        if self._rescheduleCall is None:
+            self._rescheduleCall = self.clock.callLater(0, self.reschedule)
+
+    def unregister(self, poller):
+        self.stopPoller(poller)
+        self.pollers = [p for p in self.pollers if p is not poller]
+        self.metrics.pop(str(poller), None)
+        if not self.pollers and self._rescheduleCall is not None:
+            self._rescheduleCall.cancel()
+            self._rescheduleCall = None
+
+    def reschedule(self):
+        """Spreads the first polls of all our pollers evenly over their
+        poll interval"""
+        self._rescheduleCall = None
+        pollers = sorted(self.pollers, key=str)
+        for i, poller in enumerate(pollers):
+            self.stopPoller(poller)
+            offset = poller.pollInterval * i / float(len(pollers))
+            poller.loop = LoopingCall(poller.poll)
+            poller.loop.clock = self.clock
+            self.starts[id(poller)] = self.clock.callLater(
+                offset, self.startPoller, poller)
+
+    def startPoller(self, poller):
+        del self.starts[id(poller)]
+        poller.loop.start(poller.pollInterval)
+
+    def stopPoller(self, poller):
+        start = self.starts.pop(id(poller), None)
+        if start is not None:
+            start.cancel()
+        if poller.loop is not None and poller.loop.running:
+            poller.loop.stop()
+
+    def fetch(self, poller, url, headers=None, timeout=None):
+        """Like httpclient.request, but waits for one of our request
+        slots"""
+        def request():
+            start = time.time()
+            d = httpclient.request(url, headers=headers, timeout=timeout)
+            d.addBoth(self.requestDone, poller, start)
+            return d
+        return self.semaphore.run(request)
+
+    def requestDone(self, res, poller, start):
+        now = time.time()
+        latency = now - start
+        m = self.getMetrics(poller)
+        m['requests'] += 1
+        m['latency'] = latency
+        if m['avgLatency'] is None:
+            m['avgLatency'] = latency
+        else:
+            m['avgLatency'] += self.latencyWeight * \
+                (latency - m['avgLatency'])
+        if isinstance(res, failure.Failure):
+            m['failures'] += 1
+        else:
+            m['lastSuccess'] = now
+        return res
+
+    def recordPushes(self, poller, pushDate):
+        """Records that poller found new pushes, the latest of which was
+        pushed at pushDate"""
+        m = self.getMetrics(poller)
+        m['lastPush'] = pushDate
+        m['lag'] = max(0, time.time() - pushDate)
+
+    def getMetrics(self, poller):
+        name = str(poller)
+        if name not in self.metrics:
+            self.metrics[name] = {
+                'requests': 0,
+                'failures': 0,
+                'latency': None,
+                'avgLatency': None,
+                'lastSuccess': None,
+                'lastPush': None,
+                'lag': None,
+            }
+        return self.metrics[name]
+
+
+# hg server -> HgPollerHub. Kept across reloads so that pollers which survive
+# a reconfig share a hub with new ones
+try:
+    _hubs
+except NameError:
+    _hubs = {}
+
+
+def getHub(hgURL):
+    """Returns the HgPollerHub for the server hgURL is on"""
+    host = urlparse.urlparse(hgURL)[1]
+    if host not in _hubs:
+        _hubs[host] = HgPollerHub(host)
+    return _hubs[host]
+
+
+def hubMetrics():
+    """Returns {server: {poller: metrics}} for all the HgPollerHubs"""
+    return dict((host, hub.metrics) for host, hub in _hubs.items())
+
+
 class HgPoller(base.ChangeSource, BaseHgPoller):
     """This source will poll a Mercurial server over HTTP using
     the built-in RSS feed for changes and submit them to the
@@ -407,14 +879,19 @@ class HgPoller(base.ChangeSource, BaseHgPoller):
 
     compare_attrs = ['hgURL', 'branch', 'pollInterval',
                      'pushlogUrlOverride', 'tipsOnly', 'storeRev',
-                     'repo_branch', 'maxChanges']
+                     'repo_branch', 'maxChanges', 'stateFile']
     parent = None
     loop = None
-    volatile = ['loop']
+    volatile = ['loop', 'hub', 'changesetStore']
+    # Poll through the HgPollerHub for our server
+    useHub = True
+    # Set when we're told about a push while a poll is already running
+    pollAgain = False
 
     def __init__(self, hgURL, branch, pushlogUrlOverride=None,
                  tipsOnly=False, pollInterval=30, storeRev=None,
-                 repo_branch="default", maxChanges=100):
+                 repo_branch="default", maxChanges=100,
+                 stateFile='hgpoller-state.json'):
         """
         @type   hgURL:          string
         @param  hgURL:          The base URL of the Hg repo
@@ -435,26 +912,59 @@ class HgPoller(base.ChangeSource, BaseHgPoller):
         @type   repo_branch:    string or None
         @param  repo_branch:    Name of the in-repo branch to pay attention to.
                                 If None, then pay attention to all branches.
+        @type   stateFile:      string or None
+        @param  stateFile:      File to save the last changeset seen in, so
+                                that polling resumes from it after a restart.
+                                Relative to the master's directory. If None,
+                                the first poll after starting just finds the
+                                latest changeset.
         """
 
         BaseHgPoller.__init__(self, hgURL, branch, pushlogUrlOverride,
                               tipsOnly, repo_branch=repo_branch, maxChanges=maxChanges)
         self.pollInterval = pollInterval
         self.storeRev = storeRev
+        self.stateFile = stateFile
 
     def startService(self):
-        self.loop = LoopingCall(self.poll)
         base.ChangeSource.startService(self)
-        reactor.callLater(0, self.loop.start, self.pollInterval)
+        if self.stateFile:
+            self.changesetStore = getChangesetStore(self.stateFile)
+            self.restoreLastChangeset()
+        if self.useHub:
+            getHub(self.hgURL).register(self)
+        else:
+            self.loop = LoopingCall(self.poll)
+            reactor.callLater(0, self.loop.start, self.pollInterval)
 
     def stopService(self):
-        if self.running:
+        if self.hub is not None:
+            self.hub.unregister(self)
+        elif self.running:
             self.loop.stop()
         return base.ChangeSource.stopService(self)
 
     def describe(self):
         return "Getting changes from: %s" % self._make_url()
 
+    def wantsPush(self, url):
+        """Returns True if url is the repository we're polling"""
+        return url.rstrip('/') == self.baseURL.rstrip('/')
+
+    def notified(self):
+        """Polls now, rather than waiting for our next scheduled poll, e.g.
+        because we've been told about a new push"""
+        if self.attempts:
+            # Our next poll might not see the push; poll again afterwards
+            self.pollAgain = True
+            return
+        self.poll()
+
+    def pollDone(self, res):
+        if self.pollAgain and not self.attempts:
+            self.pollAgain = False
+            self.poll()
+
     def __str__(self):
         return "<HgPoller for %s%s>" % (self.hgURL, self.branch)
 
@@ -496,18 +1006,37 @@ class HgAllLocalesPoller(base.ChangeSource, BasePoller):
     all links look like /releases/l10n-mozilla-1.9.1/af/, where the last
     path step will be the locale code, and the others will be passed
     as branch for the changes, i.e. 'releases/l10n-mozilla-1.9.1'.
+
+    Each poll of the index starts a sweep over all the locales, with at most
+    parallelRequests locale polls running at once. Locales whose previous
+    poll is still running are skipped, until BasePoller gives up on it; the
+    sweep stops waiting for a locale after localeTimeout seconds, so one
+    that hangs doesn't hold up the rest. If the last sweep finished in less
+    than sweepFraction of the poll interval, requests are spaced out so the
+    next sweep takes about that long, rather than hitting the server in a
+    burst.
+
+    Statistics for each sweep are kept in lastSweep and sweepHistory.
     """
 
-    compare_attrs = ['repositoryIndex', 'pollInterval']
+    compare_attrs = ['repositoryIndex', 'pollInterval', 'parallelRequests']
     parent = None
     loop = None
     volatile = ['loop']
 
     timeout = 10
+    # How long a sweep waits for each locale's poll
+    localeTimeout = 60
     parallelRequests = 2
     verboseChilds = False
-
-    def __init__(self, hgURL, repositoryIndex, pollInterval=120, branch=None):
+    # Fraction of pollInterval a sweep should be spread over; None to poll
+    # locales as fast as possible
+    sweepFraction = 0.5
+    # How many sweeps to keep statistics for
+    sweepHistoryLength = 10
+
+    def __init__(self, hgURL, repositoryIndex, pollInterval=120, branch=None,
+                 parallelRequests=None):
         """
         @type  repositoryIndex:      string
         @param repositoryIndex:      The URL listing all locale repos
@@ -516,6 +1045,9 @@ class HgAllLocalesPoller(base.ChangeSource, BasePoller):
                                    changes
         @type  branch:      string
         @param branch:      Used by caller to uniquely identify this object
+        @type  parallelRequests:   int
+        @param parallelRequests:   The maximum number of locales to poll at
+                                   once
         """
 
         BasePoller.__init__(self)
@@ -524,11 +1056,21 @@ class HgAllLocalesPoller(base.ChangeSource, BasePoller):
             hgURL = hgURL[:-1]
         self.repositoryIndex = repositoryIndex
         self.pollInterval = pollInterval
+        if parallelRequests is not None:
+            self.parallelRequests = parallelRequests
         self.localePollers = {}
         self.locales = []
-        self.pendingLocales = []
-        self.activeRequests = 0
+        self.pendingLocales = deque()
+        # Created by processData, so parallelRequests can be changed after
+        # construction
+        self.semaphore = None
         self.branch = branch
+        # Seconds to wait before each locale poll
+        self.pace = 0
+        # Statistics for the sweep in progress, or None
+        self.sweep = None
+        self.lastSweep = None
+        self.sweepHistory = deque(maxlen=self.sweepHistoryLength)
 
     def startService(self):
         self.loop = LoopingCall(self.poll)
@@ -549,8 +1091,9 @@ class HgAllLocalesPoller(base.ChangeSource, BasePoller):
     def getData(self):
         log.msg("Polling all locales at %s/%s/" % (self.hgURL,
                                                    self.repositoryIndex))
-        return getPage(self.hgURL + '/' + self.repositoryIndex + '/?style=raw',
-                       timeout=self.timeout)
+        return httpclient.getPage(
+            self.hgURL + '/' + self.repositoryIndex + '/?style=raw',
+            timeout=self.timeout)
 
     def getLocalePoller(self, locale, branch):
         if (locale, branch) not in self.localePollers:
@@ -574,45 +1117,129 @@ class HgAllLocalesPoller(base.ChangeSource, BasePoller):
         if locales != self.locales:
             log.msg("new locale list: " + " ".join(map(str, locales)))
         self.locales = locales
-        self.pendingLocales = locales[:]
         # prune removed locales from pollers
         for oldLoc in self.localePollers.keys():
             if oldLoc not in locales:
                 self.localePollers.pop(oldLoc)
                 log.msg("not polling %s on %s anymore, dropped from repositories" %
                         oldLoc)
-        for i in xrange(self.parallelRequests):
-            self.activeRequests += 1
-            reactor.callLater(0, self.pollNextLocale)
+
+        if self.sweep is not None:
+            log.msg("%s: previous sweep still has %i locales to go; not "
+                    "starting another" % (self, len(self.pendingLocales)))
+            return
+        if self.semaphore is None or \
+                self.semaphore.limit != self.parallelRequests:
+            self.semaphore = defer.DeferredSemaphore(self.parallelRequests)
+        self.pendingLocales = deque(locales)
+        self.sweep = {
+            'started': time.time(),
+            'locales': len(locales),
+            'polled': [],
+            'skipped': 0,
+            'timedOut': 0,
+            'pace': self.pace,
+            'parallelRequests': self.parallelRequests,
+        }
+        jobs = [self.semaphore.run(self.pollNextLocale) for l in locales]
+        d = defer.DeferredList(jobs, consumeErrors=True)
+        d.addBoth(self.sweepDone)
 
     def pollNextLocale(self):
+        """Polls the next pending locale. Returns a Deferred that fires once
+        it's done, or None if it was skipped"""
         if not self.pendingLocales:
-            self.activeRequests -= 1
-            if not self.activeRequests:
-                msg = "%s done with all locales" % str(self)
-                loadTimes = map(
-                    lambda p: p.loadTime, self.localePollers.values())
-                goodTimes = filter(lambda t: t is not None, loadTimes)
-                if not goodTimes:
-                    msg += ". All %d locale pollers failed" % len(loadTimes)
-                else:
-                    msg += ", min: %.1f, max: %.1f, mean: %.1f" % \
-                        (min(goodTimes), max(goodTimes),
-                         sum(goodTimes) / len(goodTimes))
-                    if len(loadTimes) > len(goodTimes):
-                        msg += ", %d failed" % (
-                            len(loadTimes) - len(goodTimes))
-                log.msg(msg)
-                log.msg("Total time: %.1f" % (time.time() - self.startLoad))
             return
-        loc, branch = self.pendingLocales.pop(0)
+        loc, branch = self.pendingLocales.popleft()
         poller = self.getLocalePoller(loc, branch)
-        poller.poll()
+        if self.pace:
+            return deferLater(reactor, self.pace, self.pollLocale, poller)
+        return self.pollLocale(poller)
+
+    def pollLocale(self, poller):
+        # BasePoller.poll skips the locale if its last poll is still
+        # running, and starts afresh once that's been tried attemptLimit
+        # times
+        d = poller.poll()
+        if d is None:
+            if self.verboseChilds:
+                log.msg("skipping %s; last poll is still running" % poller)
+            if self.sweep is not None:
+                self.sweep['skipped'] += 1
+            return
+        if self.sweep is not None:
+            self.sweep['polled'].append(poller)
+
+        done = defer.Deferred()
+
+        def timedOut():
+            log.msg("%s: gave up waiting for %s after %is" %
+                    (self, poller, self.localeTimeout))
+            if self.sweep is not None:
+                self.sweep['timedOut'] += 1
+            done.errback(defer.TimeoutError(str(poller)))
+        timer = reactor.callLater(self.localeTimeout, timedOut)
+
+        def finished(res):
+            if timer.active():
+                timer.cancel()
+                done.callback(None)
+            return res
+        d.addBoth(finished)
+        return done
 
     def localeDone(self, loc):
         if self.verboseChilds:
             log.msg("done with " + loc)
-        reactor.callLater(0, self.pollNextLocale)
+
+    def sweepDone(self, results):
+        sweep, self.sweep = self.sweep, None
+        polled = sweep.pop('polled')
+        loadTimes = [p.loadTime for p in polled if p.loadTime is not None]
+        sweep['total'] = time.time() - sweep['started']
+        sweep['failed'] = len(polled) - len(loadTimes)
+        sweep['polled'] = len(polled)
+        if loadTimes:
+            sweep['min'] = min(loadTimes)
+            sweep['max'] = max(loadTimes)
+            sweep['mean'] = sum(loadTimes) / len(loadTimes)
+        else:
+            sweep['min'] = sweep['max'] = sweep['mean'] = None
+        self.lastSweep = sweep
+        self.sweepHistory.append(sweep)
+
+        msg = "%s done with all locales" % str(self)
+        if not loadTimes:
+            msg += ". All %d locale pollers failed" % sweep['polled']
+        else:
+            msg += ", min: %(min).1f, max: %(max).1f, mean: %(mean).1f" % \
+                sweep
+            if sweep['failed']:
+                msg += ", %(failed)d failed" % sweep
+        if sweep['skipped']:
+            msg += ", %(skipped)d still running from last time" % sweep
+        if sweep['timedOut']:
+            msg += ", %(timedOut)d timed out" % sweep
+        log.msg(msg)
+        log.msg("Total time: %.1f" % sweep['total'])
+
+        self.adjustPace(sweep)
+
+    def adjustPace(self, sweep):
+        """Works out how long to wait before each locale poll so the next
+        sweep takes about sweepFraction of the poll interval, given how long
+        locales took to load this time."""
+        if not self.sweepFraction or not sweep['mean'] or \
+                not sweep['polled']:
+            self.pace = 0
+            return
+        target = self.pollInterval * self.sweepFraction
+        # Each of the parallelRequests slots handles this many locales
+        perSlot = float(sweep['locales']) / self.parallelRequests
+        self.pace = max(0, target / perSlot - sweep['mean'])
+        if not self.pace and perSlot * sweep['mean'] > self.pollInterval:
+            log.msg("%s: polling all locales takes longer than the poll "
+                    "interval; consider raising parallelRequests" % self)
 
     def __str__(self):
         return "<HgAllLocalesPoller for %s/%s/>" % (self.hgURL,
@@ -0,0 +1,143 @@
+# Push notifications for HgPollers
+# Contributor(s):
+#   Chris AtLee <catlee@mozilla.com>
+"""PushNotifier tells HgPollers about new pushes as soon as they happen.
+
+Notifications are JSON objects like
+
+    {"url": "https://hg.mozilla.org/mozilla-central", "pushid": 15227}
+
+which can be added to a mozilla_buildtools QueueDir (e.g. by an hg changegroup
+hook, or something listening to pulse), or written one per line to a socket
+PushNotifier is listening on.
+
+For each notification, the HgPollers for that repository poll right away.
+They still ask the pushlog for everything since their lastChangeset, so
+pushes whose notifications went missing are picked up too. Their regular
+polls carry on as a fallback, and can be made much less frequent.
+"""
+from twisted.application import strports
+from twisted.internet.protocol import ServerFactory
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from buildbot.changes import base
+from buildbot.util import json
+
+from mozilla_buildtools.queuedir import QueueDir
+
+
+class NotificationProtocol(LineReceiver):
+    delimiter = '\n'
+
+    def lineReceived(self, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            log.msg("PushNotifier: ignoring malformed notification %r" % line)
+            return
+        self.factory.notifier.dispatch(msg)
+
+
+class NotificationFactory(ServerFactory):
+    protocol = NotificationProtocol
+
+    def __init__(self, notifier):
+        self.notifier = notifier
+
+
+class PushNotifier(base.ChangeSource):
+    """Triggers polls by the HgPollers in the same master when there are
+    pushes to their repositories.
+
+    @param  queuedir:       QueueDir, or the path of one, to read
+                            notifications from
+    @param  listen:         strports description of where to listen for
+                            notifications, e.g. 'tcp:9989:interface=127.0.0.1'
+                            or 'unix:/path/to/socket'
+    @param  checkInterval:  How often, in seconds, to look for notifications
+                            in queuedir
+    """
+    compare_attrs = ['queuedir', 'listen', 'checkInterval']
+
+    def __init__(self, queuedir=None, listen=None, checkInterval=1):
+        assert queuedir or listen, "queuedir or listen is required"
+        self.queuedir = queuedir
+        if isinstance(queuedir, basestring):
+            queuedir = QueueDir('pushes', queuedir)
+        self.queue = queuedir
+        self.listen = listen
+        self.checkInterval = checkInterval
+        self.loop = None
+        self.port = None
+        self.stats = {'notifications': 0, 'polls': 0, 'unmatched': 0}
+
+    def startService(self):
+        base.ChangeSource.startService(self)
+        if self.queue is not None:
+            self.loop = LoopingCall(self.checkQueue)
+            self.loop.start(self.checkInterval)
+        if self.listen:
+            self.port = strports.listen(self.listen, NotificationFactory(self))
+
+    def stopService(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        if self.port is not None:
+            self.port.stopListening()
+            self.port = None
+        return base.ChangeSource.stopService(self)
+
+    def describe(self):
+        sources = []
+        if isinstance(self.queuedir, basestring):
+            sources.append(self.queuedir)
+        elif self.queue is not None:
+            sources.append(self.queue.name)
+        if self.listen:
+            sources.append(self.listen)
+        return "Push notifications from %s" % ", ".join(sources)
+
+    def checkQueue(self):
+        while True:
+            item = self.queue.pop()
+            if item is None:
+                return
+            item_id, fp = item
+            try:
+                msg = json.load(fp)
+            except ValueError:
+                msg = None
+            fp.close()
+            if msg is None:
+                log.msg("PushNotifier: malformed notification %s" % item_id)
+                self.queue.murder(item_id)
+                continue
+            self.queue.remove(item_id)
+            self.dispatch(msg)
+
+    def getPollers(self):
+        """Returns the change sources that can be told about pushes"""
+        if self.parent is None:
+            return []
+        return [s for s in self.parent if hasattr(s, 'wantsPush')]
+
+    def dispatch(self, msg):
+        """Tells the pollers for msg's repository to poll"""
+        self.stats['notifications'] += 1
+        url = msg.get('url') if isinstance(msg, dict) else None
+        if not url:
+            log.msg("PushNotifier: notification without a url: %r" % (msg,))
+            return
+        pollers = [p for p in self.getPollers() if p.wantsPush(url)]
+        if not pollers:
+            self.stats['unmatched'] += 1
+            return
+        log.msg("PushNotifier: push %s to %s" % (msg.get('pushid'), url))
+        for p in pollers:
+            self.stats['polls'] += 1
+            p.notified()
@@ -180,3 +180,43 @@ def getPreviousVersion(version, partialVersions):
         composed = sorted([(v, StrictVersion(v)) for v in partialVersions if v
                            != version], key=lambda x: x[1], reverse=True)
         return composed[0][0]
+
+
+class PathPrefixTrie(object):
+    """A set of path prefixes, stored as a character trie
+
+    matches() checks whether a path starts with any of the prefixes in time
+    proportional to the length of the path, however many prefixes there are.
+    """
+
+    def __init__(self, prefixes=()):
+        self.root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        node = self.root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        # None marks the end of a prefix
+        node[None] = True
+
+    def matches(self, path):
+        """Returns True if path starts with any of the prefixes"""
+        node = self.root
+        if None in node:
+            return True
+        for c in path:
+            node = node.get(c)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def matchesAny(self, paths):
+        """Returns True if any of paths starts with any of the prefixes"""
+        for path in paths:
+            if self.matches(path):
+                return True
+        return False
@@ -0,0 +1,270 @@
+# Shared HTTP client for the master
+# Contributor(s):
+#   Chris AtLee <catlee@mozilla.com>
+"""A shared HTTP client for everything in the master that fetches URLs.
+
+twisted.web.client.getPage makes a new connection, and for https a new TLS
+handshake, for every request. Requests made through here share a pool of
+keep-alive connections where Twisted supports it (12.1 and newer; older
+versions fall back to a connection per request), are limited to maxPerHost
+at once for each server, and are timed; see getStats(). Requests made
+without a timeout get HTTPClientPool.timeout, so that a server that never
+answers can't hold its slots for good.
+
+getPage() is a drop-in replacement for twisted.web.client.getPage.
+"""
+import time
+import urlparse
+from StringIO import StringIO
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Protocol
+from twisted.python import failure, log
+from twisted.web.client import HTTPClientFactory, _makeGetterFactory
+from twisted.web.error import Error as WebError
+try:
+    # Twisted 12.1 and newer can keep connections open between requests
+    from twisted.web.client import Agent, RedirectAgent, \
+        HTTPConnectionPool, FileBodyProducer, ResponseDone
+    from twisted.web.http import PotentialDataLoss
+    from twisted.web.http_headers import Headers
+except ImportError:
+    HTTPConnectionPool = None
+
+
+class _BodyReceiver(Protocol):
+    def __init__(self, finished):
+        self.finished = finished
+        self.data = []
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(''.join(self.data))
+        else:
+            self.finished.errback(reason)
+
+
+class _TrackingPool(object):
+    """Hands out connections from an HTTPConnectionPool, remembering them so
+    that a request that takes too long can be aborted; cancelling the
+    request's Deferred doesn't close its connection."""
+    def __init__(self, pool):
+        self.pool = pool
+        self.connections = []
+
+    def __getattr__(self, name):
+        # Agent looks at some of the pool's settings
+        return getattr(self.pool, name)
+
+    def getConnection(self, key, endpoint):
+        d = self.pool.getConnection(key, endpoint)
+
+        def gotConnection(connection):
+            self.connections.append(connection)
+            return connection
+        d.addCallback(gotConnection)
+        return d
+
+    def abort(self):
+        """Aborts the connection being used, or returns False if there
+        isn't one yet"""
+        if not self.connections:
+            return False
+        self.connections[-1].abort()
+        return True
+
+
+def _agentRequest(pool, url, method, headers, postdata, timeout):
+    pool = _TrackingPool(pool)
+    # Follow redirects, like HTTPClientFactory does
+    agent = RedirectAgent(Agent(reactor, pool=pool))
+    body = None
+    if postdata is not None:
+        body = FileBodyProducer(StringIO(postdata))
+    d = agent.request(method, url, Headers(
+        dict((k, [v]) for k, v in (headers or {}).items())), body)
+
+    def timedOut():
+        if not pool.abort():
+            d.cancel()
+    timer = reactor.callLater(timeout, timedOut)
+
+    def gotResponse(response):
+        status = str(response.code)
+        response_headers = dict((k.lower(), v) for k, v in
+                                response.headers.getAllRawHeaders())
+        if response.code in (204, 304):
+            # These never have a body, and some versions of Twisted never
+            # finish delivering one
+            return (status, response_headers, '')
+
+        def gotBody(body):
+            if status == '304' or 200 <= response.code < 300:
+                return (status, response_headers, body)
+            raise WebError(status, response.phrase, body)
+        finished = defer.Deferred()
+        finished.addCallback(gotBody)
+        response.deliverBody(_BodyReceiver(finished))
+        return finished
+    d.addCallback(gotResponse)
+
+    def cancelTimer(res):
+        if timer.active():
+            timer.cancel()
+        return res
+    d.addBoth(cancelTimer)
+    return d
+
+
+def _factoryRequest(url, method, headers, postdata, timeout, contextFactory):
+    factory = _makeGetterFactory(url, HTTPClientFactory,
+                                 contextFactory=contextFactory,
+                                 method=method, headers=headers or {},
+                                 postdata=postdata, timeout=timeout)
+
+    def gotPage(data):
+        return (factory.status, getattr(factory, 'response_headers', {}),
+                data)
+
+    def checkNotModified(f):
+        f.trap(WebError)
+        if f.value.status != '304':
+            return f
+        return ('304', getattr(factory, 'response_headers', {}), '')
+    d = factory.deferred
+    d.addCallbacks(gotPage, checkNotModified)
+    return d
+
+
+class HTTPClientPool(object):
+    # Most requests we'll make to any one server at once
+    maxPerHost = 4
+    # Seconds requests made without a timeout get
+    timeout = 120
+
+    def __init__(self, maxPerHost=None, persistent=True):
+        if maxPerHost is not None:
+            self.maxPerHost = maxPerHost
+        # (scheme, host:port) -> DeferredSemaphore
+        self.limits = {}
+        # (scheme, host:port) -> request stats
+        self.stats = {}
+        self.pool = None
+        if persistent and HTTPConnectionPool is not None:
+            self.pool = HTTPConnectionPool(reactor, persistent=True)
+            self.pool.maxPersistentPerHost = self.maxPerHost
+
+    def hostKey(self, url):
+        parts = urlparse.urlparse(url)
+        return (parts[0], parts[1])
+
+    def getStats(self, key):
+        if key not in self.stats:
+            self.stats[key] = {
+                'requests': 0,
+                'failures': 0,
+                'active': 0,
+                'queued': 0,
+                'bytes': 0,
+                'total_time': 0.0,
+                'max_time': 0.0,
+            }
+        return self.stats[key]
+
+    def request(self, url, method='GET', headers=None, postdata=None,
+                timeout=None, contextFactory=None):
+        """Requests url, returning a Deferred that fires with (status,
+        headers, body), where headers maps lower-cased header names to lists
+        of values. 304 Not Modified responses fire with an empty body; other
+        error responses errback with twisted.web.error.Error.
+
+        Requests with their own contextFactory get a connection of their
+        own, since pooled connections might have been verified differently.
+        Requests get self.timeout seconds if timeout isn't given.
+        """
+        if not timeout:
+            timeout = self.timeout
+        key = self.hostKey(url)
+        if key not in self.limits:
+            self.limits[key] = defer.DeferredSemaphore(self.maxPerHost)
+        stats = self.getStats(key)
+        stats['queued'] += 1
+        return self.limits[key].run(self._request, key, url, method, headers,
+                                    postdata, timeout, contextFactory)
+
+    def _request(self, key, url, method, headers, postdata, timeout,
+                 contextFactory):
+        stats = self.getStats(key)
+        stats['queued'] -= 1
+        stats['active'] += 1
+        start = time.time()
+        if self.pool is not None and contextFactory is None:
+            d = _agentRequest(self.pool, url, method, headers, postdata,
+                              timeout)
+        else:
+            d = _factoryRequest(url, method, headers, postdata, timeout,
+                                contextFactory)
+        d.addBoth(self._requestDone, key, start)
+        return d
+
+    def _requestDone(self, res, key, start):
+        elapsed = time.time() - start
+        stats = self.getStats(key)
+        stats['active'] -= 1
+        stats['requests'] += 1
+        stats['total_time'] += elapsed
+        stats['max_time'] = max(stats['max_time'], elapsed)
+        if isinstance(res, failure.Failure):
+            stats['failures'] += 1
+        else:
+            stats['bytes'] += len(res[2])
+        return res
+
+    def getPage(self, url, **kwargs):
+        """Like twisted.web.client.getPage"""
+        d = self.request(url, **kwargs)
+
+        def gotResult(result):
+            status, headers, body = result
+            if status == '304':
+                raise WebError(status, 'Not Modified', body)
+            return body
+        d.addCallback(gotResult)
+        return d
+
+    def close(self):
+        """Closes any idle connections. Returns a Deferred."""
+        if self.pool is None:
+            return defer.succeed(None)
+        return self.pool.closeCachedConnections()
+
+
+# Kept across reloads, so connections stay open through reconfigs
+try:
+    _pool
+except NameError:
+    _pool = HTTPClientPool()
+    log.msg("httpclient: keep-alive connections %s" %
+            (_pool.pool is not None and "enabled" or
+             "unavailable with this version of Twisted"))
+
+
+def request(url, **kwargs):
+    """Makes a request through the shared HTTPClientPool; see
+    HTTPClientPool.request"""
+    return _pool.request(url, **kwargs)
+
+
+def getPage(url, **kwargs):
+    """Drop-in replacement for twisted.web.client.getPage that uses the
+    shared HTTPClientPool"""
+    return _pool.getPage(url, **kwargs)
+
+
+def getStats():
+    """Returns {(scheme, host:port): stats} for the requests made through the
+    shared HTTPClientPool"""
+    return _pool.stats
@@ -39,11 +39,11 @@
 
 from twisted.python import log
 from twisted.internet import defer
-from twisted.web.client import getPage
 from buildbot.scheduler import Dependent, Triggerable, Nightly
 from buildbot.sourcestamp import SourceStamp
 from buildbot.process import properties
 from buildbot.status.builder import SUCCESS, WARNINGS
+from buildbotcustom.httpclient import getPage
 
 
 def ParseLocalesFile(data):
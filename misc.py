@@ -6,15 +6,22 @@ try:
 except:
     import simplejson as json
 import collections
+import hashlib
+import heapq
 import random
 import re
 import sys
 import os
+import types
+import copy
 from copy import deepcopy
-import inspect
+from distutils import sysconfig
 from functools import wraps
 
 from twisted.python import log
+from twisted.internet import defer, reactor, task
+from twisted.internet.task import LoopingCall
+from twisted.web.error import Error as WebError
 
 from buildbot.scheduler import Nightly, Scheduler, Triggerable
 from buildbot.schedulers.filter import ChangeFilter
@@ -24,6 +31,7 @@ from buildbot.util import now
 
 import buildbotcustom.common
 import buildbotcustom.changes.hgpoller
+import buildbotcustom.changes.pushnotify
 import buildbotcustom.process.factory
 import buildbotcustom.l10n
 import buildbotcustom.scheduler
@@ -33,22 +41,27 @@ import buildbotcustom.status.queued_command
 import buildbotcustom.misc_scheduler
 import build.paths
 import mozilla_buildtools.queuedir
-reload(buildbotcustom.common)
-reload(buildbotcustom.changes.hgpoller)
-reload(buildbotcustom.process.factory)
-reload(buildbotcustom.l10n)
-reload(buildbotcustom.scheduler)
-reload(buildbotcustom.status.mail)
-reload(buildbotcustom.status.generators)
-reload(buildbotcustom.misc_scheduler)
-reload(build.paths)
-reload(mozilla_buildtools.queuedir)
-
-from buildbotcustom.common import normalizeName
+from buildbotcustom.reloader import reloadChanged
+reloadChanged(buildbotcustom.common,
+              buildbotcustom.changes.hgpoller,
+              buildbotcustom.changes.pushnotify,
+              buildbotcustom.process.factory,
+              buildbotcustom.l10n,
+              buildbotcustom.scheduler,
+              buildbotcustom.status.mail,
+              buildbotcustom.status.generators,
+              buildbotcustom.misc_scheduler,
+              build.paths,
+              mozilla_buildtools.queuedir)
+
+from buildbotcustom.common import normalizeName, PathPrefixTrie
+from buildbotcustom.httpclient import getPage
 from buildbotcustom.changes.hgpoller import HgPoller, HgAllLocalesPoller
+from buildbotcustom.changes.pushnotify import PushNotifier
 from buildbotcustom.process.factory import NightlyBuildFactory, \
     NightlyRepackFactory, \
-    TryBuildFactory, ScriptFactory, SigningScriptFactory, rc_eval_func
+    TryBuildFactory, ScriptFactory, SigningScriptFactory, rc_eval_func, \
+    StepInterner
 from buildbotcustom.scheduler import BuilderChooserScheduler, \
     PersistentScheduler, makePropertiesScheduler, SpecificNightly, EveryNthScheduler
 from buildbotcustom.l10n import TriggerableL10n
@@ -159,28 +172,85 @@ _product_excludes = {
 }
 
 
-def isImportantForProduct(change, product):
+class ProductExcludeMatcher(object):
+    """Checks paths against a list of exclude regexes
+
+    Regexes that are just an anchored path prefix, like '^browser/', are
+    checked with a PathPrefixTrie. The rest are compiled into a single
+    alternation, so each path is searched once rather than once per regex.
+    Results are memoized per path, since the same paths show up in change
+    after change.
+    """
+    # Maximum number of paths to remember results for
+    MAX_CACHED_PATHS = 50000
+    # Regexes that only match a literal prefix
+    PREFIX_RE = re.compile(r'^\^[\w/-]+$')
+
+    def __init__(self, excludes):
+        self.excludes = excludes
+        self.prefixes = PathPrefixTrie()
+        patterns = []
+        for e in excludes:
+            if self.PREFIX_RE.match(e.pattern) and not e.flags & re.IGNORECASE:
+                self.prefixes.add(e.pattern[1:])
+            else:
+                patterns.append("(?:%s)" % e.pattern)
+        if patterns:
+            self.regex = re.compile("|".join(patterns))
+        else:
+            self.regex = None
+        # path -> whether it's excluded
+        self.cache = {}
+
+    def isExcluded(self, path):
+        excluded = self.cache.get(path)
+        if excluded is None:
+            excluded = self.prefixes.matches(path) or \
+                (self.regex is not None and
+                 self.regex.search(path) is not None)
+            if len(self.cache) >= self.MAX_CACHED_PATHS:
+                self.cache.clear()
+            self.cache[path] = excluded
+        return excluded
+
+# product -> ProductExcludeMatcher
+_product_matchers = {}
+
+
+def getProductExcludeMatcher(product):
+    """Returns the ProductExcludeMatcher for product's excludes, including
+    the ones for all products"""
+    matcher = _product_matchers.get(product)
+    if matcher is None:
+        excludes = _product_excludes.get(product, []) + \
+            _product_excludes.get('__all', [])
+        matcher = _product_matchers[product] = ProductExcludeMatcher(excludes)
+    return matcher
+
+
+def isImportantForProduct(change, product, verbose=True):
     """Handles product specific handling of important files"""
     # For each file, check each product's exclude list
     # If a file is not excluded, then the change is important
     # If all files are excluded, then the change is not important
     # As long as hgpoller's 'overflow' marker isn't excluded, it will cause all
     # products to build
-    excludes = _product_excludes.get(product, []) + _product_excludes.get('__all', [])
+    matcher = getProductExcludeMatcher(product)
     for f in change.files:
-        excluded = any(e.search(f) for e in excludes)
-        if not excluded:
-            log.msg("%s important for %s because of %s" % (
-                change.revision, product, f))
+        if not matcher.isExcluded(f):
+            if verbose:
+                log.msg("%s important for %s because of %s" % (
+                    change.revision, product, f))
             return True
 
     # Everything was excluded
-    log.msg("%s not important for %s because all files were excluded" %
-            (change.revision, product))
+    if verbose:
+        log.msg("%s not important for %s because all files were excluded" %
+                (change.revision, product))
     return False
 
 
-def makeImportantFunc(hgurl, product):
+def makeImportantFunc(hgurl, product, verbose=True):
     def isImportant(c):
         if not isHgPollerTriggered(c, hgurl):
             return False
@@ -189,16 +259,24 @@ def makeImportantFunc(hgurl, product):
         # No product is specified, so all changes are important
         if product is None:
             return True
-        return isImportantForProduct(c, product)
+        return isImportantForProduct(c, product, verbose)
     return isImportant
 
 
+# tuple of l10n modules -> PathPrefixTrie
+_l10n_tries = {}
+
+
 def isImportantL10nFile(change, l10nModules):
-    for f in change.files:
-        for basepath in l10nModules:
-            if f.startswith(basepath):
-                return True
-    return False
+    """Returns True if any file in change is under one of l10nModules, which
+    is a list of paths or a PathPrefixTrie of them"""
+    if not isinstance(l10nModules, PathPrefixTrie):
+        key = tuple(l10nModules)
+        trie = _l10n_tries.get(key)
+        if trie is None:
+            trie = _l10n_tries[key] = PathPrefixTrie(key)
+        l10nModules = trie
+    return l10nModules.matchesAny(change.files)
 
 
 def changeContainsProduct(change, productName):
@@ -238,29 +316,99 @@ def generateTestBuilderNames(name_prefix, suites_name, suites):
     return test_builders
 
 
-def _getLastTimeOnBuilder(builder, slavename):
-    # New builds are at the end of the buildCache, so
-    # examine it backwards
-    buildNumbers = reversed(sorted(builder.builder_status.buildCache.keys()))
-    for buildNumber in buildNumbers:
-        try:
-            build = builder.builder_status.buildCache[buildNumber]
-            # Skip non-successful builds
-            if build.getResults() != 0:
+class LastSuccessIndex(object):
+    """Index of when each slave last finished a successful build, per builder
+
+    The index for a builder is seeded from its buildCache the first time it's
+    asked about, and then kept up to date by subscribing to the builder's
+    status for buildFinished events. Lookups are a single dict access, so
+    nextSlave functions don't need to scan the buildCache for every
+    comparison.
+    """
+
+    def __init__(self):
+        # builder name -> (builder_status, {slavename: finished time})
+        self.builders = {}
+
+    def _getIndex(self, builder):
+        builder_status = builder.builder_status
+        entry = self.builders.get(builder.name)
+        if entry and entry[0] is builder_status:
+            return entry[1]
+
+        if entry:
+            # The builder was reconfigured with a new status object
+            entry[0].unsubscribe(self)
+
+        index = {}
+        buildCache = builder_status.buildCache
+        # Walk the cache oldest first so newer builds win
+        for buildNumber in sorted(buildCache.keys()):
+            try:
+                build = buildCache[buildNumber]
+            except KeyError:
                 continue
-            if build.slavename == slavename:
-                return build.finished
-        except KeyError:
-            continue
-    return None
+            self._record(index, build, build.getResults())
+        self.builders[builder.name] = (builder_status, index)
+        builder_status.subscribe(self)
+        return index
+
+    def _record(self, index, build, results):
+        # Skip non-successful builds
+        if results != SUCCESS:
+            return
+        last = index.get(build.slavename)
+        if last is None or build.finished > last:
+            index[build.slavename] = build.finished
+
+    def getLastTime(self, builder, slavename):
+        """Returns the time slavename last finished a successful build on
+        builder, or None if it hasn't"""
+        return self._getIndex(builder).get(slavename)
+
+    def pickMostRecent(self, builder, slaves):
+        """Returns the slave from slaves that most recently finished a
+        successful build on builder. Ties are broken in favour of slaves later
+        in the list."""
+        index = self._getIndex(builder)
+        best = None
+        best_time = None
+        for s in slaves:
+            t = index.get(s.slave.slavename)
+            if best is None or t >= best_time:
+                best = s
+                best_time = t
+        return best
+
+    def unsubscribeAll(self):
+        """Unsubscribes from every builder's status and forgets the index"""
+        for builder_status, index in self.builders.values():
+            builder_status.unsubscribe(self)
+        self.builders = {}
+
+    # IStatusReceiver methods for BuilderStatus subscriptions
+    def builderChangedState(self, builderName, state):
+        pass
+
+    def buildStarted(self, builderName, build):
+        pass
+
+    def buildFinished(self, builderName, build, results):
+        entry = self.builders.get(builderName)
+        if entry:
+            self._record(entry[1], build, results)
+
+# The index and tracker are made afresh each time this module is loaded, so
+# the ones from the previous load need to stop listening to builders
+try:
+    _lastSuccess.unsubscribeAll()
+except NameError:
+    pass
+_lastSuccess = LastSuccessIndex()
 
 
-def _recentSort(builder):
-    def sortfunc(s1, s2):
-        t1 = _getLastTimeOnBuilder(builder, s1.slave.slavename)
-        t2 = _getLastTimeOnBuilder(builder, s2.slave.slavename)
-        return cmp(t1, t2)
-    return sortfunc
+def _getLastTimeOnBuilder(builder, slavename):
+    return _lastSuccess.getLastTime(builder, slavename)
 
 
 def safeNextSlave(func):
@@ -290,40 +438,100 @@ class JacuzziAllocator(object):
     >>> J = JacuzziAllocator()
     >>> builder['nextSlave'] = J(my_next_slave_func)
 
+    nextSlave functions only ever read the in-memory snapshot of allocations.
+    Fetching from the service happens asynchronously on the reactor: entries
+    older than CACHE_MAXAGE are still used while a refresh is in flight
+    (stale-while-revalidate), and a LoopingCall keeps every builder we've been
+    asked about warm. Builders we know nothing about yet get no slaves until
+    their first fetch finishes, or any slave if that fetch fails.
+
+    With BULK_FETCH set, the whole allocation map is fetched from BULK_PATH
+    in one request instead of one request per builder. The response is
+    expected to look like {"builders": {buildername: [slavename, ...]}}.
+    Builders that aren't in the map don't have a jacuzzi.
+
+    get_stats() returns counters of cache hits, misses and fetch latency.
+
     Attributes:
         BASE_URL (str): Base URL to use for the service
-        CACHE_MAXAGE (int): Time in seconds to cache results from service,
-            defaults to 300
-        CACHE_FAIL_MAXAGE (int): Time in seconds to cache failures from
-            service, defaults to 30
+        CACHE_MAXAGE (int): Time in seconds after which results from the
+            service are refreshed, defaults to 300
+        CACHE_FAIL_MAXAGE (int): Time in seconds to wait before trying the
+            service again after giving up, defaults to 30
+        STALE_MAXAGE (int): Time in seconds after which results from the
+            service are no longer used at all, defaults to 3600
         MAX_TRIES (int): Maximum number of times to try to contact service,
             defaults to 3
-        SLEEP_TIME (int): How long to sleep between tries, in seconds, defaults
-            to 10
+        SLEEP_TIME (int): Base delay between tries, in seconds, defaults to
+            10. Each retry doubles the delay, with random jitter.
         HTTP_TIMEOUT (int): How long to wait for a response from the service,
             in seconds, defaults to 10
+        BULK_FETCH (bool): Fetch all allocations in a single request,
+            defaults to False
+        BULK_PATH (str): Path under BASE_URL of the bulk allocations
+            endpoint, defaults to "allocations/all"
     """
     BASE_URL = "http://jacuzzi-allocator.pub.build.mozilla.org/v1"
     CACHE_MAXAGE = 300  # 5 minutes
     CACHE_FAIL_MAXAGE = 30  # Cache failures for 30 seconds
+    STALE_MAXAGE = 3600  # Stop using results after an hour
     MAX_TRIES = 3  # Try up to 3 times
-    SLEEP_TIME = 10  # Wait 10s between tries
+    SLEEP_TIME = 10  # Wait ~10s before the first retry
     HTTP_TIMEOUT = 10  # Timeout http fetches in 10s
+    BULK_FETCH = False
+    BULK_PATH = "allocations/all"
+
+    # Keys for the allocated/all and bulk entries in inflight and failed
+    ALLOCATED = object()
+    BULK = object()
 
     def __init__(self):
-        # Cache of builder name -> (timestamp, set of slavenames)
+        # Cache of builder name -> (timestamp, set of slavenames or None if the
+        # builder doesn't have a jacuzzi)
         self.cache = {}
 
         # (timestamp, set of slavenames)
         self.allocated_cache = None
 
-        # Cache of builder name -> timestamp
-        self.missing_cache = {}
+        # slavename -> name of the builder it's allocated to. Only kept with
+        # BULK_FETCH, where it's rebuilt by each refresh.
+        self.slave_builders = {}
+
+        # builder name or ALLOCATED -> Deferred for fetches in flight
+        self.inflight = {}
+
+        # builder name or ALLOCATED -> time we can try the service again
+        self.failed = {}
+
+        # Builder names that have been asked for, and so are kept warm
+        self.buildernames = set()
+
+        self.refresher = None
+        self.botmaster = None
 
         self.jacuzzi_enabled = True
 
+        self.stats = dict(
+            hits=0,
+            stale_hits=0,
+            misses=0,
+            fetches=0,
+            fetch_failures=0,
+            fetch_time=0.0,
+        )
+
         self.log("created")
 
+    def get_stats(self):
+        """Returns a dict of cache and fetch counters, including the average
+        fetch latency in seconds"""
+        stats = self.stats.copy()
+        if stats['fetches']:
+            stats['avg_fetch_time'] = stats['fetch_time'] / stats['fetches']
+        else:
+            stats['avg_fetch_time'] = None
+        return stats
+
     def log(self, msg, exc_info=False):
         """
         Output stuff into twistd.log
@@ -339,119 +547,264 @@ class JacuzziAllocator(object):
         else:
             log.msg("JacuzziAllocator %i: %s" % (id(self), msg))
 
+    def _fetch(self, url):
+        """Fetches url and decodes the JSON result, retrying MAX_TRIES times
+        with jittered exponential backoff. 404 errors aren't retried.
+
+        Returns a Deferred.
+        """
+        def fetch(i):
+            self.log("fetching %s" % url)
+            start = time.time()
+            d = getPage(url, timeout=self.HTTP_TIMEOUT)
+            d.addBoth(timed, start)
+            d.addCallback(json.loads)
+            d.addErrback(retry, i)
+            return d
+
+        def timed(result, start):
+            self.stats['fetches'] += 1
+            self.stats['fetch_time'] += time.time() - start
+            return result
+
+        def retry(failure, i):
+            if failure.check(WebError) and failure.value.status == '404':
+                return failure
+            if i + 1 >= self.MAX_TRIES:
+                return failure
+            delay = self.SLEEP_TIME * (2 ** i) * random.uniform(0.5, 1.5)
+            self.log("try %i/%i for %s failed (%s); trying again in %.1fs" %
+                     (i + 1, self.MAX_TRIES, url, failure.getErrorMessage(),
+                      delay))
+            return task.deferLater(reactor, delay, fetch, i + 1)
+
+        return fetch(0)
+
+    def _start_fetch(self, key, url, callback, errback=None):
+        """Fetches url unless a fetch for key is already in flight, and
+        passes the decoded result to callback. Failures not handled by
+        errback are logged, and remembered for CACHE_FAIL_MAXAGE seconds.
+
+        Returns a Deferred that doesn't errback.
+        """
+        if key in self.inflight:
+            return self.inflight[key]
+
+        def done(result):
+            self.inflight.pop(key, None)
+            self.failed.pop(key, None)
+            return result
+
+        def failed(failure):
+            self.inflight.pop(key, None)
+            self.stats['fetch_failures'] += 1
+            self.log("gave up fetching %s: %s" % (url,
+                                                 failure.getErrorMessage()))
+            self.failed[key] = time.time() + self.CACHE_FAIL_MAXAGE
+
+        d = self._fetch(url)
+        d.addCallback(callback)
+        if errback:
+            d.addErrback(errback)
+        d.addCallbacks(done, failed)
+        self.inflight[key] = d
+        return d
+
+    def refresh_allocated(self):
+        """Fetches the set of all allocated slaves. Returns a Deferred."""
+        url = "%s/allocated/all" % self.BASE_URL
+
+        def cb(data):
+            self.allocated_cache = (time.time(), frozenset(data['machines']))
+
+        return self._start_fetch(self.ALLOCATED, url, cb)
+
+    def refresh_builder(self, buildername):
+        """Fetches the allocation for buildername. Returns a Deferred."""
+        url = "%s/builders/%s" % (self.BASE_URL,
+                                  urllib2.quote(buildername, ""))
+
+        def cb(data):
+            was_cold = buildername not in self.cache
+            self.cache[buildername] = (time.time(),
+                                       frozenset(data['machines']))
+            if was_cold:
+                self._poke()
+
+        def eb(failure):
+            failure.trap(WebError)
+            if failure.value.status != '404':
+                return failure
+            # We couldn't find an allocation for this builder, so it can use
+            # any slave that isn't allocated elsewhere
+            was_cold = buildername not in self.cache
+            self.cache[buildername] = (time.time(), None)
+            d = self.refresh_allocated()
+            if was_cold:
+                d.addCallback(lambda _: self._poke())
+            return d
+
+        return self._start_fetch(buildername, url, cb, eb)
+
+    def refresh_bulk(self):
+        """Fetches the allocations for all builders in one request, and
+        replaces the snapshot with them. Returns a Deferred."""
+        url = "%s/%s" % (self.BASE_URL, self.BULK_PATH)
+
+        def cb(data):
+            now = time.time()
+            cache = {}
+            slave_builders = {}
+            for buildername, machines in data['builders'].iteritems():
+                machines = frozenset(machines)
+                cache[buildername] = (now, machines)
+                for slavename in machines:
+                    slave_builders[slavename] = buildername
+            was_cold = self.allocated_cache is None
+            self.cache = cache
+            self.slave_builders = slave_builders
+            self.allocated_cache = (now, slave_builders.viewkeys())
+            self.log("got allocations for %i builders, %i slaves" %
+                     (len(cache), len(slave_builders)))
+            if was_cold:
+                self._poke()
+
+        return self._start_fetch(self.BULK, url, cb)
+
+    def refresh_all(self):
+        """Refreshes the allocations for every builder we know about.
+
+        Returns a Deferred that fires once all fetches are done."""
+        if self.BULK_FETCH:
+            return self.refresh_bulk()
+        ds = [self.refresh_allocated()]
+        for buildername in sorted(self.buildernames):
+            ds.append(self.refresh_builder(buildername))
+        return defer.DeferredList(ds, consumeErrors=True)
+
+    def start(self):
+        """Starts refreshing the snapshot every CACHE_MAXAGE seconds"""
+        if self.refresher is None:
+            self.refresher = LoopingCall(self.refresh_all)
+            self.refresher.start(self.CACHE_MAXAGE, now=False)
+
+    def stop(self):
+        if self.refresher is not None:
+            if self.refresher.running:
+                self.refresher.stop()
+            self.refresher = None
+
+    def _poke(self):
+        """Lets the botmaster know that a builder that was waiting on its
+        first allocation can now start builds"""
+        if self.botmaster is not None:
+            self.botmaster.maybeStartAllBuilds()
+
+    def _is_fresh(self, entry):
+        return entry and entry[0] + self.CACHE_MAXAGE > time.time()
+
+    def _is_usable(self, entry):
+        return entry and entry[0] + self.STALE_MAXAGE > time.time()
+
+    def _is_failed(self, key):
+        return self.failed.get(key, 0) > time.time()
+
+    def _count(self, entry):
+        if self._is_fresh(entry):
+            self.stats['hits'] += 1
+        elif self._is_usable(entry):
+            self.stats['stale_hits'] += 1
+        else:
+            self.stats['misses'] += 1
+
+    def _maybe_refresh(self, key, entry, refresh, *args):
+        """Schedules refresh on the reactor if entry needs refreshing. This
+        is safe to call from nextSlave functions, which run outside the
+        reactor thread."""
+        if self._is_fresh(entry) or key in self.inflight or \
+                self._is_failed(key):
+            return
+        reactor.callFromThread(self.start)
+        reactor.callFromThread(refresh, *args)
+
     def get_unallocated_slaves(self, available_slaves):
         """Filters available_slaves by the list of slaves not currently
         allocated to a jacuzzi.
 
-        This can return cached results.
+        This only uses the in-memory snapshot. Returns None if the snapshot
+        isn't usable because the service can't be reached, and an empty
+        list if the snapshot is still being fetched.
         """
         if not self.jacuzzi_enabled:
             return available_slaves
 
-        self.log("checking cache allocated slaves")
-        if self.allocated_cache:
-            cache_expiry_time, slaves = self.allocated_cache
-            if cache_expiry_time > time.time():
-                # TODO: This could get spammy
-                self.log("fresh cache: %s" % slaves)
-                return [s for s in available_slaves if s.slave.slavename not in slaves]
-            else:
-                self.log("expired cache")
+        entry = self.allocated_cache
+        if self.BULK_FETCH:
+            key, refresh = self.BULK, self.refresh_bulk
         else:
-            self.log("cache miss")
-
-        url = "%s/allocated/all" % self.BASE_URL
-        self.log("fetching %s" % url)
-        data = json.load(urllib2.urlopen(url, timeout=self.HTTP_TIMEOUT))
-        slaves = set(data['machines'])  # use sets for moar speed!
-        # TODO: This could get spammy
-        self.log("already allocated: %s" % slaves)
-        self.allocated_cache = (time.time() + self.CACHE_MAXAGE, slaves)
-        return [s for s in available_slaves if s.slave.slavename not in slaves]
+            key, refresh = self.ALLOCATED, self.refresh_allocated
+        self._maybe_refresh(key, entry, refresh)
+        if not self._is_usable(entry):
+            if self._is_failed(key):
+                return None
+            return []
+        return self._filter(available_slaves, lambda names: names - entry[1])
 
     def get_slaves(self, buildername, available_slaves):
         """Returns which slaves are suitable for building this builder
 
+        This only uses the in-memory snapshot; see the class docstring.
+
         Args:
             buildername (str): which builder to get slaves for
             available_slaves (list of buildbot Slave objects): slaves that are
                 currently available on this master
 
         Returns:
-            None if no slaves are suitable for building this builder, otherwise
-            returns a list of slaves to use
+            None if we don't know which slaves are suitable for building this
+            builder, otherwise returns a list of slaves to use
         """
         if not self.jacuzzi_enabled:
             return available_slaves
 
-        # Check the cache for this builder
-        self.log("checking cache for builder %s" % str(buildername))
-        c = self.cache.get(buildername)
-        if c:
-            cache_expiry_time, slaves = c
-            # If the cache is still fresh, use the builder's allocated slaves
-            # to filter our list of available slaves
-            if cache_expiry_time > time.time():
-                self.log("cache hit")
-                # TODO: This could get spammy
-                self.log("fresh cache: %s" % slaves)
-                if slaves:
-                    return [s for s in available_slaves if s.slave.slavename in slaves]
-                return None
-            else:
-                self.log("expired cache")
+        self.buildernames.add(buildername)
+        if self.BULK_FETCH:
+            snapshot = self.allocated_cache
+            self._count(snapshot)
+            self._maybe_refresh(self.BULK, snapshot, self.refresh_bulk)
+            if not self._is_usable(snapshot):
+                if self._is_failed(self.BULK):
+                    return None
+                # Wait for the first fetch to finish
+                return []
+            # Builders missing from the snapshot aren't allocated
+            entry = self.cache.get(buildername, (snapshot[0], None))
         else:
-            self.log("cache miss")
-
-        url = "%s/builders/%s" % (self.BASE_URL, urllib2.quote(buildername, ""))
-        for i in range(self.MAX_TRIES):
-            try:
-                if self.missing_cache.get(buildername, 0) > time.time():
-                    self.log("skipping %s since we 404'ed last time" % url)
-                    # Use unallocted slaves instead
-                    return self.get_unallocated_slaves(available_slaves)
-
-                self.log("fetching %s" % url)
-                data = json.load(urllib2.urlopen(url, timeout=self.HTTP_TIMEOUT))
-                slaves = set(data['machines'])  # use sets for moar speed!
-                # TODO: This could get spammy
-                self.log("slaves: %s" % slaves)
-                self.cache[buildername] = (time.time() + self.CACHE_MAXAGE, slaves)
-                # Filter the list of available slaves by the set the service
-                # returned to us
-                return [s for s in available_slaves if s.slave.slavename in slaves]
-            except urllib2.HTTPError, e:
-                # We couldn't find an allocation for this builder
-                # Fetch the list of all allocated slaves, and filter them out
-                # of our list of available slaves
-                if e.code == 404:
-                    try:
-                        slaves = self.get_unallocated_slaves(available_slaves)
-                        self.log("slaves: %s" % [s.slave.slavename for s in slaves])
-                        # We hit a 404 error, so we should remember
-                        # this for next time. We'll avoid doing the
-                        # per-builder lookup for CACHE_MAXAGE seconds, and
-                        # fall back to looking at all the allocated slaves
-                        self.log("remembering 404 result for %s seconds" % self.CACHE_MAXAGE)
-                        self.missing_cache[buildername] = time.time() + self.CACHE_MAXAGE
-                        return slaves
-                    except Exception:
-                        self.log("unhandled exception getting unallocated slaves", exc_info=True)
-                else:
-                    self.log("unhandled http error %s" % e.code, exc_info=True)
-            except Exception:
-                # Ignore other exceptions for now
-                self.log("unhandled exception", exc_info=True)
-
-            if i < self.MAX_TRIES:
-                self.log("try %i/%i; sleeping %i and trying again" % (i + 1, self.MAX_TRIES, self.SLEEP_TIME))
-                time.sleep(self.SLEEP_TIME)
-
-        # We couldn't get a good answer. Cache the failure so we're not
-        # hammering the service all the time, and then return None
-        self.log("gave up, returning None")
-        self.cache[buildername] = (time.time() + self.CACHE_FAIL_MAXAGE, None)
-        return None
+            entry = self.cache.get(buildername)
+            self._count(entry)
+            self._maybe_refresh(buildername, entry, self.refresh_builder,
+                                buildername)
+            if not self._is_usable(entry):
+                if self._is_failed(buildername):
+                    return None
+                # Wait for the first fetch to finish
+                return []
+
+        slaves = entry[1]
+        if slaves is None:
+            # Not allocated; use unallocated slaves instead
+            return self.get_unallocated_slaves(available_slaves)
+        return self._filter(available_slaves, lambda names: names & slaves)
+
+    def _filter(self, available_slaves, choose):
+        """Returns the slaves in available_slaves, in order, whose names are
+        in choose(set of their names)"""
+        names = choose(set(s.slave.slavename for s in available_slaves))
+        if not names:
+            return []
+        if len(names) == len(available_slaves):
+            return list(available_slaves)
+        return [s for s in available_slaves if s.slave.slavename in names]
 
     def __call__(self, func):
         """
@@ -460,6 +813,8 @@ class JacuzziAllocator(object):
         """
         @wraps(func)
         def _nextSlave(builder, available_slaves):
+            if self.botmaster is None:
+                self.botmaster = getattr(builder, 'botmaster', None)
             my_available_slaves = self.get_slaves(builder.name, available_slaves)
             # Something went wrong; fallback to using any available machine
             if my_available_slaves is None:
@@ -467,57 +822,252 @@ class JacuzziAllocator(object):
             return func(builder, my_available_slaves)
         return _nextSlave
 
+# A new allocator is made each time this module is loaded, so the previous
+# one's refresher needs stopping
+try:
+    J.stop()
+except NameError:
+    pass
 J = JacuzziAllocator()
 
 
-def _get_pending(builder):
-    """Returns the pending build requests for this builder"""
-    frame = inspect.currentframe()
-    # Walk up the stack until we find 't', a db transaction object. It allows
-    # us to make synchronous calls to the db from this thread.
-    # We need to commit this horrible crime because
-    # a) we're running in a thread
-    # b) so we can't use the db's existing sync query methods since they use a
-    # db connection created in another thread
-    # c) nor can we use deferreds (threads and deferreds don't play well
-    # together)
-    # d) there's no other way to get a db connection
-    while 't' not in frame.f_locals:
-        frame = frame.f_back
-    t = frame.f_locals['t']
-    del frame
+class PendingRequestTracker(object):
+    """Tracks the submit times of pending build requests for each builder
 
-    return builder._getBuildable(t, None)
+    The tracker subscribes to each builder's status the first time it's asked
+    about, and keeps a heap of submit times up to date from requestSubmitted
+    and requestCancelled events, so the oldest pending request is available
+    without touching the db. The heap is only changed on the reactor, which
+    also keeps the oldest submit time up to date for nextSlave functions to
+    read from db threads.
+
+    We can't see which requests a build claimed, nor claims made by other
+    masters, so the pending requests are re-read from the db on the reactor
+    after every buildStarted, and every RESYNC_INTERVAL seconds. Lookups keep
+    using the previous state until that finishes. A builder's first read
+    seeds it with the requests that were already pending, and pokes the
+    botmaster so that anything that was waiting on it gets another look.
+    """
+    RESYNC_INTERVAL = 60
+
+    def __init__(self):
+        # builder name -> dict of builder_status, heap of (submittedAt, id),
+        # live {id: submittedAt}, oldest live submittedAt, time of last
+        # resync, and resync flags
+        self.builders = {}
+
+    def _getState(self, builder):
+        builder_status = builder.builder_status
+        state = self.builders.get(builder.name)
+        if state and state['builder_status'] is builder_status:
+            return state
+
+        if state:
+            # The builder was reconfigured with a new status object. Its
+            # pending requests haven't changed, so keep them until the
+            # resync finishes.
+            state['builder_status'].unsubscribe(self)
+            state = dict(state, builder_status=builder_status, dirty=True,
+                         syncing=False)
+        else:
+            state = dict(
+                builder_status=builder_status,
+                heap=[],
+                oldest=None,
+                live={},
+                synced=None,
+                dirty=True,
+                syncing=False,
+            )
+        self.builders[builder.name] = state
+        builder_status.subscribe(self)
+        return state
+
+    def _add(self, state, reqid, submittedAt):
+        state['live'][reqid] = submittedAt
+        heapq.heappush(state['heap'], (submittedAt, reqid))
+        self._prune(state)
+
+    def _prune(self, state):
+        """Drops cancelled and claimed requests from the top of the heap,
+        and updates the oldest submit time. Must be called on the
+        reactor."""
+        heap = state['heap']
+        live = state['live']
+        while heap and heap[0][1] not in live:
+            heapq.heappop(heap)
+        if heap:
+            state['oldest'] = heap[0][0]
+        else:
+            state['oldest'] = None
+
+    def _resync(self, builder, state):
+        """Re-reads the pending requests for builder from the db. Must be
+        called on the reactor."""
+        if state['syncing']:
+            return
+        state['syncing'] = True
+        state['dirty'] = False
+
+        def cb(requests):
+            seeded = state['synced'] is None
+            heap = [(r.submittedAt, r.id) for r in requests]
+            heapq.heapify(heap)
+            state['live'] = dict((reqid, t) for (t, reqid) in heap)
+            state['heap'] = heap
+            self._prune(state)
+            state['synced'] = now()
+            botmaster = getattr(builder, 'botmaster', None)
+            if seeded and heap and botmaster is not None:
+                botmaster.maybeStartAllBuilds()
+
+        def eb(failure):
+            log.msg("PendingRequestTracker: couldn't get pending requests "
+                    "for %s" % builder.name)
+            log.err(failure)
+            state['dirty'] = True
+
+        def done(_):
+            state['syncing'] = False
+
+        d = builder.db.runInteraction(builder._getBuildable, None)
+        d.addCallbacks(cb, eb)
+        d.addBoth(done)
+        return d
+
+    def getOldestSubmitTime(self, builder):
+        """Returns the submit time of the oldest pending request for
+        builder, or None if there aren't any pending requests we know of,
+        e.g. because the builder hasn't been seeded from the db yet.
+
+        This is safe to call from nextSlave functions."""
+        state = self._getState(builder)
+        if state['dirty'] or state['synced'] is None or \
+                state['synced'] + self.RESYNC_INTERVAL < now():
+            reactor.callFromThread(self._resync, builder, state)
+
+        return state['oldest']
+
+    def unsubscribeAll(self):
+        """Unsubscribes from every builder's status and forgets the pending
+        requests"""
+        for state in self.builders.values():
+            state['builder_status'].unsubscribe(self)
+        self.builders = {}
+
+    # IStatusReceiver methods for BuilderStatus subscriptions
+    def builderChangedState(self, builderName, state):
+        pass
+
+    def requestSubmitted(self, request):
+        state = self.builders.get(request.getBuilderName())
+        if state:
+            self._add(state, request.brid, request.getSubmitTime())
+
+    def requestCancelled(self, builder, request):
+        state = self.builders.get(builder.getName())
+        if state:
+            state['live'].pop(request.brid, None)
+            self._prune(state)
+
+    def buildStarted(self, builderName, build):
+        state = self.builders.get(builderName)
+        if state:
+            state['dirty'] = True
+
+    def buildFinished(self, builderName, build, results):
+        pass
+
+try:
+    _pending.unsubscribeAll()
+except NameError:
+    pass
+_pending = PendingRequestTracker()
 
 
 def is_spot(name):
     return "-spot-" in name
 
 
-def _classifyAWSSlaves(slaves):
+class SlaveClassifier(object):
+    """Classifies slaves as inhouse, ondemand or spot according to their name
+
+    rules is a list of (matcher, class) pairs, checked in order. A matcher is
+    either a regular expression (a string or compiled pattern), which matches
+    if it's found anywhere in the slavename, or a callable taking the
+    slavename and returning True if it matches. Slaves that don't match any
+    rule are classified as default.
+
+    Classifications are cached by slavename, since the slave pool rarely
+    changes. The cache is dropped whenever the rules are changed with
+    setRules, or by calling invalidate.
+    """
+    CLASSES = ('inhouse', 'ondemand', 'spot')
+    DEFAULT_RULES = [
+        (is_spot, 'spot'),
+        ('ec2', 'ondemand'),
+    ]
+
+    def __init__(self, rules=None, default='inhouse'):
+        self.default = default
+        self.setRules(rules or self.DEFAULT_RULES)
+
+    def setRules(self, rules):
+        matchers = []
+        for matcher, klass in rules:
+            assert klass in self.CLASSES, "Unknown slave class %s" % klass
+            if isinstance(matcher, basestring):
+                matcher = re.compile(matcher)
+            if not callable(matcher):
+                matcher = matcher.search
+            matchers.append((matcher, klass))
+        self.rules = matchers
+        self.invalidate()
+
+    def invalidate(self):
+        # slavename -> class
+        self.cache = {}
+
+    def classify(self, slavename):
+        klass = self.cache.get(slavename)
+        if klass is None:
+            klass = self.default
+            for matcher, k in self.rules:
+                if matcher(slavename):
+                    klass = k
+                    break
+            self.cache[slavename] = klass
+        return klass
+
+    def partition(self, slaves):
+        """
+        Partitions slaves into three groups: inhouse, ondemand, spot. Slaves
+        that aren't connected are skipped. Returns three lists:
+            inhouse, ondemand, spot
+        """
+        buckets = dict((k, []) for k in self.CLASSES)
+        cache = self.cache
+        for s in slaves:
+            if not s.slave:
+                continue
+            name = s.slave.slavename
+            klass = cache.get(name) or self.classify(name)
+            buckets[klass].append(s)
+        return buckets['inhouse'], buckets['ondemand'], buckets['spot']
+
+_slaveClassifier = SlaveClassifier()
+
+
+def _classifyAWSSlaves(slaves, classifier=None):
     """
     Partitions slaves into three groups: inhouse, ondemand, spot according to
     their name. Returns three lists:
         inhouse, ondemand, spot
     """
-    inhouse = []
-    ondemand = []
-    spot = []
-    for s in slaves:
-        if not s.slave:
-            continue
-        name = s.slave.slavename
-        if is_spot(name):
-            spot.append(s)
-        elif 'ec2' in name:
-            ondemand.append(s)
-        else:
-            inhouse.append(s)
+    return (classifier or _slaveClassifier).partition(slaves)
 
-    return inhouse, ondemand, spot
 
-
-def _nextAWSSlave(aws_wait=None, recentSort=False):
+def _nextAWSSlave(aws_wait=None, recentSort=False, classifier=None):
     """
     Returns a nextSlave function that pick the next available slave, with some
     special consideration for AWS instances:
@@ -530,6 +1080,9 @@ def _nextAWSSlave(aws_wait=None, recentSort=False):
     If recentSort is True then pick slaves that most recently did this type of
     build. Otherwise pick randomly.
 
+    classifier is the SlaveClassifier used to tell inhouse, ondemand and spot
+    slaves apart. It defaults to one using the standard naming rules.
+
     """
     log.msg("nextAWSSlave: start")
 
@@ -537,7 +1090,7 @@ def _nextAWSSlave(aws_wait=None, recentSort=False):
         def sorter(slaves, builder):
             if not slaves:
                 return None
-            return sorted(slaves, _recentSort(builder))[-1]
+            return _lastSuccess.pickMostRecent(builder, slaves)
     else:
         def sorter(slaves, builder):
             if not slaves:
@@ -556,27 +1109,25 @@ def _nextAWSSlave(aws_wait=None, recentSort=False):
         if not available_slaves:
             return None
 
-        inhouse, ondemand, spot = _classifyAWSSlaves(available_slaves)
+        inhouse, ondemand, spot = _classifyAWSSlaves(available_slaves,
+                                                     classifier)
 
         # Always prefer inhouse slaves
         if inhouse:
             log.msg("nextAWSSlave: Choosing inhouse because it's the best!")
             return sorter(inhouse, builder)
 
-        # We need to look at our build requests if we need to know # of
-        # retries, or if we're going to be waiting for an inhouse slave to come
-        # online.
-        if aws_wait or spot:
-            requests = _get_pending(builder)
-            if requests:
-                oldestRequestTime = sorted(requests, key=lambda r:
-                                           r.submittedAt)[0].submittedAt
-            else:
-                oldestRequestTime = 0
-
-        if aws_wait and now() - oldestRequestTime < aws_wait:
-            log.msg("nextAWSSlave: Waiting for inhouse slaves to show up")
-            return None
+        # We need to look at our build requests if we're going to be waiting
+        # for an inhouse slave to come online.
+        if aws_wait:
+            oldestRequestTime = _pending.getOldestSubmitTime(builder)
+            # We're only asked when there's a request to run, so if we don't
+            # know about any, it's one we haven't heard about yet
+            if oldestRequestTime is None:
+                oldestRequestTime = now()
+            if now() - oldestRequestTime < aws_wait:
+                log.msg("nextAWSSlave: Waiting for inhouse slaves to show up")
+                return None
 
         if spot:
             log.msg("nextAWSSlave: Choosing spot since there aren't any retries")
@@ -597,7 +1148,7 @@ _nextAWSSlave_nowait = safeNextSlave(_nextAWSSlave())
 def _nextSlave(builder, available_slaves):
     # Choose the slave that was most recently on this builder
     if available_slaves:
-        return sorted(available_slaves, _recentSort(builder))[-1]
+        return _lastSuccess.pickMostRecent(builder, available_slaves)
     else:
         return None
 
@@ -610,18 +1161,244 @@ def _nextIdleSlave(nReserved):
     def _nextslave(builder, available_slaves):
         if len(available_slaves) <= nReserved:
             return None
-        return sorted(available_slaves, _recentSort(builder))[-1]
+        return _lastSuccess.pickMostRecent(builder, available_slaves)
     return _nextslave
 
+
+class SlaveAssignmentPlanner(object):
+    """Plans which idle slave each builder with pending requests should get
+
+    nextSlave functions choose greedily for one builder at a time, so builders
+    fight over the same inhouse slaves. The planner looks at every builder
+    that uses it and has pending requests, oldest request first, and gives
+    each one an idle slave. It prefers inhouse over spot over ondemand
+    slaves, then slaves that fewer of the other builders could use, then the
+    slave that most recently built on the builder. Candidates are filtered
+    through the jacuzzi allocator first.
+
+    The plan is computed the first time it's needed and reused for
+    PLAN_MAXAGE seconds, which covers one botmaster loop over the builders.
+
+    The instance is meant to be used as a decorator for nextSlave functions.
+    The wrapped function is only used when the planned slave isn't available,
+    and then only sees slaves that haven't been planned for other builders.
+    e.g.
+    >>> P = SlaveAssignmentPlanner(J, _slaveClassifier, _pending, _lastSuccess)
+    >>> builder['nextSlave'] = P(J(my_next_slave_func))
+    """
+    PLAN_MAXAGE = 5
+    CLASS_RANK = {'inhouse': 0, 'spot': 1, 'ondemand': 2}
+
+    def __init__(self, allocator, classifier, pending, lastSuccess):
+        # JacuzziAllocator, or None to not filter by jacuzzi
+        self.allocator = allocator
+        self.classifier = classifier
+        self.pending = pending
+        self.lastSuccess = lastSuccess
+
+        # builder name -> builder, for builders using this planner
+        self.builders = {}
+
+        # (timestamp, {builder name: slavename or None}, set of slavenames)
+        self.plan = None
+
+    def _getCandidates(self, builder):
+        available = [sb for sb in builder.slaves
+                     if sb.slave and sb.isAvailable()]
+        if self.allocator and available:
+            allowed = self.allocator.get_slaves(builder.name, available)
+            if allowed is not None:
+                available = allowed
+        return available
+
+    def makePlan(self):
+        """Computes which slave each builder with pending requests should
+        get"""
+        pending = []
+        for name, builder in self.builders.items():
+            oldest = self.pending.getOldestSubmitTime(builder)
+            if oldest is None:
+                continue
+            candidates = self._getCandidates(builder)
+            if candidates:
+                pending.append((oldest, name, builder, candidates))
+        # Oldest requests get first pick
+        pending.sort(key=lambda p: (p[0], p[1]))
+
+        # How many builders could use each slave
+        demand = collections.defaultdict(int)
+        for oldest, name, builder, candidates in pending:
+            for sb in candidates:
+                demand[sb.slave.slavename] += 1
+
+        assignments = {}
+        taken = set()
+        for oldest, name, builder, candidates in pending:
+            best = None
+            best_key = None
+            for sb in candidates:
+                slavename = sb.slave.slavename
+                if slavename in taken:
+                    continue
+                lastTime = self.lastSuccess.getLastTime(builder, slavename)
+                key = (self.CLASS_RANK[self.classifier.classify(slavename)],
+                       demand[slavename],
+                       -(lastTime or 0))
+                if best is None or key < best_key:
+                    best = slavename
+                    best_key = key
+            assignments[name] = best
+            if best is not None:
+                taken.add(best)
+
+        self.plan = (time.time(), assignments, taken)
+        return self.plan
+
+    def getPlan(self):
+        if self.plan is None or \
+                self.plan[0] + self.PLAN_MAXAGE < time.time():
+            return self.makePlan()
+        return self.plan
+
+    def __call__(self, func):
+        @wraps(func)
+        def _nextSlave(builder, available_slaves):
+            if self.builders.get(builder.name) is not builder:
+                # New or reconfigured builder; it needs to be in the plan
+                self.builders[builder.name] = builder
+                self.plan = None
+
+            timestamp, assignments, taken = self.getPlan()
+            slavename = assignments.get(builder.name)
+            if slavename is not None:
+                for s in available_slaves:
+                    if s.slave.slavename == slavename:
+                        return s
+
+            # The planned slave has been used already, or this builder
+            # wasn't in the plan. Don't take slaves planned for other builders.
+            others = taken - set([slavename])
+            return func(builder, [s for s in available_slaves
+                                  if s.slave.slavename not in others])
+        return _nextSlave
+
+P = SlaveAssignmentPlanner(J, _slaveClassifier, _pending, _lastSuccess)
+_nextAWSSlave_planned = safeNextSlave(
+    P(J(_nextAWSSlave(aws_wait=0, recentSort=True))))
+
+
 # Globals for mergeRequests
 nomergeBuilders = set()
 # Default to max of 3 merged requests.
 builderMergeLimits = collections.defaultdict(lambda: 3)
-# For tracking state in mergeRequests below
+# Set to True to log every mergeRequests decision, not just merges
+verboseMerging = False
+# State of the most recent mergeRequests decision, for debugging. The real
+# state is kept per builder by MergePolicy.
 _mergeCount = 0
 _mergeId = None
 
 
+class MergePolicy(object):
+    """Decides whether pairs of build requests can be merged
+
+    Merge counts are kept per builder, keyed by the id of the request being
+    merged into (req1), so decisions for different builders can interleave.
+    Whether each request may be merged at all (self-serve requests and
+    nightly builds may not) is worked out once and cached. Builders' limits
+    are looked up every time, since a reconfig can change them in place.
+
+    Each considered pair is only logged if verbose is set; actual merges are
+    always logged.
+
+    Args:
+        nomergeBuilders (set): names of builders that never merge requests
+        builderMergeLimits (dict): builder name -> maximum number of requests
+            to merge into one build
+        verbose (bool, optional): log every decision, defaults to False
+    """
+    # Maximum number of requests to cache mergeability for
+    MAX_CACHED_REQUESTS = 10000
+
+    def __init__(self, nomergeBuilders, builderMergeLimits, verbose=False):
+        self.nomergeBuilders = nomergeBuilders
+        self.builderMergeLimits = builderMergeLimits
+        self.verbose = verbose
+
+        # builder name -> [req1 id, number of requests merged into it]
+        self.counts = {}
+        # request id -> whether the request may be merged
+        self.mergeable = {}
+
+    def log(self, msg):
+        if self.verbose:
+            log.msg("mergeRequests: %s" % msg)
+
+    def getLimit(self, builder):
+        """Returns builder's merge limit, or 0 if it never merges"""
+        if builder.name in self.nomergeBuilders:
+            return 0
+        return self.builderMergeLimits[builder.name]
+
+    def isMergeable(self, req):
+        mergeable = self.mergeable.get(req.id)
+        if mergeable is None:
+            # A build explicitly requested on a revision via self-serve
+            # shouldn't be coalesced, and nor should nightly jobs
+            mergeable = 'Self-serve' not in req.reason and \
+                not req.properties.getProperty('nightly_build', False)
+            if len(self.mergeable) >= self.MAX_CACHED_REQUESTS:
+                self.mergeable.clear()
+            self.mergeable[req.id] = mergeable
+        return mergeable
+
+    def getCount(self, builder, req1):
+        """Returns the number of requests merged into req1 so far"""
+        state = self.counts.get(builder.name)
+        if state is None or state[0] != req1.id:
+            # We're merging a different request now; reset the state
+            # This works because buildbot calls this function with the same
+            # req1 for all pending requests for the builder, only req2 varies
+            # between calls. Once req1 changes we know we're in the middle of
+            # creating a different build.
+            # Start counting at 1 here, since if we're being called, we've
+            # already got 2 requests we're considering merging.
+            state = [req1.id, 1]
+            self.counts[builder.name] = state
+            self.log("%s: different r1 id; resetting state" % builder.name)
+        return state[1]
+
+    def __call__(self, builder, req1, req2):
+        # If the requests are fundamentally unmergeable, get that done first
+        if not req1.canBeMergedWith(req2):
+            # The requests are inherently unmergeable; e.g. on different
+            # branches
+            return False
+
+        self.log("considering %s %s %s" % (builder.name, req1.id, req2.id))
+        limit = self.getLimit(builder)
+        if limit == 0:
+            self.log("in nomergeBuilders; returning False")
+            return False
+
+        if not self.isMergeable(req1) or not self.isMergeable(req2):
+            self.log("self-serve or nightly_build; returning False")
+            return False
+
+        count = self.getCount(builder, req1)
+        if count >= limit:
+            # This request has already been merged with too many requests
+            self.log("%s: exceeded limit (%i)" % (builder.name, limit))
+            return False
+
+        log.msg("mergeRequests: %s merging %i %i" %
+                (builder.name, req1.id, req2.id))
+        self.counts[builder.name][1] = count + 1
+        return True
+
+_mergePolicy = None
+
+
 def mergeRequests(builder, req1, req2):
     """
     Returns True if req1 and req2 are mergeable requests, False otherwise.
@@ -629,6 +1406,10 @@ def mergeRequests(builder, req1, req2):
     This is called by buildbot to determine if pairs of buildrequests can be
     merged together for a build.
 
+    The decision is made by a MergePolicy for the current nomergeBuilders
+    and builderMergeLimits; a new policy is made if either is replaced. Set
+    verboseMerging to log every decision.
+
     Args:
         builder (buildbot builder object): which builder is being considered
         req1 (buildbot request object): first request being considered.
@@ -637,52 +1418,20 @@ def mergeRequests(builder, req1, req2):
             This changes as the buildbot master considers all pending requests
             for the build.
     """
-    global _mergeCount, _mergeId
-
-    # If the requests are fundamentally unmergeable, get that done first
-    if not req1.canBeMergedWith(req2):
-        # The requests are inherently unmergeable; e.g. on different branches
-        # Don't log this; it would be spammy
-        return False
-
-    log.msg("mergeRequests: considering %s %s %s" % (builder.name, req1.id, req2.id))
-    # Merging is disallowed on these builders
-    if builder.name in nomergeBuilders:
-        log.msg("mergeRequests: in nomergeBuilders; returning False")
-        return False
-
-    if 'Self-serve' in req1.reason or 'Self-serve' in req2.reason:
-        # A build was explicitly requested on this revision, so don't coalesce
-        # it
-        log.msg("mergeRequests: self-serve; returning False")
-        return False
-
-    # Disable merging of nightly jobs
-    if req1.properties.getProperty('nightly_build', False) or req2.properties.getProperty('nightly_build', False):
-        log.msg("mergeRequests: nightly_build; returning False")
-        return False
+    global _mergePolicy, _mergeCount, _mergeId
 
-    # We're merging a different request now; reset the state
-    # This works because buildbot calls this function with the same req1 for
-    # all pending requests for the builder, only req2 varies between calls.
-    # Once req1 changes we know we're in the middle of creating a different
-    # build.
-    if req1.id != _mergeId:
-        # Start counting at 1 here, since if we're being called, we've already
-        # got 2 requests we're considering merging. If we pa
-        _mergeCount = 1
-        _mergeId = req1.id
-        log.msg("mergeRequests: different r1 id; resetting state")
-
-    if _mergeCount >= builderMergeLimits[builder.name]:
-        # This request has already been merged with too many requests
-        log.msg("mergeRequests: %s: exceeded limit (%i)" %
-                (builder.name, builderMergeLimits[builder.name]))
-        return False
+    policy = _mergePolicy
+    if policy is None or policy.nomergeBuilders is not nomergeBuilders or \
+            policy.builderMergeLimits is not builderMergeLimits:
+        policy = _mergePolicy = MergePolicy(nomergeBuilders,
+                                            builderMergeLimits)
+    policy.verbose = verboseMerging
 
-    log.msg("mergeRequests: %s merging %i %i" % (builder.name, req1.id, req2.id))
-    _mergeCount += 1
-    return True
+    result = policy(builder, req1, req2)
+    state = policy.counts.get(builder.name)
+    if state:
+        _mergeId, _mergeCount = state
+    return result
 
 
 def mergeBuildObjects(d1, d2):
@@ -695,6 +1444,244 @@ def mergeBuildObjects(d1, d2):
     return retval
 
 
+class _Uncacheable(Exception):
+    pass
+
+
+def _stableRepr(obj, _stack=()):
+    """Returns a repr of obj that doesn't depend on dict ordering or on
+    where objects live in memory, for use in cache keys. Raises _Uncacheable
+    for recursive structures."""
+    if id(obj) in _stack:
+        raise _Uncacheable("recursive object")
+    stack = _stack + (id(obj),)
+
+    if isinstance(obj, dict):
+        items = sorted("%s: %s" % (_stableRepr(k, stack), _stableRepr(v, stack))
+                       for k, v in obj.iteritems())
+        return "{%s}" % ", ".join(items)
+    if isinstance(obj, (set, frozenset)):
+        items = sorted(_stableRepr(i, stack) for i in obj)
+        return "set([%s])" % ", ".join(items)
+    if isinstance(obj, list):
+        return "[%s]" % ", ".join(_stableRepr(i, stack) for i in obj)
+    if isinstance(obj, tuple):
+        return "(%s,)" % ", ".join(_stableRepr(i, stack) for i in obj)
+    if isinstance(obj, types.CodeType):
+        return "<code %s %s:%i %r %s>" % (
+            obj.co_name, obj.co_filename, obj.co_firstlineno, obj.co_code,
+            _stableRepr(obj.co_consts, stack))
+    if isinstance(obj, types.FunctionType):
+        cells = [c.cell_contents for c in obj.func_closure or ()]
+        return "<function %s %s %s>" % (
+            _stableRepr(obj.func_code, stack),
+            _stableRepr(obj.func_defaults, stack), _stableRepr(cells, stack))
+    if isinstance(obj, (type, types.ClassType)):
+        return "<class %s.%s>" % (obj.__module__, obj.__name__)
+    r = repr(obj)
+    if ' at 0x' in r:
+        if not hasattr(obj, '__dict__'):
+            raise _Uncacheable(r)
+        return "<%s %s>" % (obj.__class__.__name__,
+                            _stableRepr(obj.__dict__, stack))
+    return r
+
+
+def _isLibraryFile(filename):
+    """Returns True if filename is part of the standard library or an
+    installed package"""
+    return filename.startswith(_LIBRARY_DIRS) or \
+        os.path.realpath(filename).startswith(_LIBRARY_DIRS)
+
+
+def _codeVersion():
+    """Returns the modification times of the modules that generate build
+    objects, and of any module that isn't part of the standard library or an
+    installed package (the master's config files, the tools checkout, ...),
+    so cached objects aren't reused once the code or config changes"""
+    retval = []
+    for name, module in sorted(sys.modules.items()):
+        if module is None:
+            continue
+        filename = getattr(module, '__file__', None)
+        if not filename:
+            continue
+        if not name.startswith(GENERATOR_MODULE_PREFIXES) and \
+                _isLibraryFile(filename):
+            continue
+        if filename.endswith(('.pyc', '.pyo')):
+            filename = filename[:-1]
+        try:
+            retval.append((name, os.path.getmtime(filename)))
+        except OSError:
+            retval.append((name, None))
+    return retval
+
+
+def _configVersion():
+    """Returns the contents of the config modules that generators read from
+    directly, and the directory they're run from, which generators use for
+    credentials paths"""
+    retval = [os.getcwd()]
+    for name in GENERATOR_CONFIG_MODULES:
+        module = sys.modules.get(name)
+        if module is None:
+            continue
+        retval.append((name, dict(
+            (k, v) for k, v in vars(module).iteritems()
+            if not k.startswith('_') and not isinstance(v, types.ModuleType))))
+    return retval
+
+
+def _copyValue(value):
+    """Copies the dicts, lists, sets and tuples in value, all the way down.
+    Other objects are shared."""
+    t = type(value)
+    if t is dict:
+        return dict((k, _copyValue(v)) for k, v in value.iteritems())
+    if t in (list, tuple):
+        return t(_copyValue(v) for v in value)
+    if t is set:
+        return set(value)
+    return value
+
+
+def _copyBuildObjects(objects):
+    """Copies what a generator returned, so callers can modify it without
+    changing the cached objects. Builder dicts are copied with _copyValue;
+    the schedulers, status targets and change sources are copied, along with
+    the dicts, lists and sets in their attributes. Factories are shared,
+    and interning them stops their steps being changed."""
+    retval = {}
+    for key, value in objects.iteritems():
+        if isinstance(value, list):
+            value = [_copyBuildObject(v) for v in value]
+        else:
+            value = _copyValue(value)
+        retval[key] = value
+    return retval
+
+
+def _copyBuildObject(obj):
+    if not hasattr(obj, '__dict__') or \
+            isinstance(obj, (type, types.ClassType, types.FunctionType,
+                             types.ModuleType)):
+        return _copyValue(obj)
+    obj = copy.copy(obj)
+    for name, value in obj.__dict__.items():
+        obj.__dict__[name] = _copyValue(value)
+    return obj
+
+# Modules whose changes invalidate cached build objects, even if they're
+# installed as packages
+GENERATOR_MODULE_PREFIXES = ('buildbotcustom', 'build.', 'release.',
+                             'mozilla_buildtools', 'util.')
+# Modules that generators read settings from, rather than being passed them,
+# e.g. the tuxedo credentials in BuildSlaves. Their contents are part of the
+# cache key.
+GENERATOR_CONFIG_MODULES = ('BuildSlaves',)
+# Directories of the standard library and installed packages, whose modules
+# aren't expected to change while the master is running
+_LIBRARY_DIRS = set([os.path.dirname(os.__file__)])
+for _plat_specific in (False, True):
+    for _standard_lib in (False, True):
+        _LIBRARY_DIRS.add(sysconfig.get_python_lib(
+            plat_specific=_plat_specific, standard_lib=_standard_lib))
+_LIBRARY_DIRS = tuple(set(os.path.join(f(d), '') for d in _LIBRARY_DIRS
+                          for f in (os.path.abspath, os.path.realpath)))
+# Set to False to always regenerate build objects
+cacheBuildObjects = True
+# List of (generator name, branch name, seconds taken, cache hit) for each
+# generator call since this module was loaded
+generatorTimings = []
+
+# Cache of generated objects. This lives across reloads of this module, so
+# that a reconfig can reuse the objects for branches that haven't changed.
+try:
+    _buildObjectsCache
+except NameError:
+    # key -> (build objects, names added to nomergeBuilders, items set in
+    # builderMergeLimits)
+    _buildObjectsCache = {}
+else:
+    # Drop objects that weren't used by the previous config load
+    for _key in _buildObjectsCache.keys():
+        if _key not in _usedBuildObjectsKeys:
+            del _buildObjectsCache[_key]
+# Keys used since this module was loaded
+_usedBuildObjectsKeys = set()
+# Shares identical steps and factories between the builders generated by this
+# config load
+_stepInterner = StepInterner()
+
+
+def internBuildObjects(objects):
+    """Shares identical factories, and identical steps, argument lists and
+    env dicts within them, between the builders in objects. The factories
+    must not be modified afterwards."""
+    return _stepInterner.internBuildObjects(objects)
+
+
+def cachedBuildObjects(func):
+    """Decorator for functions that generate build objects for a branch
+
+    Calls with the same arguments (compared by value, including secrets and
+    platform configs), the same generator code and the same config modules
+    (see _codeVersion and _configVersion) return copies of the previously
+    generated objects instead of generating them again. The
+    changes the generator made to nomergeBuilders and builderMergeLimits are
+    replayed, since those are the only side effects generators may have.
+
+    The factories in the generated objects are interned with
+    internBuildObjects().
+
+    The time each call takes is logged and recorded in generatorTimings.
+    """
+    @wraps(func)
+    def generate(*args, **kwargs):
+        start = time.time()
+        key = None
+        if cacheBuildObjects:
+            try:
+                key = hashlib.sha1(_stableRepr(
+                    (func.__module__, func.__name__, args, kwargs,
+                     _codeVersion(), _configVersion()))).hexdigest()
+            except _Uncacheable, e:
+                log.msg("%s: not caching: %s" % (func.__name__, e))
+
+        # Label timings with the first string argument, the branch name for
+        # most generators
+        branch = ([a for a in args if isinstance(a, basestring)] or [''])[0]
+        if key is not None:
+            _usedBuildObjectsKeys.add(key)
+        cached = key is not None and key in _buildObjectsCache
+        if cached:
+            objects, nomerge, limits = _buildObjectsCache[key]
+            nomergeBuilders.update(nomerge)
+            builderMergeLimits.update(limits)
+        else:
+            nomerge_before = set(nomergeBuilders)
+            limits_before = dict(builderMergeLimits)
+            objects = internBuildObjects(func(*args, **kwargs))
+            if key is not None:
+                nomerge = nomergeBuilders - nomerge_before
+                limits = dict((k, v) for k, v in builderMergeLimits.items()
+                              if limits_before.get(k) != v)
+                _buildObjectsCache[key] = (objects, nomerge, limits)
+
+        elapsed = time.time() - start
+        generatorTimings.append((func.__name__, branch, elapsed, cached))
+        log.msg("%s(%s): %.3fs%s" % (func.__name__, branch, elapsed,
+                                     " (cached)" if cached else ""))
+        if key is not None:
+            objects = _copyBuildObjects(objects)
+            if cached:
+                # Share with the objects generated by this config load
+                internBuildObjects(objects)
+        return objects
+    return generate
+
+
 def makeMHFactory(config, pf, mh_cfg=None, extra_args=None, **kwargs):
     factory_class = ScriptFactory
     if not mh_cfg:
@@ -1080,6 +2067,20 @@ def generateDesktopMozharnessBuilders(name, platform, config, secrets,
     return desktop_mh_builders
 
 
+def makePushNotifier(name, settings):
+    """Returns a PushNotifier for a branch's push_notifications settings, a
+    dict with a 'queuedir' path and/or a strports 'listen' description, and
+    optionally a 'checkInterval'"""
+    if not isinstance(settings, dict) or \
+            not (settings.get('queuedir') or settings.get('listen')):
+        raise ValueError("%s: push_notifications needs a queuedir or listen "
+                         "to get notifications from, not %r" % (name, settings))
+    return PushNotifier(queuedir=settings.get('queuedir'),
+                        listen=settings.get('listen'),
+                        checkInterval=settings.get('checkInterval', 1))
+
+
+@cachedBuildObjects
 def generateBranchObjects(config, name, secrets=None):
     """name is the name of branch which is usually the last part of the path
        to the repository. For example, 'mozilla-central', 'mozilla-aurora', or
@@ -1118,6 +2119,12 @@ def generateBranchObjects(config, name, secrets=None):
     l10nBuilders = {}
     l10nNightlyBuilders = {}
     pollInterval = config.get('pollInterval', 60)
+    pushNotifier = None
+    if config.get('push_notifications'):
+        pushNotifier = makePushNotifier(name, config['push_notifications'])
+        # The PushNotifier makes the poller poll as soon as there's a push, so
+        # regular polls are only needed to catch anything it misses
+        pollInterval = config.get('reconcileInterval', 10 * 60)
     l10nPollInterval = config.get('l10nPollInterval', 5 * 60)
 
     # We only understand a couple PGO strategies
@@ -1297,14 +2304,16 @@ def generateBranchObjects(config, name, secrets=None):
         repo_branch=repo_branch,
         pollInterval=pollInterval,
     ))
+    if pushNotifier is not None:
+        branchObjects['change_source'].append(pushNotifier)
 
     if config['enable_l10n'] and config['enable_l10n_onchange']:
         hg_all_locales_poller = HgAllLocalesPoller(hgURL=config['hgurl'],
                                                    repositoryIndex=config[
                                                    'l10n_repo_path'],
                                                    pollInterval=l10nPollInterval,
-                                                   branch=name)
-        hg_all_locales_poller.parallelRequests = 1
+                                                   branch=name,
+                                                   parallelRequests=config.get('l10n_parallel_requests', 1))
         branchObjects['change_source'].append(hg_all_locales_poller)
 
     # schedulers
@@ -1358,14 +2367,14 @@ def generateBranchObjects(config, name, secrets=None):
         for b in l10nBuilders:
             l10n_builders.append(l10nBuilders[b]['l10n_builder'])
         nomergeBuilders.update(l10n_builders)
+        l10n_modules = PathPrefixTrie(config['l10n_modules'])
         # This L10n scheduler triggers only the builders of its own branch
         branchObjects['schedulers'].append(Scheduler(
             name="%s l10n" % name,
             branch=config['l10n_repo_path'],
             treeStableTimer=None,
             builderNames=l10n_builders,
-            fileIsImportant=lambda c: isImportantL10nFile(
-                c, config['l10n_modules']),
+            fileIsImportant=lambda c: isImportantL10nFile(c, l10n_modules),
             properties={
                 'app': 'browser',
                 'en_revision': 'default',
@@ -2284,6 +3293,7 @@ def _makeGenerateMozharnessTalosBuilderArgs(suite, talos_branch, platform,
     }
     return args
 
+@cachedBuildObjects
 def generateTalosBranchObjects(branch, branch_config, PLATFORMS, SUITES,
                                ACTIVE_UNITTEST_PLATFORMS):
     branchObjects = {'schedulers': [], 'builders': [], 'status': [],
@@ -4,22 +4,203 @@
 #   Lukas Blakk <lsblakk@mozilla.com>
 import re
 import time
-from twisted.python import log
+import weakref
+from collections import OrderedDict
+
+from twisted.python import failure, log
 from twisted.internet import defer
-from twisted.web.client import getPage
 
 from buildbot.sourcestamp import SourceStamp
 
 import buildbotcustom.try_parser
-reload(buildbotcustom.try_parser)
+from buildbotcustom.reloader import reloadChanged
+reloadChanged(buildbotcustom.try_parser)
 
-from buildbotcustom.try_parser import TryParser
+from buildbotcustom.try_parser import CompiledTryParser
 from buildbotcustom.common import genBuildID, genBuildUID, incrementBuildID
+from buildbotcustom.httpclient import getPage
 
 from buildbot.process.properties import Properties
 from buildbot.util import json
 
 
+def _tryComments(push):
+    """Returns the description of the latest changeset in push that has try
+    syntax in it, or None"""
+    for change in reversed(push['changesets']):
+        if 'try:' in change['desc']:
+            return change['desc'].encode("utf8", "replace")
+    return None
+
+
+class TryPushCache(object):
+    """LRU cache of the try syntax for recent pushes to try, looked up by any
+    of their changesets.
+
+    tryChooser needs the push's comments for every change without try syntax
+    of its own, which means a json-pushes request per change. Changes from
+    the same push share one request, even if they're looked up while it's
+    still in flight, and the builders chosen for a push are kept with it so
+    that rescheduling it doesn't need the try syntax parsed again. Lookups
+    for other pushes don't wait for it."""
+    maxPushes = 500
+    pushURL = "https://hg.mozilla.org/try/json-pushes?full=1&changeset=%s"
+    # Seconds to wait for json-pushes
+    timeout = 60
+
+    def __init__(self, maxPushes=None):
+        if maxPushes is not None:
+            self.maxPushes = maxPushes
+        # push id -> {'comments': ..., 'revisions': [...], 'builders': {}}
+        self.pushes = OrderedDict()
+        # revision -> push id
+        self.revisions = {}
+        # revision -> Deferreds waiting for its push
+        self.inflight = {}
+        # push -> revision being fetched for it
+        self.inflightPushes = {}
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+    def getPush(self, revision, push=None):
+        """Returns a Deferred that fires with the cache entry for the push
+        containing revision. push identifies the push revision is thought to
+        be in, e.g. by its change's author and time; if that push is being
+        fetched already, revision waits to see if it's in it."""
+        entry = self.lookup(revision)
+        if entry is not None:
+            self.stats['hits'] += 1
+            return defer.succeed(entry)
+
+        if revision in self.inflight:
+            self.stats['coalesced'] += 1
+            return self.waitFor(revision)
+        if push is not None and push in self.inflightPushes:
+            self.stats['coalesced'] += 1
+            d = self.waitFor(self.inflightPushes[push])
+            d.addBoth(lambda _: self.lookupOrFetch(revision, push))
+            return d
+
+        self.stats['misses'] += 1
+        return self.fetch(revision, push)
+
+    def lookup(self, revision):
+        pushid = self.revisions.get(revision)
+        if pushid is None:
+            return None
+        entry = self.pushes.pop(pushid)
+        self.pushes[pushid] = entry
+        return entry
+
+    def lookupOrFetch(self, revision, push=None):
+        entry = self.lookup(revision)
+        if entry is not None:
+            return entry
+        if revision in self.inflight:
+            return self.waitFor(revision)
+        self.stats['misses'] += 1
+        return self.fetch(revision, push)
+
+    def waitFor(self, revision):
+        d = defer.Deferred()
+        self.inflight[revision].append(d)
+        return d
+
+    def fetch(self, revision, push=None):
+        self.inflight[revision] = []
+        if push is not None:
+            self.inflightPushes.setdefault(push, revision)
+        d = self.waitFor(revision)
+        fetch = getPage(str(self.pushURL % revision), timeout=self.timeout)
+        fetch.addCallback(self.gotPushes, revision)
+        fetch.addBoth(self.fetched, revision, push)
+        return d
+
+    def gotPushes(self, data, revision):
+        pushes = json.loads(data)
+        log.msg("Looking at the push json data for try comments")
+        entry = None
+        for pushid, push in pushes.items():
+            e = {
+                'comments': _tryComments(push),
+                'revisions': [c['node'] for c in push['changesets']],
+                'builders': {},
+            }
+            if entry is None and (len(pushes) == 1 or
+                                  [r for r in e['revisions']
+                                   if r.startswith(revision)]):
+                # revision might be abbreviated
+                if revision not in e['revisions']:
+                    e['revisions'].append(revision)
+                entry = e
+            self.add(pushid, e)
+        if entry is None:
+            # Not cached, so it's looked up again next time
+            entry = {'comments': None, 'revisions': [], 'builders': {}}
+        return entry
+
+    def add(self, pushid, entry):
+        if pushid in self.pushes:
+            self.remove(pushid)
+        self.pushes[pushid] = entry
+        for r in entry['revisions']:
+            self.revisions[r] = pushid
+        while len(self.pushes) > self.maxPushes:
+            self.remove(self.pushes.keys()[0])
+
+    def remove(self, pushid):
+        entry = self.pushes.pop(pushid)
+        for r in entry['revisions']:
+            if self.revisions.get(r) == pushid:
+                del self.revisions[r]
+
+    def fetched(self, result, revision, push=None):
+        if self.inflightPushes.get(push) == revision:
+            del self.inflightPushes[push]
+        for d in self.inflight.pop(revision):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        # Failures have been passed on to everybody waiting
+        return None
+
+    def getBuilders(self, entry, s):
+        """Returns the builders scheduler s chose for entry's push last
+        time, or None"""
+        cached = entry['builders'].get(id(s))
+        if cached is not None and cached[0]() is s:
+            return list(cached[1])
+        return None
+
+    def setBuilders(self, entry, s, builders):
+        entry['builders'][id(s)] = (weakref.ref(s), list(builders))
+
+
+# Kept across reloads
+try:
+    tryPushCache
+except NameError:
+    tryPushCache = TryPushCache()
+else:
+    # Made by an older version of this module
+    if not hasattr(tryPushCache, 'inflightPushes'):
+        tryPushCache = TryPushCache()
+
+
+def getTryParser(s):
+    """Returns the CompiledTryParser for scheduler s's builders, making it
+    the first time it's needed. A reconfig that changes them makes a new
+    scheduler, and so a new parser."""
+    parser = getattr(s, 'tryParser', None)
+    if parser is None:
+        parser = CompiledTryParser(
+            s.builderNames, s.prettyNames, s.unittestPrettyNames,
+            s.unittestSuites, s.talosSuites, s.buildbotBranch,
+            s.buildersWithSetsMap)
+        s.tryParser = parser
+    return parser
+
+
 def tryChooser(s, all_changes):
     log.msg("Looking at changes: %s" % all_changes)
 
@@ -27,26 +208,25 @@ def tryChooser(s, all_changes):
 
     dl = []
 
-    def getJSON(data):
-        push = json.loads(data)
-        log.msg("Looking at the push json data for try comments")
-        for p in push:
-            pd = push[p]
-            changes = pd['changesets']
-            for change in reversed(changes):
-                match = re.search("try:", change['desc'])
-                if match:
-                    return change['desc'].encode("utf8", "replace")
-
-    def parseData(comments, c):
+    def parseData(comments, c, entry=None):
+        if entry is not None:
+            builders = tryPushCache.getBuilders(entry, s)
+            if builders is not None:
+                log.msg("Using the builders already chosen for %s's push" %
+                        c.revision)
+                buildersPerChange[c] = builders
+                return
         if not comments:
             # still need to parse a comment string to get the default set
             log.msg("No comments, passing empty string which will result in default set")
             comments = ""
-        customBuilders = TryParser(
-            comments, s.builderNames, s.prettyNames, s.unittestPrettyNames,
-            s.unittestSuites, s.talosSuites, s.buildbotBranch, s.buildersWithSetsMap)
+        customBuilders = getTryParser(s).parse(comments)
         buildersPerChange[c] = customBuilders
+        if entry is not None:
+            tryPushCache.setBuilders(entry, s, customBuilders)
+
+    def parsePush(entry, c):
+        return parseData(entry['comments'], c, entry)
 
     def parseDataError(failure, c):
         log.msg(
@@ -55,23 +235,23 @@ def tryChooser(s, all_changes):
 
     for c in all_changes:
         try:
-            match = re.search("try", c.branch)
-            if not match:
+            if 'try' not in c.branch:
                 log.msg("Ignoring off-branch %s" % c.branch)
                 continue
             # Look in comments first for try: syntax
-            match = re.search("try:", c.comments)
-            if match:
+            if 'try:' in c.comments:
                 log.msg("Found try message in the change comments, ignoring push comments")
                 d = defer.succeed(c.comments)
-            # otherwise getPage from hg.m.o
+                d.addCallback(parseData, c)
+            # otherwise get the push's comments from hg.m.o
             else:
-                d = getPage(str("https://hg.mozilla.org/try/json-pushes?full=1&changeset=%s" % c.revision))
-                d.addCallback(getJSON)
+                # Changes from the same push share its author and time
+                d = tryPushCache.getPush(c.revision, (c.who, c.when))
+                d.addCallback(parsePush, c)
         except:
             log.msg("Error in all_changes loop: sending default try set")
             d = defer.succeed("")
-        d.addCallback(parseData, c)
+            d.addCallback(parseData, c)
         d.addErrback(parseDataError, c)
         dl.append(d)
     d = defer.DeferredList(dl)
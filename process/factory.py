@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 import os.path
 import re
+import types
 
 from twisted.python import log
 
@@ -29,18 +30,19 @@ import buildbotcustom.misc_scheduler
 import build.paths
 import release.info
 import release.paths
-reload(buildbotcustom.status.errors)
-reload(buildbotcustom.steps.base)
-reload(buildbotcustom.steps.misc)
-reload(buildbotcustom.steps.source)
-reload(buildbotcustom.steps.test)
-reload(buildbotcustom.steps.unittest)
-reload(buildbotcustom.steps.signing)
-reload(buildbotcustom.steps.mock)
-reload(buildbotcustom.env)
-reload(build.paths)
-reload(release.info)
-reload(release.paths)
+from buildbotcustom.reloader import reloadChanged
+reloadChanged(buildbotcustom.status.errors,
+              buildbotcustom.steps.base,
+              buildbotcustom.steps.misc,
+              buildbotcustom.steps.source,
+              buildbotcustom.steps.test,
+              buildbotcustom.steps.unittest,
+              buildbotcustom.steps.signing,
+              buildbotcustom.steps.mock,
+              buildbotcustom.env,
+              build.paths,
+              release.info,
+              release.paths)
 
 from buildbotcustom.status.errors import purge_error, global_errors, \
     upload_errors
@@ -326,6 +328,135 @@ class RequestSortingBuildFactory(BuildFactory):
             return BuildFactory.newBuild(self, requests)
 
 
+class FrozenList(list):
+    """A list that raises TypeError if it's modified. Copies of it are plain
+    lists."""
+    def _frozen(self, *args, **kwargs):
+        raise TypeError("this list is shared and can't be modified; "
+                        "copy it first")
+    append = extend = insert = remove = pop = reverse = sort = _frozen
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _frozen
+    __iadd__ = __imul__ = _frozen
+
+    def __reduce_ex__(self, protocol):
+        return (list, (list(self),))
+
+
+class StepInterner(object):
+    """Shares structurally identical step factories between build factories.
+
+    Thousands of builders end up with step lists that differ only in a few
+    arguments. internFactory() replaces each (step class, kwargs) tuple in a
+    factory's steps, and the argument lists, env dicts and WithProperties
+    inside them, with a single shared copy of anything equal that's been seen
+    before. Factories that are identical to one seen before are replaced by
+    it entirely.
+
+    Only plain dicts, lists, tuples and WithProperties are compared by value.
+    Functions without closures are compared by their code, and everything
+    else by identity. Interned objects are shared between builders, so they
+    must not be modified afterwards. Interned factories' steps are made a
+    FrozenList, so adding steps to them fails.
+    """
+    ATOMS = (str, unicode, int, long, float, bool, type(None))
+
+    def __init__(self):
+        # key -> canonical object
+        self.table = {}
+        # factory key -> canonical factory
+        self.factories = {}
+        # id(factory) -> (factory, canonical factory), for factories already
+        # interned
+        self.interned = {}
+        self.hits = 0
+        self.misses = 0
+        self._active = set()
+
+    def _internDict(self, d):
+        """Replaces the values of d with their interned versions, and returns
+        a key for its contents. d itself isn't entered in the table."""
+        items = []
+        for k, v in d.items():
+            k, kkey = self._intern(k)
+            v, vkey = self._intern(v)
+            d[k] = v
+            items.append((kkey, vkey))
+        return frozenset(items)
+
+    def _intern(self, value):
+        """Returns (canonical value, key)"""
+        t = type(value)
+        if t is types.InstanceType:
+            # Old-style classes, like buildbot's WithProperties
+            t = value.__class__
+        if t in self.ATOMS:
+            return value, (t, value)
+        if t is types.FunctionType and value.func_closure is None:
+            key = (t, id(value.func_code), id(value.func_globals),
+                   self._intern(value.func_defaults)[1])
+        elif t in (tuple, list, dict, WithProperties) and \
+                id(value) not in self._active:
+            ident = id(value)
+            self._active.add(ident)
+            try:
+                if t is dict:
+                    key = (t, self._internDict(value))
+                elif t is WithProperties:
+                    key = (t, self._internDict(value.__dict__))
+                else:
+                    items = [self._intern(v) for v in value]
+                    key = (t, tuple(k for v, k in items))
+                    items = [v for v, k in items]
+                    if t is list:
+                        value[:] = items
+                    elif [a for a, b in zip(items, value) if a is not b]:
+                        value = tuple(items)
+            finally:
+                self._active.discard(ident)
+        else:
+            return value, ('id', id(value))
+
+        canonical = self.table.get(key)
+        if canonical is None:
+            self.misses += 1
+            self.table[key] = value
+            return value, key
+        self.hits += 1
+        return canonical, key
+
+    def intern(self, value):
+        return self._intern(value)[0]
+
+    def internFactory(self, factory):
+        """Returns the canonical version of factory, interning its steps"""
+        if not isinstance(factory, BuildFactory):
+            return factory
+        if id(factory) in self.interned:
+            return self.interned[id(factory)][1]
+
+        steps = [self._intern(s) for s in factory.steps]
+        factory.steps = FrozenList(s for s, k in steps)
+        attrs = dict((name, value) for name, value in factory.__dict__.items()
+                     if name != 'steps')
+        key = (factory.__class__, self._internDict(attrs),
+               tuple(k for s, k in steps))
+        for name, value in attrs.items():
+            setattr(factory, name, value)
+
+        canonical = self.factories.setdefault(key, factory)
+        self.interned[id(factory)] = (factory, canonical)
+        self.interned[id(canonical)] = (canonical, canonical)
+        return canonical
+
+    def internBuildObjects(self, objects):
+        """Interns the factories of the builders in objects, as returned by
+        generateBranchObjects and friends"""
+        for builder in objects.get('builders', []):
+            if isinstance(builder, dict) and 'factory' in builder:
+                builder['factory'] = self.internFactory(builder['factory'])
+        return objects
+
+
 class MockMixin(object):
     warnOnFailure = True
     warnOnWarnings = True
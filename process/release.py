@@ -20,16 +20,15 @@ import release.paths
 import buildbotcustom.common
 import build.paths
 import release.info
-reload(release.platforms)
-reload(release.paths)
-reload(build.paths)
-reload(release.info)
+from buildbotcustom.reloader import reloadChanged
+reloadChanged(release.platforms, release.paths, build.paths, release.info)
 
 from buildbotcustom.status.mail import ChangeNotifier
+import buildbotcustom.misc
 from buildbotcustom.misc import (
     generateTestBuilderNames, generateTestBuilder, changeContainsProduct,
-    nomergeBuilders, changeContainsProperties,
-    changeContainsScriptRepoRevision, makeMHFactory)
+    changeContainsProperties,
+    changeContainsScriptRepoRevision, makeMHFactory, cachedBuildObjects)
 from buildbotcustom.common import normalizeName
 from buildbotcustom.process.factory import (
     ScriptFactory, SingleSourceFactory, ReleaseBuildFactory,
@@ -50,6 +49,7 @@ import BuildSlaves
 DEFAULT_PARALLELIZATION = 10
 
 
+@cachedBuildObjects
 def generateReleaseBranchObjects(releaseConfig, branchConfig,
                                  releaseConfigFile, sourceRepoKey="mozilla",
                                  secrets=None):
@@ -1777,8 +1777,9 @@ def generateReleaseBranchObjects(releaseConfig, branchConfig,
 
     builders.extend(test_builders)
 
-    # Don't merge release builder requests
-    nomergeBuilders.update([b['name'] for b in builders + test_builders])
+    # Don't merge release builder requests. nomergeBuilders isn't imported
+    # by name, since a reload of misc can replace it.
+    buildbotcustom.misc.nomergeBuilders.update([b['name'] for b in builders + test_builders])
 
     # Make sure all builders have our build number and version set
     for b in builders:
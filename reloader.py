@@ -0,0 +1,229 @@
+# Selective module reloading for reconfigs
+# Contributor(s):
+#   Chris AtLee <catlee@mozilla.com>
+"""Reload only the modules whose source has changed.
+
+master.cfg reloads our modules on every reconfig, and they in turn used to
+reload() everything they import. That re-executes all of process/factory.py
+and friends even when nothing changed. ReloadManager fingerprints each
+module's source file, and reloads a module only if its source changed, or if
+one of the modules it imports has been reloaded since (in which case it's
+holding on to stale classes and functions). Dependencies are reloaded before
+the modules that import them.
+
+This module is deliberately never reloaded itself, so the fingerprints
+survive across reconfigs.
+"""
+import ast
+import os
+import sys
+import time
+import types
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from twisted.python import log
+
+
+class ReloadManager(object):
+    def __init__(self):
+        # module name -> (mtime, size, sha1 of the source)
+        self.fingerprints = {}
+        # module name -> number of times we've reloaded it
+        self.generations = {}
+        # module name -> {dependency name: dependency's generation} as of
+        # when the module was last (re)loaded
+        self.dependencies = {}
+        # module name -> (sha1 of the source, names of imported modules)
+        self.imports = {}
+        # (module name, seconds) for each reload we've done
+        self.timings = []
+        self._reloading = set()
+
+    def sourceFile(self, module):
+        filename = getattr(module, '__file__', None)
+        if not filename:
+            return None
+        if filename.endswith('.pyc') or filename.endswith('.pyo'):
+            filename = filename[:-1]
+        if not os.path.exists(filename):
+            return None
+        return filename
+
+    def fingerprint(self, module):
+        """Returns (mtime, size, sha1) for module's source file, or None if
+        it has no source we can look at. The file is only read if its mtime
+        or size changed since we last looked."""
+        filename = self.sourceFile(module)
+        if filename is None:
+            return None
+        st = os.stat(filename)
+        old = self.fingerprints.get(module.__name__)
+        if old and old[:2] == (st.st_mtime, st.st_size):
+            return old
+        f = open(filename, 'rb')
+        try:
+            digest = sha1(f.read()).hexdigest()
+        finally:
+            f.close()
+        return (st.st_mtime, st.st_size, digest)
+
+    def importedNames(self, module):
+        """Returns the names of every module that module's source imports,
+        resolved against its package for implicit relative imports. Parsed
+        once per version of the source."""
+        name = module.__name__
+        fp = self.fingerprint(module)
+        if fp is None:
+            return set()
+        cached = self.imports.get(name)
+        if cached and cached[0] == fp[2]:
+            return cached[1]
+
+        if hasattr(module, '__path__'):
+            package = name
+        else:
+            package = name.rpartition('.')[0]
+        f = open(self.sourceFile(module), 'rb')
+        try:
+            tree = ast.parse(f.read())
+        finally:
+            f.close()
+
+        names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    names.add(alias.name)
+                    if package:
+                        names.add('%s.%s' % (package, alias.name))
+            elif isinstance(node, ast.ImportFrom):
+                if node.level:
+                    base = package.split('.')
+                    base = base[:len(base) - node.level + 1]
+                    base = [p for p in base + [node.module] if p]
+                    bases = ['.'.join(base)]
+                else:
+                    bases = [node.module]
+                    if package:
+                        bases.append('%s.%s' % (package, node.module))
+                for base in bases:
+                    names.add(base)
+                    for alias in node.names:
+                        names.add('%s.%s' % (base, alias.name))
+        self.imports[name] = (fp[2], names)
+        return names
+
+    def getDependencies(self, module):
+        """Returns the names of the tracked modules that module imports, or
+        otherwise refers to."""
+        deps = set(n for n in self.importedNames(module)
+                   if n in self.generations)
+        for value in module.__dict__.values():
+            if isinstance(value, types.ModuleType):
+                name = value.__name__
+            else:
+                name = getattr(value, '__module__', None)
+                if not isinstance(name, basestring):
+                    continue
+            if name in self.generations:
+                deps.add(name)
+        deps.discard(module.__name__)
+        return deps
+
+    def track(self, module):
+        """Records the current state of module, without reloading it"""
+        name = module.__name__
+        fp = self.fingerprint(module)
+        if fp is not None:
+            self.fingerprints[name] = fp
+        self.generations.setdefault(name, 0)
+        self.dependencies[name] = dict(
+            (dep, self.generations[dep])
+            for dep in self.getDependencies(module))
+
+    def sourceChanged(self, module):
+        old = self.fingerprints.get(module.__name__)
+        new = self.fingerprint(module)
+        if old is None or new is None:
+            return False
+        if old[2] == new[2]:
+            # Touched, but not modified; don't look at the file again
+            self.fingerprints[module.__name__] = new
+            return False
+        return True
+
+    def staleDependencies(self, module):
+        """Returns the names of module's dependencies that have been reloaded
+        since module was"""
+        seen = self.dependencies.get(module.__name__, {})
+        return sorted(dep for dep in self.getDependencies(module)
+                      if self.generations[dep] != seen.get(dep, 0))
+
+    def maybeReload(self, module):
+        """Reloads module if it, or any module it depends on, has changed.
+        Changed dependencies are reloaded first. Returns True if module was
+        reloaded."""
+        name = module.__name__
+        if name in self._reloading:
+            # We're being imported by one of our own dependencies, or are
+            # already in the middle of being reloaded
+            return False
+        if name not in self.generations:
+            # First time we've seen this module. It was imported some time
+            # during this process's life, which is as fresh as reload()
+            # would make it.
+            self.track(module)
+            return False
+
+        self._reloading.add(name)
+        try:
+            for dep in sorted(self.getDependencies(module)):
+                if sys.modules.get(dep) is not None:
+                    self.maybeReload(sys.modules[dep])
+
+            reasons = []
+            if self.sourceChanged(module):
+                reasons.append('source changed')
+            stale = self.staleDependencies(module)
+            if stale:
+                reasons.append('depends on %s' % ', '.join(stale))
+            if not reasons:
+                return False
+
+            start = time.time()
+            module = reload(module)
+            elapsed = time.time() - start
+        finally:
+            self._reloading.discard(name)
+
+        self.generations[name] += 1
+        self.track(module)
+        self.timings.append((name, elapsed))
+        log.msg("reloader: reloaded %s in %.3fs (%s)" %
+                (name, elapsed, '; '.join(reasons)))
+        return True
+
+    def reloadChanged(self, *modules):
+        """Reloads each of modules that needs it, in the order given"""
+        reloaded = []
+        for module in modules:
+            if self.maybeReload(module):
+                reloaded.append(module.__name__)
+        return reloaded
+
+
+# Keep our state if somebody does reload this module
+try:
+    _manager
+except NameError:
+    _manager = ReloadManager()
+
+
+def reloadChanged(*modules):
+    """Reloads each of modules whose source, or whose dependencies' source,
+    has changed since it was last loaded"""
+    return _manager.reloadChanged(*modules)
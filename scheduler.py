@@ -6,7 +6,6 @@
 from twisted.internet import defer, reactor
 from twisted.python import log
 from twisted.internet.task import LoopingCall
-from twisted.web.client import getPage
 
 from buildbot.scheduler import Scheduler
 from buildbot.schedulers.base import BaseScheduler
@@ -19,7 +18,9 @@ from buildbot.status.builder import SUCCESS, WARNINGS
 from buildbot.util import now
 
 import util.tuxedo
-reload(util.tuxedo)
+from buildbotcustom.reloader import reloadChanged
+from buildbotcustom.httpclient import getPage
+reloadChanged(util.tuxedo)
 from util.tuxedo import get_release_uptake
 
 import time
@@ -123,6 +124,8 @@ class BuilderChooserScheduler(Scheduler):
         self.talosSuites = talosSuites
         self.buildbotBranch = buildbotBranch
         self.buildersWithSetsMap = buildersWithSetsMap
+        # CompiledTryParser for our builders; see misc_scheduler.getTryParser
+        self.tryParser = None
         Scheduler.__init__(self, **kwargs)
 
     def run(self):
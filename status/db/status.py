@@ -11,7 +11,8 @@ from buildbot.status.builder import FAILURE, HEADER
 import buildbot.scripts.checkconfig as checkconfig
 
 import model
-reload(model)
+from buildbotcustom.reloader import reloadChanged
+reloadChanged(model)
 
 
 class DBBuildStatus(base.StatusReceiver):
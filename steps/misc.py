@@ -497,7 +497,7 @@ class RepackPartners(ShellCommand):
             properties = self.build.getProperties()
             if 'partner' in properties:
                 partner = properties['partner']
-                self.command.extend(['-p', partner])
+                self.setCommand(self.command + ['-p', partner])
         except:
             # No partner was specified, so repacking all partners.
             pass
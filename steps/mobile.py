@@ -5,7 +5,8 @@ from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE, SKIPPED, \
 
 from buildbotcustom.steps.base import ShellCommand
 import buildbotcustom.steps.unittest
-reload(buildbotcustom.steps.unittest)
+from buildbotcustom.reloader import reloadChanged
+reloadChanged(buildbotcustom.steps.unittest)
 from buildbotcustom.steps.unittest import emphasizeFailureText, summaryText
 
 # Wasn't able to get ShellCommandReportTimeout working; may try again
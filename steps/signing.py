@@ -7,11 +7,11 @@ from OpenSSL.crypto import load_certificate, FILETYPE_PEM
 
 from twisted.python.urlpath import URLPath
 from twisted.internet.ssl import ContextFactory
-from twisted.web.client import getPage
 from twisted.python.failure import Failure
 from twisted.internet import reactor
 from twisted.python import log
 from buildbot.steps.transfer import StringDownload
+from buildbotcustom.httpclient import getPage
 
 
 class HTTPSVerifyingContextFactory(ContextFactory):
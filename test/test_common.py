@@ -1,6 +1,7 @@
 import unittest
 
-from buildbotcustom.common import normalizeName, getPreviousVersion
+from buildbotcustom.common import normalizeName, getPreviousVersion, \
+    PathPrefixTrie
 
 
 class TestNormalizeName(unittest.TestCase):
@@ -54,3 +55,25 @@ class TestGetPreviousVersion(unittest.TestCase):
     def testTwoDots(self):
         self.assertEquals('37.1.0',
             getPreviousVersion('38.0b1', ['37.1.0', '36.0']))
+
+
+class TestPathPrefixTrie(unittest.TestCase):
+    def testMatches(self):
+        trie = PathPrefixTrie(['browser/', 'dom', 'mobile/android/'])
+        self.assertTrue(trie.matches('browser/base/foo.js'))
+        self.assertTrue(trie.matches('dom/base/foo.cpp'))
+        # Prefixes aren't limited to whole directories, like str.startswith
+        self.assertTrue(trie.matches('domx/foo'))
+        self.assertFalse(trie.matches('brows'))
+        self.assertFalse(trie.matches('mobile/b2g/foo'))
+        self.assertFalse(trie.matches('layout/browser/foo'))
+
+    def testEmpty(self):
+        self.assertFalse(PathPrefixTrie().matches('foo'))
+        self.assertTrue(PathPrefixTrie(['']).matches('foo'))
+
+    def testMatchesAny(self):
+        trie = PathPrefixTrie(['browser/', 'toolkit/'])
+        self.assertTrue(trie.matchesAny(['dom/foo', 'toolkit/bar']))
+        self.assertFalse(trie.matchesAny(['dom/foo', 'layout/bar']))
+        self.assertFalse(trie.matchesAny([]))
@@ -0,0 +1,100 @@
+import copy
+
+from twisted.trial import unittest
+
+from buildbot.process.factory import BuildFactory
+from buildbot.steps.shell import WithProperties
+
+from buildbotcustom.process.factory import StepInterner, FrozenList
+from buildbotcustom.steps.base import ShellCommand
+
+
+def makeFactory(env, command):
+    f = BuildFactory()
+    f.addStep(ShellCommand(
+        name='build',
+        command=command + [WithProperties('%(buildid)s')],
+        env=env,
+        log_eval_func=lambda c, s: 0,
+    ))
+    return f
+
+
+class TestStepInterner(unittest.TestCase):
+    def setUp(self):
+        self.interner = StepInterner()
+
+    def testContainers(self):
+        a = {'env': {'PATH': '/bin'}, 'args': ['-v', ('x', 1)]}
+        b = {'args': ['-v', ('x', 1)], 'env': {'PATH': '/bin'}}
+        a = self.interner.intern(a)
+        b = self.interner.intern(b)
+        self.assertIdentical(a, b)
+
+        c = self.interner.intern({'env': {'PATH': '/usr/bin'},
+                                  'args': ['-v', ('x', 1)]})
+        self.assertNotIdentical(a, c)
+        # Equal parts are still shared
+        self.assertIdentical(a['args'], c['args'])
+
+    def testTypesDiffer(self):
+        self.assertNotIdentical(self.interner.intern([1, 2]),
+                                self.interner.intern((1, 2)))
+        self.assertNotIdentical(self.interner.intern([1]),
+                                self.interner.intern([True]))
+
+    def testIdentity(self):
+        class Thing(object):
+            pass
+        a, b = Thing(), Thing()
+        self.assertNotIdentical(self.interner.intern([a]),
+                                self.interner.intern([b]))
+
+    def testClosures(self):
+        def make(x):
+            return lambda: x
+        self.assertNotIdentical(self.interner.intern([make(1)]),
+                                self.interner.intern([make(2)]))
+
+    def testFrozenSteps(self):
+        f = self.interner.internFactory(makeFactory({}, ['make']))
+        self.assertRaises(TypeError, f.addStep, ShellCommand(name='more'))
+        self.assertRaises(TypeError, f.steps.__setitem__, 0, None)
+        self.assertEquals(len(f.steps), 1)
+        self.assertTrue(isinstance(f.steps, FrozenList))
+        # Frozen steps still compare equal to a factory's usual list
+        g = BuildFactory()
+        g.steps = list(f.steps)
+        self.assertEquals(f, g)
+        self.assertEquals(type(copy.deepcopy(f.steps)), list)
+
+    def testCycles(self):
+        a = []
+        a.append(a)
+        self.assertIdentical(self.interner.intern(a), a)
+
+    def testFactories(self):
+        f1 = makeFactory({'PATH': '/bin'}, ['make'])
+        f2 = makeFactory({'PATH': '/bin'}, ['make'])
+        f3 = makeFactory({'PATH': '/bin'}, ['make', 'check'])
+
+        f1 = self.interner.internFactory(f1)
+        self.assertIdentical(self.interner.internFactory(f2), f1)
+        self.assertIdentical(self.interner.internFactory(f1), f1)
+
+        f3 = self.interner.internFactory(f3)
+        self.assertNotIdentical(f3, f1)
+        self.assertNotIdentical(f3.steps, f1.steps)
+        self.assertEquals(f3.steps[0][0], f1.steps[0][0])
+        self.assertIdentical(f3.steps[0][1]['env'], f1.steps[0][1]['env'])
+        self.assertIdentical(f3.steps[0][1]['log_eval_func'],
+                             f1.steps[0][1]['log_eval_func'])
+
+    def testBuildObjects(self):
+        objects = {'builders': [
+            {'name': 'b1', 'factory': makeFactory({}, ['make'])},
+            {'name': 'b2', 'factory': makeFactory({}, ['make'])},
+        ]}
+        self.interner.internBuildObjects(objects)
+        b1, b2 = objects['builders']
+        self.assertIdentical(b1['factory'], b2['factory'])
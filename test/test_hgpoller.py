@@ -1,5 +1,12 @@
 from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.web.error import Error as WebError
+import os
+import shutil
+import tempfile
 import threading
+import time
 import socket
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
@@ -9,6 +16,7 @@ if not hasattr(json.decoder, 'JSONDecodeError'):
 else:
     JSONDecodeError = json.JSONDecodeError
 
+from buildbotcustom import httpclient
 from buildbotcustom.changes import hgpoller
 
 
@@ -139,7 +147,152 @@ class RepositoryIndexParsing(unittest.TestCase):
 
         poller = FakeHgAllLocalesPoller()
         poller.processData(fakeLocalesFile)
-        self.failUnlessEqual(poller.pendingLocales, correctLocales)
+        self.failUnlessEqual(list(poller.pendingLocales), correctLocales)
+
+
+class FakeLocalePoller(hgpoller.BasePoller):
+    def __init__(self, locale, running):
+        hgpoller.BasePoller.__init__(self)
+        self.locale = locale
+        self.running = running
+        self.nextLoadTime = 1.0
+        self.d = None
+
+    def getData(self):
+        self.running.append(self.locale)
+        self.d = defer.Deferred()
+        return self.d
+
+    def stopLoad(self, res):
+        self.loadTime = self.nextLoadTime
+        return res
+
+    def processData(self, data):
+        pass
+
+    def finish(self, loadTime=1.0):
+        self.nextLoadTime = loadTime
+        self.running.remove(self.locale)
+        self.d.callback(None)
+
+
+class LocaleSweeps(unittest.TestCase):
+    def setUp(self):
+        running = self.running = []
+        pollers = self.pollers = {}
+
+        class FakeHgAllLocalesPoller(hgpoller.HgAllLocalesPoller):
+            def getLocalePoller(self, locale, branch):
+                if locale not in pollers:
+                    pollers[locale] = FakeLocalePoller(locale, running)
+                return pollers[locale]
+
+        self.poller = FakeHgAllLocalesPoller(hgURL='fake',
+                                             repositoryIndex='fake',
+                                             pollInterval=60,
+                                             parallelRequests=2)
+        self.clock = task.Clock()
+        self.patch(hgpoller, 'reactor', self.clock)
+
+    def finishRunning(self, loadTime=1.0):
+        for locale in self.running[:]:
+            self.pollers[locale].finish(loadTime)
+
+    def testConcurrency(self):
+        self.poller.processData(fakeLocalesFile)
+        self.assertEquals(self.running, ['af', 'be'])
+        self.pollers['be'].finish()
+        self.assertEquals(self.running, ['af', 'de'])
+        while self.running:
+            self.finishRunning()
+        self.assertEquals(self.poller.sweep, None)
+
+        sweep = self.poller.lastSweep
+        self.assertEquals(sweep['locales'], 6)
+        self.assertEquals(sweep['polled'], 6)
+        self.assertEquals(sweep['skipped'], 0)
+        self.assertEquals(sweep['failed'], 0)
+        self.assertEquals(sweep['mean'], 1.0)
+        self.assertEquals(list(self.poller.sweepHistory), [sweep])
+
+    def testSweepInProgress(self):
+        self.poller.processData(fakeLocalesFile)
+        af = self.pollers['af']
+        while self.running != ['af']:
+            for locale in self.running[:]:
+                if locale != 'af':
+                    self.pollers[locale].finish()
+        # af is still running, so the sweep isn't done; a new poll of the
+        # index doesn't start another
+        self.poller.processData(fakeLocalesFile)
+        self.assertEquals(self.running, ['af'])
+        self.assertNotEquals(self.poller.sweep, None)
+
+        af.finish()
+        self.assertEquals(self.poller.sweep, None)
+        self.assertEquals(self.poller.lastSweep['polled'], 6)
+
+    def testSkipStillRunning(self):
+        self.pollers['af'] = FakeLocalePoller('af', self.running)
+        self.pollers['af'].attempts = 1
+        self.poller.processData(fakeLocalesFile)
+        self.assertEquals(self.running, ['be', 'de'])
+        while self.running:
+            self.finishRunning()
+        self.assertEquals(self.poller.lastSweep['skipped'], 1)
+        self.assertEquals(self.poller.lastSweep['polled'], 5)
+
+    def finishAllBut(self, locale):
+        while [l for l in self.running if l != locale]:
+            for l in self.running[:]:
+                if l != locale:
+                    self.pollers[l].finish()
+
+    def testLocaleHangs(self):
+        # Start each sweep's polls straight away
+        self.poller.sweepFraction = None
+        self.poller.processData(fakeLocalesFile)
+        af = self.pollers['af']
+        self.finishAllBut('af')
+        self.assertNotEquals(self.poller.sweep, None)
+        # af's request never comes back; the sweep gives up on it
+        self.clock.advance(self.poller.localeTimeout)
+        self.running.remove('af')
+        self.assertEquals(self.poller.sweep, None)
+        self.assertEquals(self.poller.lastSweep['timedOut'], 1)
+        self.assertEquals(self.poller.lastSweep['failed'], 1)
+
+        # Later sweeps skip af until BasePoller gives up on its last poll,
+        # and then poll it again
+        for i in range(af.attemptLimit):
+            self.poller.processData(fakeLocalesFile)
+            self.finishAllBut(None)
+            self.clock.advance(0)
+            self.assertEquals(self.poller.sweep, None)
+            self.assertEquals(self.poller.lastSweep['skipped'], 1)
+        self.poller.processData(fakeLocalesFile)
+        self.assertTrue('af' in self.running)
+        self.finishAllBut(None)
+        self.assertEquals(self.poller.sweep, None)
+        self.assertEquals(self.poller.lastSweep['skipped'], 0)
+        self.assertEquals(self.poller.lastSweep['polled'], 6)
+
+    def testPace(self):
+        self.poller.processData(fakeLocalesFile)
+        while self.running:
+            self.finishRunning(loadTime=2.0)
+        # 6 locales over 2 slots in 30s means starting one every 10s; each
+        # takes 2s to load
+        self.assertEquals(self.poller.pace, 8.0)
+
+        self.poller.sweepFraction = None
+        self.poller.adjustPace(self.poller.lastSweep)
+        self.assertEquals(self.poller.pace, 0)
+
+    def testParallelRequestsChanged(self):
+        self.poller.parallelRequests = 3
+        self.poller.processData(fakeLocalesFile)
+        self.assertEquals(self.running, ['af', 'be', 'de'])
 
 
 class TestPolling(unittest.TestCase):
@@ -197,6 +350,193 @@ class TestPolling(unittest.TestCase):
                                   repositoryIndex='foobar')
 
 
+class FakeHubPoller(object):
+    loop = None
+    hub = None
+
+    def __init__(self, name, clock, pollInterval=60):
+        self.name = name
+        self.clock = clock
+        self.pollInterval = pollInterval
+        self.polls = []
+
+    def poll(self):
+        self.polls.append(self.clock.seconds())
+
+    def __str__(self):
+        return self.name
+
+
+class PollerHub(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.hub = hgpoller.HgPollerHub('hg.example.com', maxConcurrent=2,
+                                        clock=self.clock)
+        self.pollers = [FakeHubPoller(n, self.clock) for n in 'dcba']
+
+    def tearDown(self):
+        for p in self.pollers:
+            self.hub.unregister(p)
+
+    def testStaggered(self):
+        for p in self.pollers:
+            self.hub.register(p)
+        self.clock.advance(0)
+        for i in range(120):
+            self.clock.advance(1)
+        self.assertEquals([p.polls for p in reversed(self.pollers)],
+                          [[0, 60, 120], [15, 75], [30, 90], [45, 105]])
+
+    def testUnregister(self):
+        for p in self.pollers:
+            self.hub.register(p)
+        self.clock.advance(0)
+        self.hub.unregister(self.pollers[0])
+        for i in range(60):
+            self.clock.advance(1)
+        self.assertEquals(self.pollers[0].polls, [])
+        self.assertEquals(self.pollers[1].polls, [30])
+
+    def testConcurrency(self):
+        requests = []
+
+        def fakeRequest(url, headers=None, timeout=None):
+            d = defer.Deferred()
+            requests.append((url, d))
+            return d
+        self.patch(httpclient, 'request', fakeRequest)
+
+        poller = self.pollers[0]
+        self.hub.register(poller)
+        results = []
+        errors = []
+        for i in range(3):
+            d = self.hub.fetch(poller, 'url%i' % i)
+            d.addCallbacks(results.append, errors.append)
+        self.assertEquals([u for u, d in requests], ['url0', 'url1'])
+        requests[0][1].callback(('200', {}, 'data'))
+        self.assertEquals([u for u, d in requests], ['url0', 'url1', 'url2'])
+        requests[1][1].errback(Exception('broken'))
+        requests[2][1].callback(('200', {}, 'data'))
+
+        self.assertEquals(len(results), 2)
+        self.assertEquals(len(errors), 1)
+        metrics = self.hub.metrics['d']
+        self.assertEquals(metrics['requests'], 3)
+        self.assertEquals(metrics['failures'], 1)
+        self.failIfEquals(metrics['lastSuccess'], None)
+        self.failIfEquals(metrics['avgLatency'], None)
+
+    def testLeavesRoom(self):
+        # The hub's default leaves one of httpclient's connections to the
+        # server free for other requests
+        self.assertTrue(hgpoller.HgPollerHub.maxConcurrent <
+                        httpclient.HTTPClientPool.maxPerHost)
+
+    def testLag(self):
+        poller = self.pollers[0]
+        self.hub.register(poller)
+        now = time.time()
+        self.hub.recordPushes(poller, now - 100)
+        metrics = self.hub.metrics['d']
+        self.assertEquals(metrics['lastPush'], now - 100)
+        self.failUnless(100 <= metrics['lag'] < 110)
+
+
+class ConditionalHTTPRequestHandler(BaseHTTPRequestHandler):
+    # Like hgweb, with an ETag that changes with the contents; contents and
+    # requests are set on the subclass created by FakeHgWeb
+    def do_GET(self):
+        etag = '"%s"' % hash(self.contents)
+        self.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(self.contents)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class ConditionalRequests(unittest.TestCase):
+    def setUp(self):
+        self.server = TestHTTPServer(validPushlog)
+        handler = self.server.server.RequestHandlerClass
+
+        class FakeHgWeb(ConditionalHTTPRequestHandler):
+            contents = handler.contents
+            requests = []
+        self.server.server.RequestHandlerClass = FakeHgWeb
+        self.handler = FakeHgWeb
+
+        self.changes = []
+        changes = self.changes
+
+        class parent:
+            def addChange(self, change):
+                changes.append(change)
+
+        self.poller = hgpoller.BaseHgPoller(
+            'http://localhost:%i' % self.server.port, 'whatever')
+        self.poller.verbose = False
+        self.poller.emptyRepo = True
+        self.poller.parent = parent()
+
+    def tearDown(self):
+        # Don't leave keep-alive connections to the server in the shared pool
+        d = httpclient._pool.close()
+        d.addBoth(lambda _: self.server.stop())
+        return d
+
+    def testNotModified(self):
+        d = self.poller.poll()
+
+        def pollAgain(_):
+            self.assertEquals(len(self.changes), 2)
+            self.assertEquals(self.handler.requests[0][1], None)
+            # Pretend the fromchange query still returns the same pushes
+            self.poller.lastChangeset = None
+            self.poller.emptyRepo = True
+            return self.poller.poll()
+
+        def check(_):
+            self.assertEquals(len(self.handler.requests), 2)
+            self.assertNotEquals(self.handler.requests[1][1], None)
+            # processData was skipped
+            self.assertEquals(len(self.changes), 2)
+            self.assertEquals(self.poller.lastChangeset, None)
+            stats = self.poller.requestStats
+            self.assertEquals(stats['requests'], 2)
+            self.assertEquals(stats['not_modified'], 1)
+            self.assertEquals(stats['bytes_received'], len(validPushlog))
+            self.assertEquals(stats['bytes_saved'], len(validPushlog))
+        d.addCallback(pollAgain)
+        d.addCallback(check)
+        return d
+
+    def testModified(self):
+        d = self.poller.poll()
+
+        def pollAgain(_):
+            self.poller.lastChangeset = None
+            self.poller.emptyRepo = True
+            self.handler.contents = validPushlog.replace('1282362551',
+                                                         '1282362552')
+            return self.poller.poll()
+
+        def check(_):
+            self.assertEquals(len(self.changes), 4)
+            self.assertEquals(self.poller.requestStats['not_modified'], 0)
+        d.addCallback(pollAgain)
+        d.addCallback(check)
+        return d
+
+
 validPushlog = """
 {
  "15226": {
@@ -314,6 +654,281 @@ class PushlogParsing(unittest.TestCase):
     def testEmptyPushlog(self):
         self.failUnlessRaises(JSONDecodeError, hgpoller._parse_changes, "")
 
+    def testNoPushes(self):
+        self.failUnlessEqual(hgpoller._parse_changes(" { } "), [])
+
+    def testBoundedPushlog(self):
+        data = makePushlog(50)
+        pushes = hgpoller._parse_changes(data)
+        self.failUnlessEqual(len(pushes), 50)
+        self.failUnlessEqual([p['date'] for p in pushes], range(1, 51))
+
+        # The newest 5 pushes are enough for 5 merged changes, and one more
+        # shows there were too many
+        bounded = hgpoller._parse_changes(data, maxChanges=5)
+        self.failUnlessEqual(bounded, pushes[-6:])
+
+        # Without merging, each push has 2 changes
+        bounded = hgpoller._parse_changes(data, maxChanges=5,
+                                          mergePushChanges=False)
+        self.failUnlessEqual(bounded, pushes[-4:])
+
+        # Only every other push has changes on relbranch
+        bounded = hgpoller._parse_changes(data, maxChanges=5,
+                                          repo_branch='relbranch')
+        self.failUnlessEqual(bounded, pushes[-11:])
+
+
+def makePushlog(n):
+    """Returns a json-pushes response with n pushes of 2 changesets each,
+    in reverse order"""
+    pushes = {}
+    for i in range(1, n + 1):
+        branch = 'relbranch' if i % 2 else 'default'
+        pushes[str(i)] = {
+            'date': i,
+            'user': 'user%i@example.com' % i,
+            'changesets': [{
+                'node': '%040x' % (i * 2 + j),
+                'files': ['file%i' % j, 'common'],
+                'tags': [],
+                'author': 'Author <author@example.com>',
+                'branch': branch,
+                'desc': 'Bug %i - change %i\n\nDetails' % (i, j),
+            } for j in range(2)],
+        }
+    return '{%s}' % ', '.join('"%s": %s' % (k, json.dumps(pushes[k]))
+                              for k in sorted(pushes, reverse=True))
+
+
+class SavedChangesets(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'state.json')
+        self.changes = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makePoller(self, repo_branch=None):
+        changes = self.changes
+
+        class parent:
+            def addChange(self, change):
+                changes.append(change)
+
+        p = hgpoller.BaseHgPoller('http://localhost', 'whatever',
+                                  repo_branch=repo_branch)
+        p.verbose = False
+        p.parent = parent()
+        p.changesetStore = hgpoller.ChangesetStore(self.filename)
+        return p
+
+    def testSaveAndRestore(self):
+        p = self.makePoller()
+        p.restoreLastChangeset()
+        self.assertEquals(p.lastChangeset, None)
+        p.emptyRepo = True
+        p.processData(validPushlog)
+        self.assertEquals(json.load(open(self.filename)),
+                          {'http://localhost/whatever#*':
+                           '33be08836cb164f9e546231fc59e9e4cf98ed991'})
+
+        # After a restart
+        p = self.makePoller()
+        p.restoreLastChangeset()
+        self.assertEquals(p.lastChangeset,
+                          '33be08836cb164f9e546231fc59e9e4cf98ed991')
+        self.assertEquals(p._make_url(), 'http://localhost/whatever/'
+                          'json-pushes?full=1&fromchange='
+                          '33be08836cb164f9e546231fc59e9e4cf98ed991')
+
+    def testBranches(self):
+        # Two pollers watching different branches of one repository
+        default = self.makePoller('default')
+        default.setLastChangeset('aaaaaa')
+        relbranch = self.makePoller('GECKO_RELBRANCH')
+        relbranch.setLastChangeset('bbbbbb')
+
+        default = self.makePoller('default')
+        default.restoreLastChangeset()
+        self.assertEquals(default.lastChangeset, 'aaaaaa')
+        relbranch = self.makePoller('GECKO_RELBRANCH')
+        relbranch.restoreLastChangeset()
+        self.assertEquals(relbranch.lastChangeset, 'bbbbbb')
+
+    def testOldKey(self):
+        # State saved before keys included the branch
+        hgpoller.ChangesetStore(self.filename).set(
+            'http://localhost/whatever', 'abcdef')
+        p = self.makePoller('default')
+        p.restoreLastChangeset()
+        self.assertEquals(p.lastChangeset, 'abcdef')
+        self.assertEquals(json.load(open(self.filename)),
+                          {'http://localhost/whatever': 'abcdef',
+                           'http://localhost/whatever#default': 'abcdef'})
+
+        p.setLastChangeset('fedcba')
+        p = self.makePoller('default')
+        p.restoreLastChangeset()
+        self.assertEquals(p.lastChangeset, 'fedcba')
+
+    def testUnknownChangeset(self):
+        hgpoller.ChangesetStore(self.filename).set(
+            'http://localhost/whatever', 'abcdef')
+        p = self.makePoller()
+        p.restoreLastChangeset()
+        p.attempts = 1
+        p.dataFailed(failure.Failure(WebError('500', 'Internal Server Error',
+                                              'unknown revision')))
+        self.assertEquals(p.lastChangeset, None)
+        self.assertEquals(json.load(open(self.filename)), {})
+
+    def testCorruptFile(self):
+        open(self.filename, 'w').write('{"http://localhost/whatever": ')
+        p = self.makePoller()
+        p.restoreLastChangeset()
+        self.assertEquals(p.lastChangeset, None)
+        self.flushLoggedErrors(ValueError)
+
+
+class PushNotifications(unittest.TestCase):
+    def setUp(self):
+        self.poller = hgpoller.HgPoller('http://hg.example.com/',
+                                        'mozilla-central', stateFile=None)
+        self.polls = 0
+
+        def poll():
+            self.polls += 1
+        self.poller.poll = poll
+
+    def testWantsPush(self):
+        self.failUnless(self.poller.wantsPush(
+            'http://hg.example.com/mozilla-central/'))
+        self.failIf(self.poller.wantsPush(
+            'http://hg.example.com/mozilla-central-2'))
+
+    def testNotified(self):
+        self.poller.notified()
+        self.assertEquals(self.polls, 1)
+
+    def testNotifiedWhilePolling(self):
+        self.poller.attempts = 1
+        self.poller.notified()
+        self.assertEquals(self.polls, 0)
+        # Still running
+        self.poller.pollDone(None)
+        self.assertEquals(self.polls, 0)
+        self.poller.attempts = 0
+        self.poller.pollDone(None)
+        self.assertEquals(self.polls, 1)
+        self.poller.pollDone(None)
+        self.assertEquals(self.polls, 1)
+
+
+class FakeDB(object):
+    def __init__(self):
+        self.transactions = 0
+        self.rows = []
+        self.notified = []
+        self._change_cache = self
+        self.cached = []
+
+    def runInteractionNow(self, fn, *args):
+        self.transactions += 1
+        return fn('cursor', *args)
+
+    def _txn_addChangeToDatabase(self, t, change):
+        self.rows.append(change)
+        change.number = len(self.rows)
+        # Like buildbot's, this notifies from inside the transaction
+        self.notify("add-change", change.number)
+
+    def addChangeToDatabase(self, change):
+        self.runInteractionNow(self._txn_addChangeToDatabase, change)
+        self.add(change.number, change)
+
+    def notify(self, category, *args):
+        self.notified.append((category,) + args)
+
+    def add(self, number, change):
+        self.cached.append(number)
+
+
+class FakeMaster(object):
+    def __init__(self):
+        self.db = FakeDB()
+        self.status = self
+        self.added = []
+
+    def changeAdded(self, change):
+        self.added.append(change)
+
+    def addChange(self, change):
+        self.db.addChangeToDatabase(change)
+        self.changeAdded(change)
+
+
+class FakeChangeManager(object):
+    def __init__(self):
+        self.parent = FakeMaster()
+        self.pruned = []
+
+    def addChange(self, change):
+        self.parent.addChange(change)
+        self.pruneChanges(change.number)
+
+    def pruneChanges(self, last_added_changeid):
+        self.pruned.append(last_added_changeid)
+
+
+class BatchedChanges(unittest.TestCase):
+    def setUp(self):
+        self.poller = hgpoller.BaseHgPoller('http://localhost', 'whatever',
+                                            maxChanges=None)
+        self.poller.verbose = False
+        self.poller.lastChangeset = 'abcdef'
+        self.poller.parent = FakeChangeManager()
+        self.master = self.poller.parent.parent
+
+    def testOneTransaction(self):
+        self.poller.processData(makePushlog(20))
+        db = self.master.db
+        self.assertEquals(db.transactions, 1)
+        self.assertEquals(len(db.rows), 20)
+        self.assertEquals(db.notified,
+                          [('add-change', i) for i in range(1, 21)])
+        self.assertEquals(db.cached, range(1, 21))
+        self.assertEquals([c.number for c in self.master.added],
+                          range(1, 21))
+        self.assertEquals([c.revision for c in self.master.added],
+                          ['%040x' % (i * 2 + 1) for i in range(1, 21)])
+        self.assertEquals(self.poller.parent.pruned, [20])
+        # Files are only listed once per push
+        self.assertEquals(sorted(self.master.added[0].files),
+                          ['common', 'file0', 'file1'])
+
+    def testUnbatched(self):
+        self.poller.batchChanges = False
+        self.poller.processData(makePushlog(20))
+        self.assertEquals(self.master.db.transactions, 20)
+        self.assertEquals(len(self.master.added), 20)
+        self.assertEquals(self.master.db.notified,
+                          [('add-change', i) for i in range(1, 21)])
+
+    def testDuplicateFiles(self):
+        pushlog = json.dumps({'1': {
+            'date': 1, 'user': 'me',
+            'changesets': [
+                {'node': 'a', 'files': ['x', 'y'], 'branch': 'default',
+                 'desc': 'first', 'tags': [], 'author': 'me'},
+                {'node': 'b', 'files': ['y', 'z'], 'branch': 'default',
+                 'desc': 'second', 'tags': [], 'author': 'me'},
+            ]}})
+        self.poller.processData(pushlog)
+        self.assertEquals(len(self.master.added), 1)
+        self.assertEquals(sorted(self.master.added[0].files), ['x', 'y', 'z'])
+
 
 class RepoBranchHandling(unittest.TestCase):
     def setUp(self):
@@ -481,6 +1096,29 @@ class MaxChangesHandling(unittest.TestCase):
         self.assertEquals(self.changes[1].revision,
                           '33be08836cb164f9e546231fc59e9e4cf98ed991')
 
+    def testThreadedParse(self):
+        changes = self.changes
+
+        class TestPoller(hgpoller.BaseHgPoller):
+            threadedParseSize = 0
+
+        class parent:
+            def addChange(self, change):
+                changes.append(change)
+
+        p = TestPoller('http://localhost', 'whatever', maxChanges=1)
+        p.emptyRepo = True
+        p.parent = parent()
+        d = p.processData(makePushlog(10))
+
+        def check(_):
+            self.assertEquals(len(self.changes), 1)
+            self.assertEquals(self.changes[0].revision, '%040x' % 21)
+            self.assert_('overflow' in self.changes[0].files)
+            self.assertEquals(p.lastChangeset, '%040x' % 21)
+        d.addCallback(check)
+        return d
+
     def testRelbranchSmallMax(self):
         self.doTest('GECKO20b5pre_20100820_RELBRANCH', 1, False)
 
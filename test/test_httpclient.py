@@ -0,0 +1,151 @@
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Factory, Protocol
+from twisted.web.error import Error as WebError
+
+from buildbotcustom import httpclient
+from buildbotcustom.test.test_hgpoller import TestHTTPServer
+
+
+class PageRequestHandler(BaseHTTPRequestHandler):
+    def respond(self, body):
+        if self.path == '/moved':
+            self.send_response(301)
+            self.send_header('Location', 'http://localhost:%i/foo' %
+                             self.server.server_port)
+            self.send_header('Content-length', '0')
+            self.end_headers()
+            return
+        if self.path == '/missing':
+            self.send_response(404)
+        else:
+            self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond('page at %s' % self.path)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-length', 0))
+        self.respond('posted %s' % self.rfile.read(length))
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class TestHTTPClientPool(unittest.TestCase):
+    def setUp(self):
+        self.server = TestHTTPServer('')
+        self.server.server.RequestHandlerClass = PageRequestHandler
+        self.base = 'http://localhost:%i' % self.server.port
+        self.pool = httpclient.HTTPClientPool(maxPerHost=1)
+
+    def tearDown(self):
+        d = self.pool.close()
+        d.addBoth(lambda _: self.server.stop())
+        return d
+
+    def testGetPage(self):
+        d = self.pool.getPage(self.base + '/foo', timeout=10)
+
+        def check(page):
+            self.assertEquals(page, 'page at /foo')
+            stats = self.pool.stats[('http', 'localhost:%i' %
+                                     self.server.port)]
+            self.assertEquals(stats['requests'], 1)
+            self.assertEquals(stats['failures'], 0)
+            self.assertEquals(stats['bytes'], len(page))
+            self.assertEquals(stats['active'], 0)
+        d.addCallback(check)
+        return d
+
+    def testError(self):
+        d = self.pool.getPage(self.base + '/missing')
+
+        def check(f):
+            f.trap(WebError)
+            self.assertEquals(f.value.status, '404')
+            stats = self.pool.stats.values()[0]
+            self.assertEquals(stats['failures'], 1)
+        d.addCallbacks(lambda _: self.fail("didn't fail"), check)
+        return d
+
+    def testRedirect(self):
+        d = self.pool.getPage(self.base + '/moved', timeout=10)
+        d.addCallback(self.assertEquals, 'page at /foo')
+        return d
+
+    def testPost(self):
+        d = self.pool.getPage(self.base + '/', method='POST',
+                              postdata='a=b',
+                              headers={'Content-Type':
+                                       'application/x-www-form-urlencoded'})
+        d.addCallback(self.assertEquals, 'posted a=b')
+        return d
+
+    def testPerHostLimit(self):
+        ds = [self.pool.request(self.base + '/%i' % i) for i in range(3)]
+        stats = self.pool.stats.values()[0]
+        self.assertEquals(stats['active'], 1)
+        self.assertEquals(stats['queued'], 2)
+
+        def check(results):
+            self.assertEquals([r[1][2] for r in results],
+                              ['page at /0', 'page at /1', 'page at /2'])
+            self.assertEquals(stats['requests'], 3)
+            self.assertEquals(stats['queued'], 0)
+        d = defer.DeferredList(ds)
+        d.addCallback(check)
+        return d
+
+
+class TestConnectionPerRequest(TestHTTPClientPool):
+    """The same tests without keep-alive connections, as with Twisted older
+    than 12.1"""
+    def setUp(self):
+        TestHTTPClientPool.setUp(self)
+        self.pool = httpclient.HTTPClientPool(maxPerHost=1, persistent=False)
+
+
+class TestTimeout(unittest.TestCase):
+    persistent = True
+
+    def setUp(self):
+        # Accepts connections, and never says anything
+        factory = Factory()
+        factory.protocol = Protocol
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%i/' % self.port.getHost().port
+        self.pool = httpclient.HTTPClientPool(maxPerHost=1,
+                                              persistent=self.persistent)
+        self.pool.timeout = 0.5
+
+    def tearDown(self):
+        d = self.pool.close()
+        d.addBoth(lambda _: self.port.stopListening())
+        return d
+
+    def testDefaultTimeout(self):
+        """Tests that requests without a timeout give up, and free their
+        host's slot"""
+        ds = [self.pool.getPage(self.url) for i in range(2)]
+        d = defer.DeferredList(ds, consumeErrors=True)
+
+        def check(results):
+            self.assertEquals([success for success, result in results],
+                              [False, False])
+            stats = self.pool.stats.values()[0]
+            self.assertEquals(stats['failures'], 2)
+            self.assertEquals(stats['active'], 0)
+            self.assertEquals(stats['queued'], 0)
+        d.addCallback(check)
+        return d
+
+
+class TestTimeoutConnectionPerRequest(TestTimeout):
+    persistent = False
@@ -0,0 +1,150 @@
+import os
+import sys
+import types
+
+from twisted.trial import unittest
+
+import buildbotcustom.misc as misc
+
+
+class TestCachedBuildObjects(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        @misc.cachedBuildObjects
+        def generate(name, config, secrets=None):
+            self.calls.append(name)
+            builder = {'name': '%s builder' % name, 'factory': object()}
+            misc.nomergeBuilders.add(builder['name'])
+            misc.builderMergeLimits[builder['name']] = config['limit']
+            return {'builders': [builder], 'schedulers': [], 'status': [],
+                    'change_source': []}
+        self.generate = generate
+
+        misc._buildObjectsCache.clear()
+        misc.nomergeBuilders.clear()
+        misc.builderMergeLimits.clear()
+
+    def tearDown(self):
+        misc._buildObjectsCache.clear()
+        misc.nomergeBuilders.clear()
+        misc.builderMergeLimits.clear()
+
+    def testCacheHit(self):
+        config = {'limit': 5, 'platforms': {'linux': set(['a', 'b'])}}
+        first = self.generate('b1', config, secrets={'pw': 'x'})
+
+        # Mutating the results doesn't affect the cached objects
+        first['builders'].append({'name': 'extra'})
+        first['builders'][0]['name'] = 'renamed'
+        misc.nomergeBuilders.clear()
+        misc.builderMergeLimits.clear()
+
+        # An equal, but different, config
+        config = {'platforms': {'linux': set(['b', 'a'])}, 'limit': 5}
+        second = self.generate('b1', config, secrets={'pw': 'x'})
+        self.assertEquals(self.calls, ['b1'])
+        self.assertEquals([b['name'] for b in second['builders']],
+                          ['b1 builder'])
+        self.assertEquals(second['builders'][0]['factory'],
+                          first['builders'][0]['factory'])
+
+        # Side effects are replayed
+        self.assertEquals(misc.nomergeBuilders, set(['b1 builder']))
+        self.assertEquals(misc.builderMergeLimits['b1 builder'], 5)
+
+        self.assertEquals(misc.generatorTimings[-1][:2], ('generate', 'b1'))
+        self.assertTrue(misc.generatorTimings[-1][3])
+
+    def testNestedCopies(self):
+        class Scheduler(object):
+            def __init__(self):
+                self.builderNames = ['b1 builder']
+                self.properties = {'branch': 'b1'}
+
+        @misc.cachedBuildObjects
+        def generate(name):
+            self.calls.append(name)
+            return {'builders': [{'name': name, 'factory': object(),
+                                  'env': {'PATH': '/bin'},
+                                  'properties': {'platforms': ['linux']}}],
+                    'schedulers': [Scheduler()], 'status': []}
+        first = generate('b1')
+        first['builders'][0]['env']['PATH'] = '/usr/bin'
+        first['builders'][0]['properties']['platforms'].append('win32')
+        first['schedulers'][0].builderNames.append('extra')
+        first['schedulers'][0].properties['branch'] = 'b2'
+
+        second = generate('b1')
+        self.assertEquals(self.calls, ['b1'])
+        builder = second['builders'][0]
+        self.assertEquals(builder['env'], {'PATH': '/bin'})
+        self.assertEquals(builder['properties'], {'platforms': ['linux']})
+        self.assertIdentical(builder['factory'],
+                             first['builders'][0]['factory'])
+        scheduler = second['schedulers'][0]
+        self.assertEquals(scheduler.builderNames, ['b1 builder'])
+        self.assertEquals(scheduler.properties, {'branch': 'b1'})
+        self.assertTrue(isinstance(scheduler, Scheduler))
+
+    def testCacheMiss(self):
+        self.generate('b1', {'limit': 5})
+        self.generate('b1', {'limit': 6})
+        self.generate('b1', {'limit': 6}, secrets={'pw': 'y'})
+        self.generate('b2', {'limit': 6})
+        self.assertEquals(self.calls, ['b1', 'b1', 'b1', 'b2'])
+        self.assertEquals(misc.builderMergeLimits['b1 builder'], 6)
+
+    def testConfigModules(self):
+        BuildSlaves = types.ModuleType('BuildSlaves')
+        BuildSlaves.tuxedoPassword = 'x'
+        old = sys.modules.get('BuildSlaves')
+        sys.modules['BuildSlaves'] = BuildSlaves
+        try:
+            self.generate('b1', {'limit': 5})
+            self.generate('b1', {'limit': 5})
+            BuildSlaves.tuxedoPassword = 'y'
+            self.generate('b1', {'limit': 5})
+        finally:
+            if old is None:
+                del sys.modules['BuildSlaves']
+            else:
+                sys.modules['BuildSlaves'] = old
+        self.assertEquals(self.calls, ['b1', 'b1'])
+
+    def testCodeVersion(self):
+        # Modules from outside the standard library and installed packages
+        # are tracked, whatever they're called
+        dirname = self.mktemp()
+        os.mkdir(dirname)
+        open(os.path.join(dirname, 'localconfig_test.py'), 'w').close()
+        sys.path.insert(0, dirname)
+        try:
+            import localconfig_test
+            assert localconfig_test  # pyflakes
+            names = [name for name, mtime in misc._codeVersion()]
+        finally:
+            sys.path.remove(dirname)
+            del sys.modules['localconfig_test']
+        self.assertIn('localconfig_test', names)
+        self.assertIn('buildbotcustom.misc', names)
+        self.assertNotIn('os', names)
+
+    def testDisabled(self):
+        misc.cacheBuildObjects = False
+        try:
+            self.generate('b1', {'limit': 5})
+            self.generate('b1', {'limit': 5})
+        finally:
+            misc.cacheBuildObjects = True
+        self.assertEquals(self.calls, ['b1', 'b1'])
+
+    def testStableRepr(self):
+        self.assertEquals(misc._stableRepr({'a': 1, 'b': [1, (2,)]}),
+                          misc._stableRepr({'b': [1, (2,)], 'a': 1}))
+        self.assertNotEquals(misc._stableRepr([1]), misc._stableRepr((1,)))
+        self.assertNotEquals(misc._stableRepr(lambda: 1),
+                             misc._stableRepr(lambda: 2))
+        recursive = []
+        recursive.append(recursive)
+        self.assertRaises(misc._Uncacheable, misc._stableRepr, recursive)
@@ -1,7 +1,12 @@
+import random
+
 from twisted.trial import unittest
 
+import buildbotcustom.misc
 from buildbotcustom.misc import makeImportantFunc, \
-    changeContainsScriptRepoRevision
+    changeContainsScriptRepoRevision, isImportantForProduct, \
+    ProductExcludeMatcher, isImportantL10nFile
+from buildbotcustom.common import PathPrefixTrie
 
 from buildbot.process.properties import Properties
 
@@ -63,6 +68,60 @@ class TestProductImportance(unittest.TestCase):
         self.assertTrue(f(c))
 
 
+def makeBigPush(nfiles=5000, seed=0):
+    """Returns a list of nfiles paths, roughly shaped like a large merge"""
+    r = random.Random(seed)
+    topdirs = ['accessible/src/windows', 'b2g/app', 'browser/base/content',
+               'build/win32', 'devtools/client/shared', 'dom/base', 'gfx/2d',
+               'js/src/jit', 'layout/generic', 'mobile/android/base',
+               'netwerk/protocol/http', 'testing/mochitest', 'toolkit/themes',
+               'widget/gonk', 'widget/windows', 'xpcom/base', 'docs/foo']
+    files = []
+    for i in range(nfiles):
+        files.append('%s/dir%i/file%i.cpp' % (r.choice(topdirs),
+                                              r.randint(0, 50), i))
+    return files
+
+
+def naiveIsExcluded(product, path):
+    excludes = buildbotcustom.misc._product_excludes.get(product, []) + \
+        buildbotcustom.misc._product_excludes.get('__all', [])
+    return any(e.search(path) for e in excludes)
+
+
+class TestProductExcludeMatcher(unittest.TestCase):
+    def testMatchesNaive(self):
+        """Tests that the compiled matcher agrees with checking each regex in
+        turn"""
+        files = makeBigPush(1000)
+        for product in buildbotcustom.misc._product_excludes:
+            matcher = buildbotcustom.misc.getProductExcludeMatcher(product)
+            for f in files:
+                self.assertEquals(matcher.isExcluded(f),
+                                  naiveIsExcluded(product, f), (product, f))
+
+    def testEmpty(self):
+        self.assertFalse(ProductExcludeMatcher([]).isExcluded('foo'))
+
+    def testQuiet(self):
+        c = Change(files=['b2g/foo'])
+        self.assertFalse(isImportantForProduct(c, 'firefox', verbose=False))
+
+
+class TestL10nImportance(unittest.TestCase):
+    modules = ['browser/locales/', 'toolkit/locales/', 'dom/locales/']
+
+    def testImportant(self):
+        c = Change(files=['foo/bar', 'toolkit/locales/en-US/foo.dtd'])
+        self.assertTrue(isImportantL10nFile(c, self.modules))
+        self.assertTrue(isImportantL10nFile(c, PathPrefixTrie(self.modules)))
+
+    def testUnImportant(self):
+        c = Change(files=['foo/bar', 'toolkit/content/foo.js'])
+        self.assertFalse(isImportantL10nFile(c, self.modules))
+        self.assertFalse(isImportantL10nFile(c, PathPrefixTrie(self.modules)))
+
+
 class TestChangeContainsScriptRepoRevision(unittest.TestCase):
 
     def test_exact_match(self):
@@ -74,3 +133,4 @@ class TestChangeContainsScriptRepoRevision(unittest.TestCase):
         c = Change(properties=Properties(
             script_repo_revision="F_34_0_5_RELEASE"))
         self.assertFalse(changeContainsScriptRepoRevision(c, "F_34_0_RELEASE"))
+
@@ -0,0 +1,275 @@
+import threading
+import time
+import urllib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import mock
+
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+
+from buildbot.util import json
+
+from buildbotcustom.misc import JacuzziAllocator
+
+
+class FakeAllocatorHandler(BaseHTTPRequestHandler):
+    # allocator is set on the subclass created by FakeAllocator
+    def do_GET(self):
+        allocator = self.allocator
+        allocator.requests.append(self.path)
+        if allocator.errors:
+            allocator.errors -= 1
+            self.send_error(500)
+            return
+
+        parts = [urllib.unquote(p) for p in self.path.split('/')]
+        if parts[1:] == ['v1', 'allocated', 'all']:
+            machines = set()
+            for m in allocator.allocations.values():
+                machines.update(m)
+            data = {'machines': sorted(machines)}
+        elif parts[1:] == ['v1', 'allocations', 'all']:
+            data = {'builders': allocator.allocations}
+        elif parts[1:3] == ['v1', 'builders'] and \
+                parts[3] in allocator.allocations:
+            data = {'machines': allocator.allocations[parts[3]]}
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(data))
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class FakeAllocator(object):
+    """Local stand-in for the jacuzzi allocator service.
+
+    allocations maps builder names to lists of slavenames. Set errors to make
+    the next requests fail with a 500."""
+
+    def __init__(self, allocations):
+        self.allocations = allocations
+        self.requests = []
+        self.errors = 0
+
+        class OurHandler(FakeAllocatorHandler):
+            pass
+        OurHandler.allocator = self
+        server = HTTPServer(('127.0.0.1', 0), OurHandler)
+        ip, port = server.server_address
+
+        def serve_forever_and_catch():
+            try:
+                server.serve_forever()
+            except Exception:
+                pass
+        server_thread = threading.Thread(target=serve_forever_and_catch)
+        server_thread.setDaemon(True)
+        server_thread.start()
+
+        self.server = server
+        self.server_thread = server_thread
+        self.base_url = 'http://127.0.0.1:%i/v1' % port
+
+    def stop(self):
+        self.server.server_close()
+        self.server_thread.join()
+
+
+def makeSlaves(names):
+    slaves = []
+    for name in names:
+        slave = mock.Mock()
+        slave.slave.slavename = name
+        slaves.append(slave)
+    return slaves
+
+
+def slavenames(slaves):
+    if slaves is None:
+        return None
+    return [s.slave.slavename for s in slaves]
+
+
+class JacuzziTestMixin(object):
+    def setUp(self):
+        self.service = FakeAllocator({
+            'b1': ['s1', 's2'],
+            'b2': ['s3'],
+        })
+        self.J = JacuzziAllocator()
+        self.J.BASE_URL = self.service.base_url
+        self.J.SLEEP_TIME = 0
+        self.J.botmaster = mock.Mock()
+        self.slaves = makeSlaves(['s1', 's2', 's3', 's4'])
+
+    def tearDown(self):
+        self.J.stop()
+        self.service.stop()
+
+    def settle(self):
+        """Waits for callFromThread calls, and then for any fetches they
+        started"""
+        def wait(_):
+            ds = self.J.inflight.values()
+            if ds:
+                return ds[0].addCallback(wait)
+        return deferLater(reactor, 0, lambda: None).addCallback(wait)
+
+
+class TestJacuzziAllocator(JacuzziTestMixin, unittest.TestCase):
+    def test_cold_then_warm(self):
+        """Test that unknown builders wait for their first fetch, without
+        blocking"""
+        self.assertEquals(self.J.get_slaves('b1', self.slaves), [])
+
+        def check(_):
+            self.assertEquals(slavenames(self.J.get_slaves('b1', self.slaves)),
+                              ['s1', 's2'])
+            self.assertTrue(self.J.botmaster.maybeStartAllBuilds.called)
+            self.assertTrue(self.J.refresher.running)
+        return self.settle().addCallback(check)
+
+    def test_unallocated(self):
+        """Test that builders without a jacuzzi get unallocated slaves"""
+        d = self.J.refresh_builder('b3')
+
+        def check(_):
+            self.assertEquals(slavenames(self.J.get_slaves('b3', self.slaves)),
+                              ['s4'])
+            self.assertEquals(self.service.requests,
+                              ['/v1/builders/b3', '/v1/allocated/all'])
+        return d.addCallback(check)
+
+    def test_quoting(self):
+        """Test that builder names are quoted"""
+        self.service.allocations['b 1/x'] = ['s4']
+        d = self.J.refresh_builder('b 1/x')
+
+        def check(_):
+            self.assertEquals(
+                slavenames(self.J.get_slaves('b 1/x', self.slaves)), ['s4'])
+        return d.addCallback(check)
+
+    def test_stale_while_revalidate(self):
+        """Test that stale results are used while they're refreshed"""
+        d = self.J.refresh_builder('b1')
+
+        def expire(_):
+            fetched, slaves = self.J.cache['b1']
+            self.J.cache['b1'] = (fetched - self.J.CACHE_MAXAGE - 1, slaves)
+            self.service.allocations['b1'] = ['s4']
+            self.assertEquals(slavenames(self.J.get_slaves('b1', self.slaves)),
+                              ['s1', 's2'])
+            return self.settle()
+
+        def check(_):
+            self.assertEquals(slavenames(self.J.get_slaves('b1', self.slaves)),
+                              ['s4'])
+        return d.addCallback(expire).addCallback(check)
+
+    def test_retry(self):
+        """Test that errors are retried"""
+        self.service.errors = 2
+        d = self.J.refresh_builder('b2')
+
+        def check(_):
+            self.assertEquals(slavenames(self.J.get_slaves('b2', self.slaves)),
+                              ['s3'])
+            self.assertEquals(len(self.service.requests), 3)
+        return d.addCallback(check)
+
+    def test_give_up(self):
+        """Test that we fall back to any slave once we give up, and don't try
+        again for CACHE_FAIL_MAXAGE"""
+        self.service.errors = self.J.MAX_TRIES
+        d = self.J.refresh_builder('b2')
+
+        def check(_):
+            self.assertEquals(self.J.get_slaves('b2', self.slaves), None)
+            self.assertTrue(self.J.failed['b2'] > time.time())
+            self.assertEquals(len(self.service.requests), self.J.MAX_TRIES)
+            return self.settle()
+
+        def check_no_refetch(_):
+            self.assertEquals(len(self.service.requests), self.J.MAX_TRIES)
+        return d.addCallback(check).addCallback(check_no_refetch)
+
+    def test_disabled(self):
+        self.J.jacuzzi_enabled = False
+        self.assertEquals(self.J.get_slaves('b1', self.slaves), self.slaves)
+
+    def test_stats(self):
+        """Test that cache hits, misses and fetches are counted"""
+        self.J.get_slaves('b1', self.slaves)
+        d = self.settle()
+
+        def check(_):
+            self.J.get_slaves('b1', self.slaves)
+            stats = self.J.get_stats()
+            self.assertEquals(stats['misses'], 1)
+            self.assertEquals(stats['hits'], 1)
+            self.assertEquals(stats['fetches'], 1)
+            self.assertEquals(stats['fetch_failures'], 0)
+            self.assert_(stats['avg_fetch_time'] >= 0)
+        return d.addCallback(check)
+
+
+class TestJacuzziAllocatorBulk(JacuzziTestMixin, unittest.TestCase):
+    def setUp(self):
+        JacuzziTestMixin.setUp(self)
+        self.J.BULK_FETCH = True
+
+    def test_cold_then_warm(self):
+        """Test that nothing is allocated until the first bulk fetch
+        finishes"""
+        self.assertEquals(self.J.get_slaves('b1', self.slaves), [])
+
+        def check(_):
+            self.assertEquals(slavenames(self.J.get_slaves('b1', self.slaves)),
+                              ['s1', 's2'])
+            self.assertTrue(self.J.botmaster.maybeStartAllBuilds.called)
+            self.assertEquals(self.J.get_stats()['misses'], 1)
+            self.assertEquals(self.J.get_stats()['hits'], 1)
+        return self.settle().addCallback(check)
+
+    def test_bulk(self):
+        """Test that one request fetches every builder's allocation"""
+        d = self.J.refresh_all()
+
+        def check(_):
+            self.assertEquals(self.service.requests, ['/v1/allocations/all'])
+            self.assertEquals(slavenames(self.J.get_slaves('b1', self.slaves)),
+                              ['s1', 's2'])
+            self.assertEquals(slavenames(self.J.get_slaves('b2', self.slaves)),
+                              ['s3'])
+            # Builders that aren't in the map get unallocated slaves
+            self.assertEquals(slavenames(self.J.get_slaves('b3', self.slaves)),
+                              ['s4'])
+            # The available slaves' order is kept
+            self.assertEquals(
+                slavenames(self.J.get_slaves('b1', self.slaves[::-1])),
+                ['s2', 's1'])
+            self.assertEquals(self.J.slave_builders,
+                              {'s1': 'b1', 's2': 'b1', 's3': 'b2'})
+            self.assertEquals(sorted(self.J.allocated_cache[1]),
+                              ['s1', 's2', 's3'])
+            self.assertEquals(len(self.service.requests), 1)
+        return d.addCallback(check)
+
+    def test_bulk_give_up(self):
+        """Test that we fall back to any slave if the bulk fetch fails"""
+        self.service.errors = self.J.MAX_TRIES
+        d = self.J.refresh_all()
+
+        def check(_):
+            self.assertEquals(self.J.get_slaves('b2', self.slaves), None)
+            self.assertEquals(self.J.get_stats()['fetch_failures'], 1)
+        return d.addCallback(check)
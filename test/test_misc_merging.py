@@ -88,6 +88,54 @@ class TestMergeRequsets(unittest.TestCase):
         self.assertEquals(misc._mergeId, r2.id)
         self.assertEquals(misc._mergeCount, 2)
 
+    def testInterleavedBuilders(self):
+        """Tests that merge counts for different builders don't interfere
+        with each other"""
+        b1 = makeBuilder("b1")
+        b2 = makeBuilder("b2")
+        r1 = makeRequest(b1)
+        r2 = makeRequest(b1)
+        r3 = makeRequest(b1)
+        r4 = makeRequest(b1)
+        s1 = makeRequest(b2)
+        s2 = makeRequest(b2)
+
+        self.assertTrue(misc.mergeRequests(b1, r1, r2))
+        self.assertTrue(misc.mergeRequests(b2, s1, s2))
+        self.assertTrue(misc.mergeRequests(b1, r1, r3))
+        # b1 has reached its limit, despite the b2 decision in between
+        self.assertFalse(misc.mergeRequests(b1, r1, r4))
+
+    def testReconfig(self):
+        """Tests that changes a reconfig makes to nomergeBuilders and
+        builderMergeLimits in place are noticed"""
+        b1 = makeBuilder("b1")
+        r1 = makeRequest(b1)
+        r2 = makeRequest(b1)
+        r3 = makeRequest(b1)
+        self.assertTrue(misc.mergeRequests(b1, r1, r2))
+
+        misc.builderMergeLimits["b1"] = 2
+        self.assertFalse(misc.mergeRequests(b1, r1, r3))
+
+        misc.nomergeBuilders.add("b1")
+        self.assertFalse(misc.mergeRequests(b1, r2, r3))
+
+    def testVerbose(self):
+        "Tests that verboseMerging logs every decision"
+        b1 = makeBuilder("b1")
+        r1 = makeRequest(b1)
+        r2 = makeRequest(b1, reason="Retriggered via Self-serve")
+        messages = []
+        self.patch(misc.log, 'msg', messages.append)
+
+        misc.mergeRequests(b1, r1, r2)
+        self.assertEquals(messages, [])
+
+        self.patch(misc, 'verboseMerging', True)
+        misc.mergeRequests(b1, r1, r2)
+        self.assertEquals(len(messages), 2)
+
     def testMergeSelfserve(self):
         "Test that having Self-serve in the request reason disables coalescing"
         b1 = makeBuilder("b1")
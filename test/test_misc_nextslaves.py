@@ -1,17 +1,14 @@
 from __future__ import with_statement
 
-import os
-import shutil
-
 import mock
 
 from twisted.trial import unittest
-from buildbot.db import dbspec, connector
-from buildbot.db.schema.manager import DBSchemaManager
+from twisted.internet import defer
 
 import buildbotcustom.misc
 from buildbotcustom.misc import _nextIdleSlave, _nextAWSSlave, \
-    _classifyAWSSlaves, _get_pending, J
+    _classifyAWSSlaves, J, LastSuccessIndex, PendingRequestTracker, \
+    SlaveClassifier, SlaveAssignmentPlanner
 
 
 class TestNextSlaveFuncs(unittest.TestCase):
@@ -44,6 +41,73 @@ class TestNextSlaveFuncs(unittest.TestCase):
         self.assert_(slave is None)
 
 
+class TestLastSuccessIndex(unittest.TestCase):
+    def makeBuild(self, slavename, finished, results=0):
+        build = mock.Mock()
+        build.slavename = slavename
+        build.finished = finished
+        build.getResults.return_value = results
+        return build
+
+    def setUp(self):
+        self.slaves = slaves = []
+        for name in ('s1', 's2', 's3'):
+            slave = mock.Mock()
+            slave.slave.slavename = name
+            slaves.append(slave)
+
+        self.builder = builder = mock.Mock()
+        builder.name = "b1"
+        builder.builder_status.buildCache = {
+            1: self.makeBuild('s1', 100),
+            2: self.makeBuild('s2', 200),
+            3: self.makeBuild('s3', 300, results=2),
+        }
+        self.index = LastSuccessIndex()
+
+    def test_seed(self):
+        """Test that the index is seeded from successful builds in the
+        buildCache"""
+        self.assertEquals(self.index.getLastTime(self.builder, 's1'), 100)
+        self.assertEquals(self.index.getLastTime(self.builder, 's2'), 200)
+        self.assertEquals(self.index.getLastTime(self.builder, 's3'), None)
+        self.assertEquals(self.index.pickMostRecent(self.builder,
+                                                    self.slaves),
+                          self.slaves[1])
+        self.builder.builder_status.subscribe.assert_called_once_with(
+            self.index)
+
+    def test_buildFinished(self):
+        """Test that finished builds update the index without rescanning the
+        buildCache"""
+        self.index.getLastTime(self.builder, 's1')
+        self.builder.builder_status.buildCache = {}
+
+        self.index.buildFinished("b1", self.makeBuild('s3', 400), 0)
+        self.assertEquals(self.index.pickMostRecent(self.builder,
+                                                    self.slaves),
+                          self.slaves[2])
+
+        # Failed builds are ignored
+        self.index.buildFinished("b1", self.makeBuild('s1', 500), 2)
+        self.assertEquals(self.index.getLastTime(self.builder, 's1'), 100)
+
+    def test_ties(self):
+        """Test that slaves later in the list win ties, like the old sort
+        did"""
+        self.builder.builder_status.buildCache = {}
+        self.assertEquals(self.index.pickMostRecent(self.builder,
+                                                    self.slaves),
+                          self.slaves[2])
+
+    def test_unsubscribeAll(self):
+        self.index.getLastTime(self.builder, 's1')
+        self.index.unsubscribeAll()
+        self.builder.builder_status.unsubscribe.assert_called_once_with(
+            self.index)
+        self.assertEquals(self.index.builders, {})
+
+
 class TestNextAWSSlave(unittest.TestCase):
     def setUp(self):
         self.slaves = slaves = []
@@ -65,6 +129,31 @@ class TestNextAWSSlave(unittest.TestCase):
         self.assertEquals(ondemand[0].slave.slavename, "slave-ec2")
         self.assertEquals(spot[0].slave.slavename, "slave-spot-001")
 
+    def test_classify_rules(self):
+        """Test that classification rules can be regexes or callables"""
+        classifier = SlaveClassifier([
+            (lambda name: name.endswith('-001'), 'spot'),
+            ('^slave-(hw|ec2)$', 'ondemand'),
+        ])
+        inhouse, ondemand, spot = _classifyAWSSlaves(self.slaves, classifier)
+        self.assertEquals(inhouse, [])
+        self.assertEquals([s.slave.slavename for s in ondemand],
+                          ["slave-hw", "slave-ec2"])
+        self.assertEquals([s.slave.slavename for s in spot],
+                          ["slave-spot-001"])
+
+    def test_classify_cache(self):
+        """Test that classifications are cached until the rules change"""
+        rule = mock.Mock(return_value=False)
+        classifier = SlaveClassifier([(rule, 'spot')])
+        classifier.partition(self.slaves)
+        classifier.partition(self.slaves)
+        self.assertEquals(rule.call_count, 3)
+
+        classifier.setRules([('hw', 'spot')])
+        inhouse, ondemand, spot = classifier.partition(self.slaves)
+        self.assertEquals(spot, [self.slaves[0]])
+
     def test_nextAWSSlave_inhouse(self):
         """Test that _nextAWSSlave returns the correct slave in different
         situations"""
@@ -83,26 +172,24 @@ class TestNextAWSSlave(unittest.TestCase):
         """Test that we pick between ondemand and spot properly"""
         f = _nextAWSSlave()
         inhouse, ondemand, spot = _classifyAWSSlaves(self.slaves)
-        # We need to mock out _get_pending so that we don't have to create a db
-        # for these tests
-        with mock.patch.object(buildbotcustom.misc, "_get_pending") as \
-                _get_pending:
-            request = mock.Mock()
-            request.submittedAt = 0
-            _get_pending.return_value = [request]
+        # We need to mock out the pending request tracker so that we don't
+        # have to create a db for these tests
+        with mock.patch.object(buildbotcustom.misc._pending,
+                               "getOldestSubmitTime") as getOldest:
+            getOldest.return_value = 0
 
             # Sanity check - can't choose any slave if none are available!
             self.assertEquals(None,
                               f(self.builder, []))
 
-            # _get_pending shouldn't get called either
-            self.assertEquals(_get_pending.called, 0)
+            # getOldestSubmitTime shouldn't get called either
+            self.assertEquals(getOldest.called, 0)
 
-            # _get_pending shouldn't get called if we only have ondemand
+            # getOldestSubmitTime shouldn't get called if we only have ondemand
             # instances either
             self.assertEquals("slave-ec2",
                               f(self.builder, ondemand).slave.slavename)
-            self.assertEquals(_get_pending.called, 0)
+            self.assertEquals(getOldest.called, 0)
 
             # Spot instances should be preferred
             self.assertEquals("slave-spot-001",
@@ -113,15 +200,13 @@ class TestNextAWSSlave(unittest.TestCase):
         available"""
         f = _nextAWSSlave(aws_wait=60)
         inhouse, ondemand, spot = _classifyAWSSlaves(self.slaves)
-        # We need to mock out _get_pending so that we don't have to create a db
-        # for these tests
-        with mock.patch.object(buildbotcustom.misc, "_get_pending") as \
-                _get_pending:
+        # We need to mock out the pending request tracker so that we don't
+        # have to create a db for these tests
+        with mock.patch.object(buildbotcustom.misc._pending,
+                               "getOldestSubmitTime") as getOldest:
             # Also need to mock time
             with mock.patch.object(buildbotcustom.misc, "now") as t:
-                request = mock.Mock()
-                request.submittedAt = 0
-                _get_pending.return_value = [request]
+                getOldest.return_value = 0
 
                 # at t=1, we shouldn't use an ondemand or spot intance
                 t.return_value = 1
@@ -136,62 +221,241 @@ class TestNextAWSSlave(unittest.TestCase):
                                   f(self.builder,
                                     ondemand).slave.slavename)
 
+                # A request we don't know about yet was just submitted, so
+                # we wait for it too
+                getOldest.return_value = None
+                self.assertEquals(None, f(self.builder, spot + ondemand))
+
     def test_nextAWSSlave_noRequests(self):
         """Test that everything works if there are no pending requests to
         getRetries"""
         f = _nextAWSSlave()
         inhouse, ondemand, spot = _classifyAWSSlaves(self.slaves)
-        # We need to mock out _get_pending so that we don't have to create a db
-        # for these tests
-        with mock.patch.object(buildbotcustom.misc, "_get_pending") as \
-                _get_pending:
-            _get_pending.return_value = []
+        # We need to mock out the pending request tracker so that we don't
+        # have to create a db for these tests
+        with mock.patch.object(buildbotcustom.misc._pending,
+                               "getOldestSubmitTime") as getOldest:
+            getOldest.return_value = None
 
             # Sanity check - can't choose any slave if none are available!
             self.assertEquals(None,
                               f(self.builder, []))
 
-            # _get_pending shouldn't get called either
-            self.assertEquals(_get_pending.called, 0)
+            # getOldestSubmitTime shouldn't get called either
+            self.assertEquals(getOldest.called, 0)
 
-            # _get_pending shouldn't get called if we only have ondemand
+            # getOldestSubmitTime shouldn't get called if we only have ondemand
             # instances either
             self.assertEquals("slave-ec2",
                               f(self.builder, ondemand).slave.slavename)
-            self.assertEquals(_get_pending.called, 0)
+            self.assertEquals(getOldest.called, 0)
 
             # Spot instances should be preferred if there are no retries
             self.assertEquals("slave-spot-001",
                               f(self.builder, spot + ondemand).slave.slavename)
 
 
-class TestGetPending(unittest.TestCase):
-    basedir = "test_misc_nextslaves"
+class TestPendingRequestTracker(unittest.TestCase):
+    def makeRequest(self, _id, submittedAt):
+        request = mock.Mock()
+        request.id = _id
+        request.submittedAt = submittedAt
+        return request
 
-    def setUp(self):
-        if os.path.exists(self.basedir):
-            shutil.rmtree(self.basedir)
-        os.makedirs(self.basedir)
-        spec = dbspec.DBSpec.from_url("sqlite:///state.sqlite", self.basedir)
-        # For testing against mysql, uncomment this
-        # spec = dbspec.DBSpec.from_url("mysql://buildbot@localhost/buildbot_schedulers", self.basedir)
-        manager = DBSchemaManager(spec, self.basedir)
-        manager.upgrade()
-
-        self.dbc = connector.DBConnector(spec)
-        self.dbc.start()
-
-    def tearDown(self):
-        self.dbc.stop()
-        shutil.rmtree(self.basedir)
-
-    def test_get_pending(self):
-        # Get a db transaction object so that getRetries' stack walking can
-        # find it!
-        t = self.dbc.get_sync_connection().cursor()
+    def makeRequestStatus(self, brid, buildername="b1", submittedAt=None):
+        request = mock.Mock()
+        request.brid = brid
+        request.getBuilderName.return_value = buildername
+        request.getSubmitTime.return_value = submittedAt
+        return request
 
+    def setUp(self):
+        self.tracker = PendingRequestTracker()
+        self.builder = builder = mock.Mock()
+        builder.name = "b1"
+        builder.builder_status.getName.return_value = "b1"
+        self.requests = [self.makeRequest(2, 20), self.makeRequest(1, 10)]
+        builder.db.runInteraction.side_effect = \
+            lambda f, *args: defer.succeed(self.requests)
+
+    def test_resync(self):
+        """Test that the pending requests are read from the db"""
+        self.assertEquals(self.tracker.getOldestSubmitTime(self.builder),
+                          None)
+        state = self.tracker.builders["b1"]
+        self.tracker._resync(self.builder, state)
+        self.assertEquals(self.tracker.getOldestSubmitTime(self.builder), 10)
+        self.builder.builder_status.subscribe.assert_called_once_with(
+            self.tracker)
+
+    def test_events(self):
+        """Test that submitted and cancelled requests update the oldest
+        submit time"""
+        self.tracker.getOldestSubmitTime(self.builder)
+        state = self.tracker.builders["b1"]
+        self.tracker._resync(self.builder, state)
+
+        with mock.patch.object(buildbotcustom.misc, "now") as t:
+            t.return_value = 30
+            # The request's own submit time is used, not the time we heard
+            # about it
+            self.tracker.requestSubmitted(
+                self.makeRequestStatus(3, submittedAt=5))
+            self.assertEquals(
+                self.tracker.getOldestSubmitTime(self.builder), 5)
+
+            self.tracker.requestCancelled(self.builder.builder_status,
+                                          self.makeRequestStatus(3))
+            self.assertEquals(
+                self.tracker.getOldestSubmitTime(self.builder), 10)
+
+            # Requests for other builders are ignored
+            self.tracker.requestSubmitted(
+                self.makeRequestStatus(4, "b2", submittedAt=1))
+            self.assertEquals(
+                self.tracker.getOldestSubmitTime(self.builder), 10)
+
+    def test_readOnly(self):
+        """Test that looking up the oldest submit time, which nextSlave
+        functions do from db threads, doesn't change the heap"""
+        self.tracker.getOldestSubmitTime(self.builder)
+        state = self.tracker.builders["b1"]
+        self.tracker._resync(self.builder, state)
+        heap = list(state['heap'])
+        # Claimed, but not pruned yet
+        del state['live'][1]
+        self.assertEquals(self.tracker.getOldestSubmitTime(self.builder), 10)
+        self.assertEquals(state['heap'], heap)
+
+        self.tracker.requestCancelled(self.builder.builder_status,
+                                      self.makeRequestStatus(2))
+        self.assertEquals(self.tracker.getOldestSubmitTime(self.builder),
+                          None)
+        self.assertEquals(state['heap'], [])
+
+    def test_seed(self):
+        """Test that the first resync pokes the botmaster, so builders that
+        were waiting on it get another look"""
+        self.tracker.getOldestSubmitTime(self.builder)
+        state = self.tracker.builders["b1"]
+        self.tracker._resync(self.builder, state)
+        self.assertEquals(
+            self.builder.botmaster.maybeStartAllBuilds.call_count, 1)
+
+        self.tracker._resync(self.builder, state)
+        self.assertEquals(
+            self.builder.botmaster.maybeStartAllBuilds.call_count, 1)
+
+    def test_reconfig(self):
+        """Test that a builder with a new status object keeps its pending
+        requests until the resync finishes"""
+        self.tracker.getOldestSubmitTime(self.builder)
+        old_status = self.builder.builder_status
+        self.tracker._resync(self.builder, self.tracker.builders["b1"])
+
+        self.builder.builder_status = mock.Mock()
+        self.requests = []
+        self.assertEquals(self.tracker.getOldestSubmitTime(self.builder), 10)
+        old_status.unsubscribe.assert_called_once_with(self.tracker)
+        self.builder.builder_status.subscribe.assert_called_once_with(
+            self.tracker)
+        state = self.tracker.builders["b1"]
+        self.assertTrue(state['dirty'])
+
+        self.tracker._resync(self.builder, state)
+        self.assertEquals(self.tracker.getOldestSubmitTime(self.builder),
+                          None)
+
+    def test_unsubscribeAll(self):
+        self.tracker.getOldestSubmitTime(self.builder)
+        self.tracker.unsubscribeAll()
+        self.builder.builder_status.unsubscribe.assert_called_once_with(
+            self.tracker)
+        self.assertEquals(self.tracker.builders, {})
+
+    def test_buildStarted(self):
+        """Test that starting a build causes a resync"""
+        self.tracker.getOldestSubmitTime(self.builder)
+        state = self.tracker.builders["b1"]
+        self.tracker._resync(self.builder, state)
+        self.assertFalse(state['dirty'])
+
+        self.tracker.buildStarted("b1", mock.Mock())
+        self.assertTrue(state['dirty'])
+
+        self.requests = []
+        self.tracker._resync(self.builder, state)
+        self.assertEquals(self.tracker.getOldestSubmitTime(self.builder),
+                          None)
+
+
+class TestSlaveAssignmentPlanner(unittest.TestCase):
+    def makeBuilder(self, name, slaves):
         builder = mock.Mock()
-        builder._getBuildable.return_value = []
-        builder.db = self.dbc
+        builder.name = name
+        builder.builder_status.buildCache = {}
+        builder.slaves = slaves
+        return builder
+
+    def setUp(self):
+        self.slaves = slaves = []
+        for name in ('slave-hw', 'slave-spot-001', 'slave-ec2'):
+            slave = mock.Mock()
+            slave.slave.slavename = name
+            slave.isAvailable.return_value = True
+            slaves.append(slave)
 
-        self.assertEquals(_get_pending(builder), ([]))
+        self.oldest = {}
+        pending = mock.Mock()
+        pending.getOldestSubmitTime.side_effect = \
+            lambda b: self.oldest.get(b.name)
+
+        self.planner = SlaveAssignmentPlanner(None, SlaveClassifier(),
+                                              pending, LastSuccessIndex())
+        self.fallback = mock.Mock(return_value=None)
+        # mock 1.0 doesn't give Mocks a __name__ for wraps() to copy
+        self.fallback.__name__ = "fallback"
+        self.nextSlave = self.planner(self.fallback)
+
+    def test_oldest_first(self):
+        """Test that builders with older requests get the better slaves,
+        whichever builder asks first"""
+        b1 = self.makeBuilder("b1", self.slaves)
+        b2 = self.makeBuilder("b2", self.slaves)
+        self.oldest = {"b1": 20, "b2": 10}
+        # Register both builders
+        self.nextSlave(b1, [])
+        self.nextSlave(b2, [])
+        self.planner.plan = None
+        self.fallback.reset_mock()
+
+        self.assertEquals(self.nextSlave(b1, self.slaves), self.slaves[1])
+        self.assertEquals(self.nextSlave(b2, self.slaves), self.slaves[0])
+        self.assertEquals(self.fallback.called, 0)
+
+    def test_scarce_slaves(self):
+        """Test that slaves only one builder can use are given to it, rather
+        than being taken by a builder with other options"""
+        hw1, hw2 = self.slaves[0], mock.Mock()
+        hw2.slave.slavename = 'slave-hw2'
+        hw2.isAvailable.return_value = True
+        b1 = self.makeBuilder("b1", [hw1, hw2])
+        b2 = self.makeBuilder("b2", [hw1])
+        self.oldest = {"b1": 10, "b2": 20}
+        self.nextSlave(b1, [])
+        self.nextSlave(b2, [])
+        self.planner.plan = None
+
+        # b1 could use either slave, but b2 can only use slave-hw
+        self.assertEquals(self.nextSlave(b1, [hw1, hw2]), hw2)
+        self.assertEquals(self.nextSlave(b2, [hw1]), hw1)
+
+    def test_fallback(self):
+        """Test that the wrapped function is used when the plan has nothing
+        for the builder, without the slaves planned for other builders"""
+        b1 = self.makeBuilder("b1", self.slaves)
+        b2 = self.makeBuilder("b2", self.slaves)
+        self.oldest = {"b1": 10}
+        self.nextSlave(b1, [])
+        self.nextSlave(b2, self.slaves)
+        self.fallback.assert_called_with(b2, self.slaves[1:])
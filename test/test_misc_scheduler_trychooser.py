@@ -0,0 +1,167 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from buildbot.util import json
+
+import buildbotcustom.misc_scheduler as misc_scheduler
+from buildbotcustom.misc_scheduler import TryPushCache, tryChooser
+
+
+class FakeChange(object):
+    def __init__(self, revision, comments='', branch='try', who='me',
+                 when=1):
+        self.revision = revision
+        self.comments = comments
+        self.branch = branch
+        self.who = who
+        self.when = when
+
+
+class FakeScheduler(object):
+    builderNames = ['b1', 'b2']
+    prettyNames = unittestPrettyNames = {}
+    unittestSuites = talosSuites = []
+    buildbotBranch = 'try'
+    buildersWithSetsMap = None
+
+
+def makePush(pushid, revisions, desc):
+    return {pushid: {
+        'date': 1,
+        'user': 'me',
+        'changesets': [{'node': r, 'desc': desc, 'files': [],
+                        'branch': 'default', 'tags': [], 'author': 'me'}
+                       for r in revisions],
+    }}
+
+
+class TestTryChooser(unittest.TestCase):
+    def setUp(self):
+        self.cache = TryPushCache(maxPushes=2)
+        self.patch(misc_scheduler, 'tryPushCache', self.cache)
+        self.fetches = []
+        self.patch(misc_scheduler, 'getPage', self.getPage)
+        self.parsed = []
+        self.patch(misc_scheduler, 'getTryParser', lambda s: self)
+        self.s = FakeScheduler()
+        self.pushes = {}
+
+    def getPage(self, url, timeout=None):
+        self.assertEquals(timeout, self.cache.timeout)
+        d = defer.Deferred()
+        self.fetches.append((url, d))
+        return d
+
+    def parse(self, comments):
+        self.parsed.append(comments)
+        return self.s.builderNames[:1]
+
+    def respond(self, i, push):
+        url, d = self.fetches[i]
+        d.callback(json.dumps(push))
+
+    def testSamePush(self):
+        changes = [FakeChange('a' * 40), FakeChange('b' * 40)]
+        d = tryChooser(self.s, changes)
+        # Both are waiting on the same request
+        self.assertEquals(len(self.fetches), 1)
+        self.failUnless(self.fetches[0][0].endswith('changeset=' + 'a' * 40))
+        push = makePush('10', ['a' * 40, 'b' * 40], 'try: -b o')
+        self.respond(0, push)
+
+        def check(buildersPerChange):
+            self.assertEquals(buildersPerChange,
+                              {changes[0]: ['b1'], changes[1]: ['b1']})
+            self.assertEquals(self.parsed, ['try: -b o'])
+            self.assertEquals(self.cache.stats,
+                              {'hits': 0, 'misses': 1, 'coalesced': 1})
+            # Rescheduling the push needs no requests or parsing
+            return tryChooser(self.s, changes)
+
+        def checkAgain(buildersPerChange):
+            self.assertEquals(len(buildersPerChange), 2)
+            self.assertEquals(len(self.fetches), 1)
+            self.assertEquals(self.parsed, ['try: -b o'])
+            self.assertEquals(self.cache.stats['hits'], 2)
+        d.addCallback(check)
+        d.addCallback(checkAgain)
+        return d
+
+    def testNotInPush(self):
+        changes = [FakeChange('a' * 40), FakeChange('b' * 40)]
+        d = tryChooser(self.s, changes)
+        # b looks like it's in a's push, so it waits to see
+        self.assertEquals(len(self.fetches), 1)
+        self.respond(0, makePush('10', ['a' * 40], 'try: -b o'))
+        # It isn't, so it gets its own request
+        self.assertEquals(len(self.fetches), 2)
+        self.failUnless(self.fetches[1][0].endswith('changeset=' + 'b' * 40))
+        self.respond(1, makePush('11', ['b' * 40], 'try: -b d'))
+
+        def check(buildersPerChange):
+            self.assertEquals(len(buildersPerChange), 2)
+            self.assertEquals(self.parsed, ['try: -b o', 'try: -b d'])
+            self.assertEquals(self.cache.stats,
+                              {'hits': 0, 'misses': 2, 'coalesced': 1})
+        d.addCallback(check)
+        return d
+
+    def testDifferentPushes(self):
+        changes = [FakeChange('a' * 40), FakeChange('b' * 40, when=2)]
+        d = tryChooser(self.s, changes)
+        # Neither waits for the other
+        self.assertEquals(len(self.fetches), 2)
+        self.respond(1, makePush('11', ['b' * 40], 'try: -b d'))
+        self.assertEquals(self.parsed, ['try: -b d'])
+        self.respond(0, makePush('10', ['a' * 40], 'try: -b o'))
+
+        def check(buildersPerChange):
+            self.assertEquals(len(buildersPerChange), 2)
+            self.assertEquals(self.cache.stats,
+                              {'hits': 0, 'misses': 2, 'coalesced': 0})
+            self.assertEquals(self.cache.inflight, {})
+            self.assertEquals(self.cache.inflightPushes, {})
+        d.addCallback(check)
+        return d
+
+    def testHungFetch(self):
+        """Tests that a request that never answers only holds up changes
+        from its own push"""
+        tryChooser(self.s, [FakeChange('a' * 40)])
+        d = tryChooser(self.s, [FakeChange('b' * 40, when=2)])
+        self.assertEquals(len(self.fetches), 2)
+        self.respond(1, makePush('11', ['b' * 40], 'try: -b d'))
+        d.addCallback(lambda builders: self.assertEquals(len(builders), 1))
+        return d
+
+    def testCommentsInChange(self):
+        changes = [FakeChange('a' * 40, comments='try: -b d')]
+        d = tryChooser(self.s, changes)
+        self.assertEquals(self.fetches, [])
+        d.addCallback(lambda _: self.assertEquals(self.parsed, ['try: -b d']))
+        return d
+
+    def testFetchFailed(self):
+        changes = [FakeChange('a' * 40)]
+        d = tryChooser(self.s, changes)
+        self.fetches[0][1].errback(Exception('hg is down'))
+
+        def check(buildersPerChange):
+            self.assertEquals(buildersPerChange, {changes[0]: ['b1']})
+            self.assertEquals(self.parsed, [''])
+            # Not cached
+            self.assertEquals(self.cache.revisions, {})
+        d.addCallback(check)
+        return d
+
+    def testEviction(self):
+        for i, rev in enumerate('abc'):
+            self.cache.add(str(i), {'comments': None, 'revisions': [rev],
+                                    'builders': {}})
+        self.assertEquals(self.cache.pushes.keys(), ['1', '2'])
+        self.assertEquals(sorted(self.cache.revisions), ['b', 'c'])
+        # Looking a push up makes it the most recently used
+        self.cache.getPush('b')
+        self.cache.add('3', {'comments': None, 'revisions': ['d'],
+                             'builders': {}})
+        self.assertEquals(self.cache.pushes.keys(), ['1', '3'])
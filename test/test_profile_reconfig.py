@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+from twisted.trial import unittest
+
+import buildbotcustom
+
+BASE_DIR = os.path.dirname(os.path.abspath(buildbotcustom.__file__))
+SCRIPT = os.path.join(BASE_DIR, 'bin', 'profile_reconfig.py')
+FIXTURE = os.path.join(BASE_DIR, 'test', 'fixtures', 'reconfig',
+                       'spidermonkey.json')
+
+
+class TestProfileReconfig(unittest.TestCase):
+    def run_script(self, *args):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        proc = subprocess.Popen([sys.executable, SCRIPT] + list(args),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, env=env)
+        output = proc.communicate()[0]
+        self.assertEquals(proc.returncode, 0, output)
+        return output
+
+    def testSmoke(self):
+        """Tests that the smallest fixture runs, without Twisted or
+        zope.interface, as outside the tox environment"""
+        output = self.run_script('--stub', 'twisted', '--stub', 'zope',
+                                 '--top', '1', FIXTURE)
+        self.assertTrue('6 builders, 4 schedulers' in output, output)
@@ -0,0 +1,106 @@
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.test.proto_helpers import StringTransport
+
+from buildbot.util import json
+
+from buildbotcustom.changes import pushnotify
+from buildbotcustom import misc
+
+
+class FakeQueueDir(object):
+    name = 'fake'
+
+    def __init__(self, items):
+        self.items = list(items)
+        self.removed = []
+        self.murdered = []
+
+    def pop(self):
+        if not self.items:
+            return None
+        item_id = 'item%i' % len(self.removed + self.murdered)
+        return item_id, StringIO(self.items.pop(0))
+
+    def remove(self, item_id):
+        self.removed.append(item_id)
+
+    def murder(self, item_id):
+        self.murdered.append(item_id)
+
+
+class FakePoller(object):
+    def __init__(self, url):
+        self.url = url
+        self.notifications = 0
+
+    def wantsPush(self, url):
+        return url == self.url
+
+    def notified(self):
+        self.notifications += 1
+
+
+class TestPushNotifier(unittest.TestCase):
+    def setUp(self):
+        self.central = FakePoller('http://hg/mozilla-central')
+        self.inbound = FakePoller('http://hg/mozilla-inbound')
+
+    def makeNotifier(self, **kwargs):
+        notifier = pushnotify.PushNotifier(**kwargs)
+        notifier.parent = [self.central, self.inbound, object()]
+        return notifier
+
+    def testQueueDir(self):
+        queuedir = FakeQueueDir([
+            json.dumps({'url': 'http://hg/mozilla-central', 'pushid': 1}),
+            '{"url": ',
+            json.dumps({'url': 'http://hg/elsewhere', 'pushid': 2}),
+        ])
+        notifier = self.makeNotifier(queuedir=queuedir)
+        notifier.checkQueue()
+        self.assertEquals(self.central.notifications, 1)
+        self.assertEquals(self.inbound.notifications, 0)
+        self.assertEquals(queuedir.removed, ['item0', 'item2'])
+        self.assertEquals(queuedir.murdered, ['item1'])
+        self.assertEquals(notifier.stats,
+                          {'notifications': 2, 'polls': 1, 'unmatched': 1})
+
+    def testSocket(self):
+        notifier = self.makeNotifier(listen='tcp:0')
+        proto = pushnotify.NotificationFactory(notifier).buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        proto.dataReceived('{"url": "http://hg/mozilla-inbound"}\n'
+                           'garbage\n\n'
+                           '{"url": "http://hg/mozilla-inbound", ')
+        self.assertEquals(self.inbound.notifications, 1)
+        proto.dataReceived('"pushid": 5}\n')
+        self.assertEquals(self.inbound.notifications, 2)
+        self.assertEquals(self.central.notifications, 0)
+
+    def testQueueDirPath(self):
+        path = self.mktemp()
+        notifier = self.makeNotifier(queuedir=path)
+        self.assertEquals(notifier.queuedir, path)
+        self.assertEquals(notifier.describe(),
+                          "Push notifications from %s" % path)
+        # Notifiers for the same path compare equal, so a reconfig keeps the
+        # running one
+        self.assertEquals(notifier, pushnotify.PushNotifier(queuedir=path))
+
+
+class TestMakePushNotifier(unittest.TestCase):
+    def testSettings(self):
+        notifier = misc.makePushNotifier('mozilla-central',
+                                         {'listen': 'tcp:0'})
+        self.assertEquals(notifier.listen, 'tcp:0')
+        self.assertEquals(notifier.queue, None)
+
+    def testNoSource(self):
+        # Without somewhere to get notifications from, polling less often
+        # would just mean noticing pushes later
+        self.assertRaises(ValueError, misc.makePushNotifier,
+                          'mozilla-central', True)
+        self.assertRaises(ValueError, misc.makePushNotifier,
+                          'mozilla-central', {'checkInterval': 5})
@@ -0,0 +1,75 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.trial import unittest
+
+from buildbotcustom.reloader import ReloadManager
+
+
+class TestReloadManager(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        sys.path.insert(0, self.tmpdir)
+        self.writeModule('rl_base', 'X = 1\n')
+        self.writeModule('rl_user', 'from rl_base import X\n'
+                         'class User(object):\n    pass\n')
+        self.writeModule('rl_other', 'Y = 2\n')
+        import rl_base
+        import rl_user
+        import rl_other
+        self.base, self.user, self.other = rl_base, rl_user, rl_other
+        self.m = ReloadManager()
+        self.m.reloadChanged(self.base, self.user, self.other)
+
+    def tearDown(self):
+        sys.path.remove(self.tmpdir)
+        for name in ('rl_base', 'rl_user', 'rl_other'):
+            sys.modules.pop(name, None)
+        shutil.rmtree(self.tmpdir)
+
+    def writeModule(self, name, source):
+        filename = os.path.join(self.tmpdir, '%s.py' % name)
+        mtime = None
+        if os.path.exists(filename):
+            mtime = os.stat(filename).st_mtime
+        f = open(filename, 'w')
+        f.write(source)
+        f.close()
+        for ext in ('c', 'o'):
+            if os.path.exists(filename + ext):
+                os.unlink(filename + ext)
+        if mtime is not None:
+            # Make sure the change is noticed, even with coarse mtimes
+            os.utime(filename, (time.time(), mtime + 2))
+
+    def testFirstSeenNotReloaded(self):
+        self.assertEquals(self.m.timings, [])
+        self.assertEquals(self.m.dependencies['rl_user'], {'rl_base': 0})
+
+    def testUnchanged(self):
+        self.assertEquals(
+            self.m.reloadChanged(self.base, self.user, self.other), [])
+
+    def testTouched(self):
+        filename = self.m.sourceFile(self.base)
+        mtime = os.stat(filename).st_mtime
+        os.utime(filename, (time.time(), mtime + 2))
+        self.assertEquals(self.m.reloadChanged(self.base), [])
+
+    def testChangedAndDependents(self):
+        oldUser = self.user.User
+        self.writeModule('rl_base', 'X = 42\n')
+        # rl_user is asked about first, so rl_base is reloaded as its
+        # dependency first
+        self.assertEquals(
+            self.m.reloadChanged(self.user, self.base, self.other),
+            ['rl_user'])
+        self.assertEquals(self.base.X, 42)
+        self.assertEquals(self.user.X, 42)
+        self.assertNotEqual(self.user.User, oldUser)
+        self.assertEquals([name for name, t in self.m.timings],
+                          ['rl_base', 'rl_user'])
+        self.assertEquals(self.m.reloadChanged(self.base, self.user), [])
@@ -1,4 +1,5 @@
-from buildbotcustom.try_parser import TryParser, processMessage
+from buildbotcustom.try_parser import TryParser, CompiledTryParser, \
+    processMessage, suiteAliases, dumpSuiteAliases, expandTestSuites
 import unittest
 
 
@@ -682,5 +683,133 @@ try: -this -should -be -ignored""")
 try: -a -b -c""")
 
 
+class TestCompiledTryParser(unittest.TestCase):
+    # Builders chosen by TryParser before CompiledTryParser replaced it.
+    # The default set is what it chose for messages without try syntax.
+    DEFAULT_BUILDERS = [
+        'Rev3 Fedora 12 try debug test mochitest-1',
+        'Rev3 Fedora 12 try debug test mochitest-browser-chrome',
+        'Rev3 Fedora 12 try debug test mochitest-other',
+        'Rev3 Fedora 12 try opt test crashtest',
+        'Rev3 Fedora 12 try opt test mochitest-1',
+        'Rev3 Fedora 12 try opt test mochitest-browser-chrome',
+        'Rev3 Fedora 12 try opt test mochitest-other',
+        'Rev3 MacOSX Snow Leopard 10.6.2 try debug test crashtest',
+        'Rev3 WINNT 5.1 try opt test crashtest',
+        'Rev3 WINNT 5.1 try opt test reftest',
+        'Rev3 WINNT 6.1 try debug test crashtest',
+        'Rev3 WINNT 6.1 try debug test mochitest-3',
+        'Rev3 WINNT 6.1 try debug test mochitest-browser-chrome',
+        'Rev3 WINNT 6.1 try debug test mochitest-other',
+        'Rev3 WINNT 6.1 try opt test crashtest',
+        'Windows XP 32-bit try debug test crashtest',
+        'b2g_ubuntu64_vm try opt test gaia-js-integration-1',
+        'b2g_ubuntu64_vm try opt test gaia-js-integration-2',
+        'b2g_ubuntu64_vm try opt test gaia-ui-test-accessibility',
+        'b2g_ubuntu64_vm try opt test gaia-ui-test-unit',
+    ]
+    EXPECTED = {
+        '': DEFAULT_BUILDERS,
+        'try: junk': DEFAULT_BUILDERS,
+        # TryParser raised IndexError for an empty try: line
+        'try: ': DEFAULT_BUILDERS,
+        'try: -b o -p win32 -u all': [
+            'Rev3 WINNT 5.1 try opt test crashtest',
+            'Rev3 WINNT 5.1 try opt test reftest',
+            'Rev3 WINNT 6.1 try opt test crashtest',
+        ],
+        'try: -b d -p all -u mochitests': [
+            'Rev3 Fedora 12 try debug test mochitest-1',
+            'Rev3 Fedora 12 try debug test mochitest-browser-chrome',
+            'Rev3 Fedora 12 try debug test mochitest-other',
+            'Rev3 WINNT 6.1 try debug test mochitest-3',
+            'Rev3 WINNT 6.1 try debug test mochitest-browser-chrome',
+            'Rev3 WINNT 6.1 try debug test mochitest-other',
+        ],
+        'try: -b do -p full -u all[Fedora,-x64]': [
+            'Rev3 Fedora 12 try debug test mochitest-1',
+            'Rev3 Fedora 12 try debug test mochitest-browser-chrome',
+            'Rev3 Fedora 12 try debug test mochitest-other',
+            'Rev3 Fedora 12 try opt test crashtest',
+            'Rev3 Fedora 12 try opt test mochitest-1',
+            'Rev3 Fedora 12 try opt test mochitest-browser-chrome',
+            'Rev3 Fedora 12 try opt test mochitest-other',
+        ],
+        'try: -p linux,win32 -u reftest,crashtest': [
+            'Rev3 Fedora 12 try opt test crashtest',
+            'Rev3 WINNT 5.1 try opt test crashtest',
+            'Rev3 WINNT 5.1 try opt test reftest',
+            'Rev3 WINNT 6.1 try debug test crashtest',
+            'Rev3 WINNT 6.1 try opt test crashtest',
+            'Windows XP 32-bit try debug test crashtest',
+        ],
+    }
+
+    def setUp(self):
+        self.parser = CompiledTryParser(
+            VALID_TESTER_NAMES, TESTER_PRETTY_NAMES, None, UNITTEST_SUITES,
+            maxMessages=2)
+
+    def test_SameAsOldTryParser(self):
+        for tm, builders in sorted(self.EXPECTED.items()):
+            self.assertEqual(sorted(self.parser.parse(tm)), builders, tm)
+            self.assertEqual(
+                sorted(TryParser(tm, VALID_TESTER_NAMES, TESTER_PRETTY_NAMES,
+                                 None, UNITTEST_SUITES)), builders, tm)
+
+    def test_Memoized(self):
+        tm = "try: -b o -p linux -u mochitests"
+        builders = self.parser.parse(tm)
+        # Only the try: line matters
+        again = self.parser.parse("Bug 1 - stuff\n" + tm + "\nmore stuff")
+        self.assertEqual(sorted(again), sorted(builders))
+        self.assertEqual(self.parser.stats, {'hits': 1, 'misses': 1})
+        # Callers get their own copy
+        again.append('junk')
+        self.assertEqual(sorted(self.parser.parse(tm)), sorted(builders))
+
+    def test_MaxMessages(self):
+        for tm in ["try: -b o", "try: -b d", "try: -b do"]:
+            self.parser.parse(tm)
+        self.assertEqual(len(self.parser.results), 2)
+        self.parser.parse("try: -b o")
+        self.assertEqual(self.parser.stats, {'hits': 0, 'misses': 4})
+
+
+class TestSuiteAliases(unittest.TestCase):
+    suites = MOBILE_UNITTEST_SUITES + ['mochitest-browser-chrome-1',
+                                       'mochitest-devtools-chrome-2',
+                                       'mochitest-e10s-1']
+
+    def test_SameAsExpandTestSuites(self):
+        aliases = suiteAliases(self.suites)
+        for u in ['all', 'mochitests', 'mochitest-o', 'reftests', 'e10s',
+                  'mochitest-bc', 'mochitest-bc1', 'mochitest-bc-1',
+                  'mochitest-dt2', 'mochitest-dt-2', 'gaia-ui-test',
+                  'reftest-1', 'crashtest']:
+            self.assertEqual(aliases[u],
+                             frozenset(expandTestSuites([u], self.suites)))
+
+    def test_NoEmptyAliases(self):
+        aliases = suiteAliases(self.suites)
+        self.assertFalse('xpcshell' in aliases)
+        self.assertFalse('mochitest-bc2' in aliases)
+        self.assertEqual(suiteAliases([]), {})
+
+    def test_Dump(self):
+        dump = dumpSuiteAliases(suiteAliases(['reftest-1', 'reftest-3']))
+        self.assertEqual(dump, "all: reftest-1, reftest-3\n"
+                               "reftest: reftest-1, reftest-3\n"
+                               "reftest-1: reftest-1\n"
+                               "reftest-3: reftest-3\n"
+                               "reftests: reftest-1, reftest-3")
+
+    def test_CompiledUnlistedAbbreviation(self):
+        suites = ['mochitest-devtools-chrome-devtools-chrome-1']
+        parser = CompiledTryParser([], {}, None, suites)
+        self.assertEqual(list(parser.expandSuite('mochitest-dt-dt1')), suites)
+        self.assertEqual(list(parser.expandSuite('junk')), [])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,242 @@
+"""Fuzzing and scaling tests for the try parser.
+
+These run against a generated try config about the size of the real one
+(3000 builders), built from the fixtures in test_try_parser. Rather than
+timing the parser, they count the work it does: how often argparse runs and
+how many arguments it is given. bin/bench_tryparser.py uses the same config
+and messages to report messages per second and how time grows with size.
+"""
+import random
+import unittest
+
+from buildbotcustom.try_parser import TryParser, CompiledTryParser, \
+    processMessage, parseTestOptions, basePlatform
+from buildbotcustom.test.test_try_parser import TESTER_PRETTY_NAMES, \
+    UNITTEST_SUITES, TALOS_SUITES
+
+
+def makeTryConfig(builders=3000):
+    '''Returns (builderNames, prettyNames, unittestSuites, talosSuites) for a
+    try test master with at least the given number of builders'''
+    unittestSuites = list(UNITTEST_SUITES)
+    for i in range(1, 11):
+        unittestSuites.extend([
+            'mochitest-%i' % i, 'mochitest-browser-chrome-%i' % i,
+            'mochitest-devtools-chrome-%i' % i, 'mochitest-e10s-%i' % i,
+            'reftest-%i' % i, 'web-platform-tests-%i' % i])
+    unittestSuites.extend(['xpcshell', 'jittest-1', 'jittest-2',
+                           'mochitest-gl', 'mochitest-other', 'robocop-1'])
+    unittestSuites = sorted(set(unittestSuites))
+    talosSuites = TALOS_SUITES + ['dromaeojs', 'svgr', 'tp5o', 'other']
+
+    platforms = sorted(TESTER_PRETTY_NAMES.items())
+    prettyNames = {}
+    builderNames = []
+    i = 0
+    while len(builderNames) < builders:
+        if platforms:
+            platform, pretties = platforms.pop(0)
+        else:
+            i += 1
+            platform = 'platform%i' % i
+            pretties = ['Rev%i Slave %i' % (i % 5, i),
+                        'Rev%i Slave %i try-nondefault' % (i % 5, i)]
+        prettyNames[platform] = pretties
+        for pretty in pretties:
+            base = basePlatform(pretty)
+            for buildType in ('opt', 'debug'):
+                builderNames.extend(['%s try %s test %s' % (base, buildType, s)
+                                     for s in unittestSuites])
+            builderNames.extend(['%s try talos %s' % (base, s)
+                                 for s in talosSuites])
+    return builderNames, prettyNames, unittestSuites, talosSuites
+
+
+def makeMessage(rnd, prettyNames, unittestSuites, talosSuites):
+    '''Returns a random commit message, usually with try syntax, some of it
+    valid'''
+    def choose(names):
+        names = rnd.sample(names, rnd.randint(1, min(4, len(names))))
+        if rnd.random() < 0.2:
+            names = ['%s[%s]' % (n, ','.join(
+                rnd.sample(['Rev3', '-Rev3', 'Slave', '-x64', 'try-nondefault',
+                            'Fedora', '-WINNT'], 2)))
+                for n in names]
+        return ','.join(names)
+
+    args = []
+    if rnd.random() < 0.8:
+        args.append('-b ' + rnd.choice(['o', 'd', 'do', 'od', 'x']))
+    if rnd.random() < 0.8:
+        args.append('-p ' + choose(sorted(prettyNames) +
+                                   ['all', 'full', 'none', 'junk']))
+    if rnd.random() < 0.8:
+        args.append('-u ' + choose(unittestSuites +
+                                   ['all', 'none', 'mochitests', 'reftests',
+                                    'mochitest-bc', 'mochitest-bc3',
+                                    'mochitest-dt-2', 'e10s', 'junk']))
+    if rnd.random() < 0.5:
+        args.append('-t ' + choose(talosSuites + ['all', 'none']))
+    if rnd.random() < 0.1:
+        args.append(''.join(rnd.choice('[],- \t-ux') for i in range(20)))
+    rnd.shuffle(args)
+    message = 'Bug %i - Fix something' % rnd.randint(1, 10 ** 6)
+    if rnd.random() < 0.9:
+        message += '\n\ntry: ' + ' '.join(args)
+    return message
+
+
+# Inputs that could make the parser take more than linear time: long try:
+# lines, lots of brackets, unclosed brackets and long lists of names
+SCALING_CASES = {
+    'unclosed brackets': lambda n: 'try: ' + '[' * n,
+    'unclosed filters': lambda n: 'try: ' + '[a ' * (n // 3),
+    'closed filters': lambda n: 'try: -u ' + ','.join(
+        ['mochitest-1[a,-b]'] * (n // 18)),
+    'unclosed filter list': lambda n: 'try: -u ' + '[a,' * (n // 3),
+    'long platform list': lambda n: 'try: -b do -p ' + ','.join(
+        ['linux', 'win32', 'macosx64'] * (n // 21)),
+    'many arguments': lambda n: 'try: ' + '-x ' * (n // 3),
+    'long message': lambda n: 'Bug 1 - ' + 'words ' * (n // 6) +
+    '\ntry: -b o -p linux',
+    'many try lines': lambda n: 'try: -b o\n' * (n // 10),
+}
+
+
+def countArgParser(parser):
+    '''Wraps parser's argument parser so that the argument lists it is given
+    are recorded. Returns the list they are appended to.'''
+    calls = []
+    parse_known_args = parser.argParser.parse_known_args
+
+    def counted(args):
+        calls.append(args)
+        return parse_known_args(args)
+    parser.argParser.parse_known_args = counted
+    return calls
+
+
+class TestTryParserFuzz(unittest.TestCase):
+    messages = 500
+
+    def setUp(self):
+        self.rnd = random.Random(1)
+        self.builderNames, self.prettyNames, self.unittestSuites, \
+            self.talosSuites = makeTryConfig()
+        self.parser = CompiledTryParser(
+            self.builderNames, self.prettyNames, None, self.unittestSuites,
+            self.talosSuites)
+
+    def makeMessages(self, count):
+        return [makeMessage(self.rnd, self.prettyNames, self.unittestSuites,
+                            self.talosSuites)
+                for i in range(count)]
+
+    def test_ConfigSize(self):
+        self.assertTrue(len(self.builderNames) >= 3000)
+
+    def test_Fuzz(self):
+        builderNames = set(self.builderNames)
+        for message in self.makeMessages(self.messages):
+            try:
+                builders = self.parser.parse(message)
+            except ValueError:
+                # Malformed, e.g. '-b' with nothing after it
+                continue
+            self.assertEqual(len(builders), len(set(builders)), message)
+            self.assertTrue(builderNames.issuperset(builders), message)
+
+    def test_FuzzSameAsTryParser(self):
+        for message in self.makeMessages(20):
+            try:
+                builders = self.parser.parse(message)
+            except ValueError:
+                self.assertRaises(ValueError, TryParser, message,
+                                  self.builderNames, self.prettyNames, None,
+                                  self.unittestSuites, self.talosSuites)
+                continue
+            self.assertEqual(
+                sorted(builders),
+                sorted(TryParser(message, self.builderNames, self.prettyNames,
+                                 None, self.unittestSuites, self.talosSuites)),
+                message)
+
+    def test_FuzzProcessMessage(self):
+        for i in range(self.messages):
+            line = ''.join(self.rnd.choice('[] \ta,-') for j in range(30))
+            args = processMessage('try: ' + line)
+            # Every non-space character ends up in exactly one argument
+            self.assertEqual(''.join(''.join(args).split()),
+                             ''.join(line.split()), line)
+            parseTestOptions(line.replace(' ', ''), self.unittestSuites)
+
+    def test_TrailingTry(self):
+        self.assertEqual(processMessage('Backed out for try: '), [])
+
+    def test_Malformed(self):
+        self.assertRaises(ValueError, self.parser.parse, 'try: -p linux -b')
+        # Not help, and not an exit
+        self.assertEqual(sorted(self.parser.parse('try: -h')),
+                         sorted(self.parser.parse('')))
+
+    def test_MaxArgs(self):
+        self.parser.maxArgs = 4
+        self.assertEqual(
+            sorted(self.parser.parse('try: -b o -p linux -u junk')),
+            sorted(self.parser.parse('try: -b o -p linux')))
+
+    def parseAll(self, messages):
+        for message in messages:
+            try:
+                self.parser.parse(message)
+            except ValueError:
+                pass
+
+    def test_Cache(self):
+        calls = countArgParser(self.parser)
+        messages = self.makeMessages(self.messages)
+        distinct = len(set(tuple(processMessage(m)) for m in messages))
+        self.parseAll(messages)
+        # argparse runs once per distinct try: line...
+        self.assertEqual(len(calls), distinct)
+        self.assertEqual(self.parser.stats['misses'], distinct)
+        # ...and messages the parser has seen are a lookup away
+        self.parseAll(messages)
+        self.assertEqual(len(calls), distinct)
+        self.assertEqual(self.parser.stats['misses'], distinct)
+        self.assertEqual(self.parser.stats['hits'],
+                         len(messages) * 2 - distinct)
+
+
+class TestTryParserScaling(unittest.TestCase):
+    size = 32000
+
+    def setUp(self):
+        builderNames, prettyNames, unittestSuites, talosSuites = \
+            makeTryConfig()
+        self.parser = CompiledTryParser(builderNames, prettyNames, None,
+                                        unittestSuites, talosSuites)
+
+    def test_ProcessMessage(self):
+        for name, makeMessage in sorted(SCALING_CASES.items()):
+            message = makeMessage(self.size)
+            args = processMessage(message)
+            # Every non-space character of the first try: line ends up in
+            # exactly one argument
+            line = message.split('try: ', 1)[1].split('\n')[0]
+            self.assertEqual(''.join(''.join(args).split()),
+                             ''.join(line.split()), name)
+
+    def test_ParseArgs(self):
+        # argparse takes time quadratic in the number of options given, so
+        # it should never see more than maxArgs of them, once per message
+        calls = countArgParser(self.parser)
+        for name, makeMessage in sorted(SCALING_CASES.items()):
+            del calls[:]
+            try:
+                self.parser.parse(makeMessage(self.size))
+            except ValueError:
+                pass
+            self.assertEqual(len(calls), 1, name)
+            self.assertTrue(len(calls[0]) <= self.parser.maxArgs,
+                            "%s: %i arguments" % (name, len(calls[0])))
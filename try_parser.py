@@ -4,6 +4,7 @@
 
 import argparse
 import re
+from collections import OrderedDict
 
 from twisted.python import log
 
@@ -61,13 +62,62 @@ def expandTestSuites(user_suites, valid_suites):
     return [v for v in valid_suites for u in user_suites if testSuiteMatches(v, u)]
 
 
+# The suite names testSuiteMatches gives special meanings to
+SUITE_KEYWORDS = [
+    'all', 'mochitests', 'mochitest', 'jittests', 'jittest',
+    'mochitest-debug', 'mochitest-o', 'mochitest-a11y', 'xpcshell', 'robocop',
+    'mochitest-dt', 'mochitest-gl', 'mochitest-bc', 'mochitest-browser',
+    'reftests', 'reftest', 'web-platform-tests', 'web-platform-test', 'e10s',
+    'gaia-js-integration', 'gaia-ui-test',
+]
+# Numbered suites that can be abbreviated, e.g. mochitest-bc1 or
+# mochitest-bc-1 for mochitest-browser-chrome-1
+SUITE_ABBREVIATIONS = [
+    ('mochitest-devtools-chrome-', 'mochitest-dt'),
+    ('mochitest-browser-chrome-', 'mochitest-bc'),
+]
+
+
+def suiteAliases(valid_suites):
+    '''Returns a dict of every name that can be used to ask for some of
+    valid_suites, to the frozenset of suites it asks for'''
+    names = set(SUITE_KEYWORDS)
+    for v in valid_suites:
+        names.add(v)
+        for prefix, abbreviation in SUITE_ABBREVIATIONS:
+            if v.startswith(prefix):
+                rest = v[len(prefix):]
+                names.add(abbreviation + rest)
+                names.add(abbreviation + '-' + rest)
+    aliases = {}
+    for u in names:
+        suites = frozenset(expandTestSuites([u], valid_suites))
+        if suites:
+            aliases[u] = suites
+    return aliases
+
+
+def dumpSuiteAliases(aliases):
+    '''Formats a suiteAliases table one alias per line, for debugging'''
+    return '\n'.join(["%s: %s" % (u, ', '.join(sorted(aliases[u])))
+                      for u in sorted(aliases)])
+
+
 def processMessage(message):
     for line in message.split('\n'):
         match = re.search('try: ', str(line))
         if match:
-            line = line.strip().split('try: ', 1)
-            # Allow spaces inside of [filter expressions]
-            return re.findall(r'(?:\[.*?\]|\S)+', line[1])
+            line = line.split('try: ', 1)[1]
+            # Allow spaces inside of [filter expressions]. A '[' after the
+            # last ']' can't start one, so only look for them before that;
+            # looking from every '[' would take time quadratic in the length
+            # of the line.
+            end = line.rfind(']') + 1
+            args = re.findall(r'(?:\[.*?\]|\S)+', line[:end])
+            rest = re.findall(r'\S+', line[end:])
+            if args and rest and line[end:].startswith(rest[0]):
+                args[-1] += rest.pop(0)
+            return args + rest
     return [""]
 
 
@@ -188,7 +238,7 @@ def getTestBuilders(
     return list(testBuilders.intersection(builderNames))
 
 
-def parseTestOptions(s, testSuites):
+def parseTestOptions(s, testSuites, expandSuite=None):
     '''parse a comma-separated list of tests, each optionally followed by a
     comma-separated list of restrictions enclosed in square brackets
 
@@ -260,7 +310,9 @@ def parseTestOptions(s, testSuites):
         return '[' + str(n) + ']'
     # Replace restrictions inside of square brackets with a numeric id, and
     # generate a side table mapping that numeric id to a list of restrictions
-    s = re.sub(r'\[(.*?)\]', grab_restrictions, s)
+    # (only up to the last ']', as in processMessage)
+    end = s.rfind(']') + 1
+    s = re.sub(r'\[(.*?)\]', grab_restrictions, s[:end]) + s[end:]
 
     all_tests = set()
     restrictions_map = {}
@@ -270,7 +322,10 @@ def parseTestOptions(s, testSuites):
         if not m:
             return []  # Bad syntax
 
-        tests = expandTestSuites([m.group(1)], testSuites)
+        if expandSuite is not None:
+            tests = expandSuite(m.group(1))
+        else:
+            tests = expandTestSuites([m.group(1)], testSuites)
         if m.group(2):
             for test in tests:
                 restrictions_map[test] = restrictions[int(m.group(2))]
@@ -280,13 +335,17 @@ def parseTestOptions(s, testSuites):
     return list(all_tests), restrictions_map
 
 
-def TryParser(
-    message, builderNames, prettyNames, unittestPrettyNames=None, unittestSuites=None, talosSuites=None,
-        buildbotBranch='try', buildersWithSetsMap=None):
+class TryArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        # argparse prints usage and exits
+        raise ValueError(message)
 
-    parser = argparse.ArgumentParser(description='Pass in a commit message and a list \
+
+def makeArgParser():
+    # No -h; it would print help and exit
+    parser = TryArgumentParser(description='Pass in a commit message and a list \
                                      and tryParse populates the list with the builderNames\
-                                     that need schedulers.')
+                                     that need schedulers.', add_help=False)
 
     parser.add_argument('--build', '-b',
                         default='do',
@@ -304,116 +363,291 @@ def TryParser(
                         default='none',
                         dest='talos',
                         help='provide a list of talos tests, or specify all (default is None)')
-
-    (options, unknown_args) = parser.parse_known_args(processMessage(message))
-
-    # Build options include a possible override of 'all' to get a buildset
-    # that matches m-c
-    if options.build == 'do' or options.build == 'od':
-        options.build = ['opt', 'debug']
-    elif options.build == 'd':
-        options.build = ['debug']
-    elif options.build == 'o':
-        options.build = ['opt']
-    else:
-        # for any input other than do/od, d, o, all set to default
-        options.build = ['opt', 'debug']
-
-    if buildersWithSetsMap and type(buildersWithSetsMap) is dict:
-        # The TryChooser user has set a comma separated list of test suites
-        # This platform has a dictionary that allows to match a test suite
-        # to an actual builder (e.g. {"mochitest-1": "androidx86-set-1"}
-        chosen_suites = options.test.split(',')
-        new_choice = []
-        for chosen_suite in chosen_suites:
-            if chosen_suite == 'all':
-                new_choice.append(chosen_suite)
+    return parser
+
+
+# Build options include a possible override of 'all' to get a buildset that
+# matches m-c; anything else gets both
+BUILD_TYPES = {
+    'do': ('opt', 'debug'),
+    'od': ('opt', 'debug'),
+    'd': ('debug',),
+    'o': ('opt',),
+}
+
+
+class CompiledTryParser(object):
+    '''Chooses builders from try syntax for one set of builders.
+
+    Everything that depends only on the builders is worked out once, when
+    the parser is made: the argument parser, what -p all and -p full mean,
+    what each test suite name expands to, and the builder for each platform,
+    build type and test suite. Choosing builders for a message is then a
+    matter of looking them up. The builders chosen for the last maxMessages
+    distinct try: lines are remembered.
+
+    Takes the same arguments as TryParser, apart from the message.'''
+    maxMessages = 1000
+    # Only this many arguments of a try: line are looked at; argparse takes
+    # time quadratic in the number of options given
+    maxArgs = 200
+
+    def __init__(self, builderNames, prettyNames, unittestPrettyNames=None,
+                 unittestSuites=None, talosSuites=None, buildbotBranch='try',
+                 buildersWithSetsMap=None, maxMessages=None):
+        self.builderNames = frozenset(builderNames)
+        self.prettyNames = prettyNames
+        self.unittestPrettyNames = unittestPrettyNames
+        self.unittestSuites = unittestSuites
+        self.talosSuites = talosSuites
+        self.buildbotBranch = buildbotBranch
+        self.buildersWithSetsMap = buildersWithSetsMap
+        if maxMessages is not None:
+            self.maxMessages = maxMessages
+
+        self.argParser = makeArgParser()
+        # try: arguments -> builders
+        self.results = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+        # suite name -> test suites it asks for
+        self.suiteAliases = suiteAliases(unittestSuites or [])
+        self.talosAliases = suiteAliases(talosSuites or [])
+
+        # build types -> (all platforms, default platforms)
+        self.platforms = {}
+
+        # (expanded) platform -> build builder
+        self.platformBuilders = {}
+        # When prettyNames contains list values rather than simple strings,
+        # we're choosing test suites, so there aren't any build builders
+        if not (prettyNames and isinstance(prettyNames.values()[0], list)):
+            for p, pretty in prettyNames.iteritems():
+                builder = basePlatform(pretty)
+                if builder in self.builderNames:
+                    self.platformBuilders[p] = builder
+
+        # (platform, build type) -> {test suite: [(builder, isDefault)]}
+        self.testBuilders = {}
+        # debug platform -> {test suite: [(builder, isDefault)]}, for debug
+        # unittests run on the build master
+        self.debugTestBuilders = {}
+        # platform -> {talos suite: [(builder, isDefault)]}
+        self.talosBuilders = {}
+        if unittestSuites:
+            for platform, pretties in prettyNames.iteritems():
+                # check for list type to handle test_master builders where
+                # slave_platforms are used
+                if not isinstance(pretties, list):
+                    pretties = [pretties]
+                for buildType in ('opt', 'debug'):
+                    self._index(self.testBuilders, (platform, buildType),
+                                pretties, unittestSuites,
+                                "%%s %s %s test %%s" % (buildbotBranch,
+                                                        buildType))
+            for platform, pretty in (unittestPrettyNames or {}).iteritems():
+                self._index(self.debugTestBuilders, platform, [pretty],
+                            unittestSuites, "%s %s")
+        if talosSuites:
+            for platform, pretties in prettyNames.iteritems():
+                self._index(self.talosBuilders, platform, pretties,
+                            talosSuites, "%%s %s talos %%s" % buildbotBranch)
+
+    def _getPlatforms(self, buildTypes):
+        prettyNames = self.prettyNames
+        if self.unittestSuites:
+            all_platforms = prettyNames.keys()
+        else:
+            # for build builders (as opposed to test builders), check against
+            # the prettyNames for -debug
+            all_platforms = set()
+            if 'debug' in buildTypes:
+                all_platforms.update(
+                    [p for p in prettyNames.keys() if p.endswith('debug')])
+            if 'opt' in buildTypes:
+                all_platforms.update(
+                    [p for p in prettyNames.keys() if not p.endswith('debug')])
+
+            # Strip off -debug. It gets tacked on in getPlatformBuilders for
+            # buildType == debug
+            all_platforms = list(
+                set([p.replace('-debug', '') for p in all_platforms]))
+
+        # Platforms whose prettyNames all have 'try-nondefault' in them are
+        # not included in -p all
+        default_platforms = set()
+        if self.unittestSuites or self.talosSuites:
+            for p in all_platforms:
+                default_platforms.update(
+                    [p for n in prettyNames[p] if 'try-nondefault' not in n])
+        else:
+            defaultPrettyNames = dict([(k, v)
+                                       for k, v in prettyNames.iteritems()
+                                       if 'try-nondefault' not in v])
+            for p in all_platforms:
+                if p in defaultPrettyNames:
+                    default_platforms.add(p)
+                elif p + '-debug' in defaultPrettyNames:
+                    default_platforms.add(p)
+        return frozenset(all_platforms), frozenset(default_platforms)
+
+    def _index(self, index, key, pretties, suites, nameFormat):
+        '''Adds the builders in builderNames that nameFormat gives for each
+        of pretties and suites to index[key]'''
+        tests = {}
+        for pretty in pretties:
+            base_pretty = basePlatform(pretty)
+            for test in suites:
+                builder = nameFormat % (base_pretty, test)
+                if builder in self.builderNames:
+                    tests.setdefault(test, []).append(
+                        (builder, base_pretty == pretty))
+        if tests:
+            index[key] = tests
+
+    def _expand(self, u, aliases, valid_suites):
+        if u in aliases:
+            return aliases[u]
+        if u.startswith('mochitest-dt') or u.startswith('mochitest-bc'):
+            # Abbreviations of suites with odd names aren't in the table
+            return expandTestSuites([u], valid_suites)
+        return ()
+
+    def expandSuite(self, u):
+        return self._expand(u, self.suiteAliases, self.unittestSuites)
+
+    def expandTalos(self, u):
+        return self._expand(u, self.talosAliases, self.talosSuites)
+
+    def dumpAliases(self):
+        '''Returns the suite alias tables, formatted for debugging'''
+        return "unittests:\n%s\ntalos:\n%s" % (
+            dumpSuiteAliases(self.suiteAliases),
+            dumpSuiteAliases(self.talosAliases))
+
+    def parse(self, message):
+        '''Returns the builders chosen by message's try syntax. Raises
+        ValueError if it can't be parsed, e.g. -b with nothing after it.'''
+        args = processMessage(message)
+        if len(args) > self.maxArgs:
+            log.msg("TryChooser: ignoring all but the first %i of %i "
+                    "arguments" % (self.maxArgs, len(args)))
+            args = args[:self.maxArgs]
+        args = tuple(args)
+        if args in self.results:
+            self.stats['hits'] += 1
+            builders = self.results.pop(args)
+        else:
+            self.stats['misses'] += 1
+            builders = self._parse(args, message)
+            while len(self.results) >= self.maxMessages:
+                self.results.popitem(last=False)
+        self.results[args] = builders
+        return list(builders)
+
+    def _parse(self, args, message):
+        (options, unknown_args) = self.argParser.parse_known_args(list(args))
+
+        options.build = BUILD_TYPES.get(options.build, ('opt', 'debug'))
+
+        buildersWithSetsMap = self.buildersWithSetsMap
+        if buildersWithSetsMap and type(buildersWithSetsMap) is dict:
+            # The TryChooser user has set a comma separated list of test
+            # suites. This platform has a dictionary that allows to match a
+            # test suite to an actual builder (e.g. {"mochitest-1":
+            # "androidx86-set-1"}
+            chosen_suites = options.test.split(',')
+            new_choice = []
+            for chosen_suite in chosen_suites:
+                if chosen_suite == 'all':
+                    new_choice.append(chosen_suite)
+                    continue
+                if chosen_suite in buildersWithSetsMap:
+                    if chosen_suite not in new_choice:
+                        new_choice.append(buildersWithSetsMap[chosen_suite])
+            options.test = ','.join(new_choice)
+
+        if options.build not in self.platforms:
+            self.platforms[options.build] = self._getPlatforms(options.build)
+        all_platforms, default_platforms = self.platforms[options.build]
+        user_platforms = set()
+        for platform in options.user_platforms.split(','):
+            if platform == 'all':
+                user_platforms.update(default_platforms)
+            elif platform == 'full':
+                user_platforms.update(all_platforms)
+            else:
+                user_platforms.add(platform)
+
+        options.user_platforms = user_platforms
+
+        testFilters = None
+        if self.unittestSuites:
+            options.test, testFilters = parseTestOptions(
+                options.test, self.unittestSuites, self.expandSuite)
+
+        talosTestFilters = None
+        if self.talosSuites:
+            options.talos, talosTestFilters = parseTestOptions(
+                options.talos, self.talosSuites, self.expandTalos)
+
+        customBuilderNames = []
+        if options.user_platforms:
+            log.msg("TryChooser OPTIONS : MESSAGE %s : %s" % (options, message))
+            customBuilderNames = self.getPlatformBuilders(
+                options.user_platforms, options.build)
+
+            if options.test and self.unittestSuites:
+                # get test builders for test_master first
+                customBuilderNames.extend(self.getTestBuilders(
+                    options.user_platforms, options.build, options.test,
+                    testFilters))
+            if options.talos and self.talosSuites:
+                customBuilderNames.extend(self.getTalosBuilders(
+                    options.user_platforms, options.talos, talosTestFilters))
+
+        return tuple(customBuilderNames)
+
+    def getPlatformBuilders(self, user_platforms, buildTypes):
+        platforms = expandPlatforms(user_platforms, buildTypes)
+        return list(set([self.platformBuilders[p] for p in platforms
+                         if p in self.platformBuilders]))
+
+    def getTestBuilders(self, platforms, buildTypes, tests, testFilters):
+        indexes = []
+        for buildType in buildTypes:
+            for platform in platforms:
+                indexes.append(self.testBuilders.get((platform, buildType)))
+                # we do all but debug win32 over on test masters so have to
+                # check the unittestPrettyNames platforms for local builder
+                # master unittests
+                if buildType == 'debug' and not platform.endswith('debug'):
+                    indexes.append(
+                        self.debugTestBuilders.get('%s-debug' % platform))
+        return self._lookup(indexes, tests, testFilters)
+
+    def getTalosBuilders(self, platforms, tests, testFilters):
+        return self._lookup([self.talosBuilders.get(p) for p in platforms],
+                            tests, testFilters)
+
+    def _lookup(self, indexes, tests, testFilters):
+        testBuilders = set()
+        for index in indexes:
+            if not index:
                 continue
-            if buildersWithSetsMap.has_key(chosen_suite):
-                if chosen_suite not in new_choice:
-                    new_choice.append(buildersWithSetsMap[chosen_suite])
-        options.test = ','.join(new_choice)
+            for test in tests:
+                for builder, isDefault in index.get(test, ()):
+                    if passesFilter(testFilters, test, builder, isDefault):
+                        testBuilders.add(builder)
+        return list(testBuilders)
 
-    if unittestSuites:
-        all_platforms = prettyNames.keys()
-    else:
-        # for build builders (as opposed to test builders), check against the
-        # prettyNames for -debug
-        all_platforms = set()
-        if 'debug' in options.build:
-            all_platforms.update(
-                [p for p in prettyNames.keys() if p.endswith('debug')])
-        if 'opt' in options.build:
-            all_platforms.update(
-                [p for p in prettyNames.keys() if not p.endswith('debug')])
-
-        # Strip off -debug. It gets tacked on in the getPlatformBuilders for
-        # buildType == debug
-        all_platforms = list(
-            set([p.replace('-debug', '') for p in all_platforms]))
-
-    # Platforms whose prettyNames all have 'try-nondefault' in them are not
-    # included in -p all
-    default_platforms = set()
-    if unittestSuites or talosSuites:
-        for p in all_platforms:
-            default_platforms.update(
-                [p for n in prettyNames[p] if 'try-nondefault' not in n])
-    else:
-        defaultPrettyNames = dict([(k, v)
-                                   for k, v in prettyNames.iteritems()
-                                   if 'try-nondefault' not in v])
-        for p in all_platforms:
-            if p in defaultPrettyNames:
-                default_platforms.add(p)
-            elif p + '-debug' in defaultPrettyNames:
-                default_platforms.add(p)
-
-    user_platforms = set()
-    for platform in options.user_platforms.split(','):
-        if platform == 'all':
-            user_platforms.update(default_platforms)
-        elif platform == 'full':
-            user_platforms.update(all_platforms)
-        else:
-            user_platforms.add(platform)
-
-    options.user_platforms = user_platforms
-
-    testFilters = None
-    if unittestSuites:
-        options.test, testFilters = parseTestOptions(
-            options.test, unittestSuites)
-
-    talosTestFilters = None
-    if talosSuites:
-        options.talos, talosTestFilters = parseTestOptions(
-            options.talos, talosSuites)
-
-    # List for the custom builder names that match prettyNames passed in from
-    # misc.py
-    customBuilderNames = []
-    if options.user_platforms:
-        log.msg("TryChooser OPTIONS : MESSAGE %s : %s" % (options, message))
-        customBuilderNames = getPlatformBuilders(
-            options.user_platforms, builderNames, options.build, prettyNames)
-
-        if options.test and unittestSuites:
-            # get test builders for test_master first
-            customBuilderNames.extend(
-                getTestBuilders(
-                    options.user_platforms, "test", options.test, testFilters,
-                    builderNames, options.build, buildbotBranch, prettyNames, None))
-            # then add any builder_master test builders
-            if unittestPrettyNames:
-                customBuilderNames.extend(
-                    getTestBuilders(
-                        options.user_platforms, "test", options.test, testFilters,
-                        builderNames, options.build, buildbotBranch, {}, unittestPrettyNames))
-        if options.talos and talosSuites:
-            customBuilderNames.extend(
-                getTestBuilders(
-                    options.user_platforms, "talos", options.talos, talosTestFilters, builderNames,
-                    options.build, buildbotBranch, prettyNames, None))
-
-    return customBuilderNames
+
+def TryParser(
+    message, builderNames, prettyNames, unittestPrettyNames=None, unittestSuites=None, talosSuites=None,
+        buildbotBranch='try', buildersWithSetsMap=None):
+    '''Returns the builders chosen by message's try syntax. Schedulers that
+    parse many messages for the same builders should use a CompiledTryParser
+    instead.'''
+    parser = CompiledTryParser(builderNames, prettyNames, unittestPrettyNames,
+                               unittestSuites, talosSuites, buildbotBranch,
+                               buildersWithSetsMap)
+    return parser.parse(message)